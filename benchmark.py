@@ -0,0 +1,372 @@
+#!/usr/bin/python3
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from fractions import Fraction
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from typing import Callable, List, Optional, Tuple
+
+import instrumentation
+from bytereader import FileByteReader, CachedFileByteReader, RegionByteReader, open_file_reader
+from matroska import MatroskaParser
+from mp4 import MP4Parser, MovieBox, MovieFragmentBox, iter_boxes
+from manifestclient import EXTENSIONS, FORMATS
+from manifestformat import dump_manifest, load_manifest
+from manifestgen import process_file
+from mseparser import MSEParser, MediaSegment, SegmentTable, jsonify
+from segmentsplit import split_segments
+from synthetic import fragments_for_size, parse_size, write_file
+
+
+class CountingFile:
+    """
+    Unbuffered file proxy counting the calls that reach the OS. fileno() is deliberately not exposed, so that readers
+    can't bypass it with os.pread().
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb", buffering=0)
+        self.reads = 0
+        self.seeks = 0
+
+    def read(self, num_bytes: int = -1) -> bytes:
+        self.reads += 1
+        return self._file.read(num_bytes)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        self.seeks += 1
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+def parser_for_path(path: str) -> MSEParser:
+    if path.endswith(".webm"):
+        return MatroskaParser()
+    return MP4Parser()
+
+
+def best_time(function: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_readers(paths: List[str], repeat: int):
+    readers = {
+        "FileByteReader": lambda path: FileByteReader(open(path, "rb")),
+        "CachedFileByteReader": open_file_reader,
+        "MmapByteReader": lambda path: open_file_reader(path, use_mmap=True),
+    }
+    counted_readers = {
+        "FileByteReader": FileByteReader,
+        "CachedFileByteReader": CachedFileByteReader,
+    }
+    print(f"{'file':40} {'reader':22} {'seeks':>9} {'reads':>9} {'time (ms)':>10}")
+    for path in paths:
+        for name, make_reader in readers.items():
+            seeks = reads = "-"  # a mapped file is read through page faults instead
+            if name in counted_readers:
+                counting_file = CountingFile(path)
+                parser_for_path(path).find_media_segments(counted_readers[name](counting_file))
+                seeks, reads = counting_file.seeks, counting_file.reads
+            elapsed = best_time(lambda: parser_for_path(path).find_media_segments(make_reader(path)), repeat)
+            print(f"{path[-40:]:40} {name:22} {seeks:>9} {reads:>9} {elapsed * 1000:10.2f}")
+
+
+def bench_regions(depths: List[int], num_reads: int, repeat: int):
+    """Reads box headers at the bottom of region trees of increasing depth, like trun inside traf inside moof."""
+    header_size = 8
+    file_reader = FileByteReader(BytesIO(bytes(header_size * (max(depths) + num_reads))))
+    print(f"{'depth':>5} {'time per read (ns)':>20}")
+    for depth in depths:
+        reader = file_reader
+        for level in range(depth):
+            reader = RegionByteReader(reader, reader.start + header_size, None)
+
+        def read_headers():
+            for i in range(num_reads):
+                reader.read_at(reader.start + i * header_size, header_size)
+
+        elapsed = best_time(read_headers, repeat)
+        print(f"{depth:5} {elapsed / num_reads * 1e9:20.1f}")
+
+
+def decode_fragments_fully(path: str) -> List[MediaSegment]:
+    """Segment index built from a full MovieFragmentBox per moof, like MP4Parser did before having a fast path."""
+    reader = open_file_reader(path)
+    moov = MovieBox(next(box for box in iter_boxes(reader) if box.kind == b"moov"))
+    moofs = [MovieFragmentBox(box) for box in iter_boxes(reader) if box.kind == b"moof"]
+    timescale = moov.tracks[0].mdia.mdhd.timescale
+    ends = [moof.box.offset for moof in moofs[1:]] + [reader.end]
+    return [MediaSegment(moof.box.offset, end - moof.box.offset,
+                         Fraction(moof.trafs[0].tfdt.base_media_decode_time +
+                                  moof.trafs[0].truns[0].first_sample_composition_time_offset,
+                                  timescale) + moov.presentation_offset())
+            for moof, end in zip(moofs, ends)]
+
+
+def bench_fragments(paths: List[str], repeat: int):
+    print(f"{'file':40} {'fragments':>9} {'full decode (ms)':>17} {'fast path (ms)':>15}")
+    for path in paths:
+        segments = MP4Parser().find_media_segments(open_file_reader(path))
+        assert jsonify(segments) == jsonify(decode_fragments_fully(path))
+        full = best_time(lambda: decode_fragments_fully(path), repeat)
+        fast = best_time(lambda: MP4Parser().find_media_segments(open_file_reader(path)), repeat)
+        print(f"{path[-40:]:40} {len(segments):9} {full * 1000:17.2f} {fast * 1000:15.2f}")
+
+
+def split_segments_in_memory(file_path: str, base_dir: str):
+    """Splits a file reading each segment in memory, like segmentsplit.py did before copying in the kernel."""
+    media_segments = parser_for_path(file_path).find_media_segments(open_file_reader(file_path))
+    directory = os.path.join(base_dir, os.path.basename(file_path))
+    os.makedirs(directory, exist_ok=True)
+    extension = os.path.splitext(file_path)[1]
+    with open(file_path, "rb") as src_file:
+        with open(os.path.join(directory, f"init{extension}"), "wb") as dst_file:
+            dst_file.write(src_file.read(media_segments[0].offset))
+        for i, segment in enumerate(media_segments, 1):
+            with open(os.path.join(directory, f"media{i}{extension}"), "wb") as dst_file:
+                dst_file.write(src_file.read(segment.size))
+
+
+def measure_split(split: Callable[[str, str], None], path: str, output_dir: str, repeat: int) -> Tuple[float, int]:
+    """Runs in a fresh process, so that the peak RSS it returns (in KiB) is only the one of this split."""
+    base_dir = os.path.join(output_dir, "split")
+    best = float("inf")
+    for _ in range(repeat):
+        # Deleting the previous output is left out of the measurement
+        shutil.rmtree(base_dir, ignore_errors=True)
+        os.mkdir(base_dir)
+        start = time.perf_counter()
+        split(path, base_dir)
+        best = min(best, time.perf_counter() - start)
+    shutil.rmtree(base_dir)
+    return best, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_split(paths: List[str], output_dir: str, repeat: int):
+    methods = {
+        "in memory": split_segments_in_memory,
+        "kernel copy": partial(split_segments, checksums=False, jobs=1),
+        "reflink": partial(split_segments, reflink=True, checksums=False, jobs=1),
+        "checksums": partial(split_segments, jobs=1),
+        "checksums, 4 threads": partial(split_segments, jobs=4),
+    }
+    print(f"{'file':40} {'method':20} {'MB/s':>9} {'peak RSS (MB)':>14}")
+    for path in paths:
+        size = os.path.getsize(path)
+        for name, split in methods.items():
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                elapsed, peak_rss = executor.submit(measure_split, split, path, output_dir, repeat).result()
+            print(f"{path[-40:]:40} {name:20} {size / 1e6 / elapsed:9.1f} {peak_rss / 1024:14.1f}")
+
+
+def bench_manifests(num_segments: int, output_dir: str, repeat: int):
+    """Compares writing and loading a manifest with num_segments 2 second segments in each format."""
+    media_segments = SegmentTable()
+    media_segments.extend_ticks(range(1000, 1000 + num_segments * 500_000, 500_000), [500_000] * num_segments,
+                                range(0, num_segments * 180_000, 180_000), 90_000, time_offset=Fraction(1001, 30000))
+    print(f"{'format':14} {'write (ms)':>11} {'size (MB)':>10} {'load (ms)':>10} {'load + sum (ms)':>16}")
+    for manifest_format in FORMATS:
+        path = os.path.join(output_dir, "manifest" + EXTENSIONS[manifest_format])
+
+        def write():
+            with open(path, "wb") as f:
+                dump_manifest("media.mp4", media_segments, f, manifest_format)
+
+        write_time = best_time(write, repeat)
+        load_time = best_time(lambda: load_manifest(path), repeat)
+        # Reading every segment as well, as the binary format is loaded lazily
+        load_and_sum_time = best_time(lambda: sum(load_manifest(path).media_segments.sizes), repeat)
+        print(f"{manifest_format:14} {write_time * 1000:11.1f} {os.path.getsize(path) / 1e6:10.2f} "
+              f"{load_time * 1000:10.2f} {load_and_sum_time * 1000:16.2f}")
+
+
+SUITE_TOOLS = ("parse", "samples", "manifestgen", "segmentsplit")
+# Synthetic files of each size: 2 s fragments of 60 frames of 10 KB (2.4 Mbit/s), with and without the optional
+# indexes that parsers may use instead of scanning the file
+SUITE_SAMPLES_PER_FRAGMENT = 60
+SUITE_SAMPLE_SIZE = 10_000
+SUITE_VARIANTS = {
+    ".mp4": {},
+    "-indexed.mp4": {"sidx": True, "mfra": True},
+    ".webm": {},
+    "-indexed.webm": {"cues": True},
+    "-unknown-sizes.webm": {"unknown_sizes": True},
+}
+
+
+def run_tool(tool: str, path: str, output_dir: str):
+    if tool == "parse":
+        parser_for_path(path).find_media_segments(open_file_reader(path))
+    elif tool == "samples":
+        parser_for_path(path).find_samples(open_file_reader(path))
+    elif tool == "manifestgen":
+        result = process_file(path)
+        if result.error is not None:
+            raise RuntimeError(f"{path}: {result.error}")
+    elif tool == "segmentsplit":
+        split_segments(path, output_dir)
+
+
+def measure_tool(tool: str, path: str, output_dir: str, repeat: int) -> dict:
+    """
+    Runs in a fresh process like measure_split(), returning the best time, the peak RSS (in KiB) and the
+    instrumentation stats of the last run.
+    """
+    base_dir = os.path.join(output_dir, "output")
+    best = float("inf")
+    for _ in range(repeat):
+        shutil.rmtree(base_dir, ignore_errors=True)
+        os.mkdir(base_dir)
+        with instrumentation.collect() as stats:
+            start = time.perf_counter()
+            run_tool(tool, path, base_dir)
+            best = min(best, time.perf_counter() - start)
+    shutil.rmtree(base_dir)
+    return {"seconds": best, "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "stats": stats.to_dict()}
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(sizes: List[str], tools: List[str], output_dir: str, results_path: str, baseline_path: Optional[str],
+                repeat: int):
+    """
+    Generates synthetic files of each size and measures each tool on them, writing the results to a JSON file that
+    later runs can be compared with. Files are generated one at a time and deleted once measured, so only the
+    largest one (and its segments) needs to fit on disk.
+    """
+    baseline = {}
+    if baseline_path is not None:
+        with open(baseline_path) as f:
+            baseline = {(result["file"], result["tool"]): result for result in json.load(f)["results"]}
+
+    results = []
+    print(f"{'file':32} {'tool':12} {'MB/s':>9} {'time (s)':>9} {'peak RSS (MB)':>14} {'reads':>10} "
+          f"{'file reads':>10} {'change':>7}")
+    for size in sizes:
+        for suffix, options in SUITE_VARIANTS.items():
+            name = f"synthetic-{size}{suffix}"
+            directory = os.path.join(output_dir, name)
+            os.mkdir(directory)
+            path = os.path.join(directory, name)
+            num_fragments = fragments_for_size(parse_size(size), SUITE_SAMPLES_PER_FRAGMENT, SUITE_SAMPLE_SIZE)
+            write_file(path, num_fragments, SUITE_SAMPLES_PER_FRAGMENT, SUITE_SAMPLE_SIZE, **options)
+            file_size = os.path.getsize(path)
+            for tool in tools:
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    measurement = executor.submit(measure_tool, tool, path, directory, repeat).result()
+                io = measurement["stats"]["counters"].get("io", {})
+                result = {
+                    "file": name,
+                    "tool": tool,
+                    "size": file_size,
+                    "fragments": num_fragments,
+                    "seconds": measurement["seconds"],
+                    "mb_per_s": file_size / 1e6 / measurement["seconds"],
+                    "peak_rss_kib": measurement["peak_rss_kib"],
+                    "reads": io.get("reads", 0),
+                    "file_reads": io.get("file reads", 0),
+                    "stats": measurement["stats"],
+                }
+                results.append(result)
+                previous = baseline.get((name, tool))
+                change = f"{result['seconds'] / previous['seconds'] - 1:+7.0%}" if previous is not None else ""
+                print(f"{name:32} {tool:12} {result['mb_per_s']:9.1f} {result['seconds']:9.3f} "
+                      f"{result['peak_rss_kib'] / 1024:14.1f} {result['reads']:10} {result['file_reads']:10} "
+                      f"{change:>7}")
+            shutil.rmtree(directory)
+
+    with open(results_path, "w") as f:
+        json.dump({
+            "created": datetime.now(timezone.utc).isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "repeat": repeat,
+            "results": results,
+        }, f, indent=4)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Benchmarks for the MSE manifest generation tools.")
+    parser.add_argument("--repeat", "-r", type=int, default=5, help="Runs per measurement, the best one is reported.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    readers_parser = subparsers.add_parser("readers", help="Compares the syscalls and time spent parsing files with "
+                                                           "each ByteReader.")
+    readers_parser.add_argument("FILES", nargs="+")
+    regions_parser = subparsers.add_parser("regions", help="Measures the cost of reads in deeply nested regions.")
+    regions_parser.add_argument("--depths", type=int, nargs="+", default=[0, 1, 4, 16, 64])
+    regions_parser.add_argument("--reads", type=int, default=100_000)
+    fragments_parser = subparsers.add_parser("fragments", help="Compares the MP4 segment index fast path against "
+                                                               "fully decoding every moof.")
+    fragments_parser.add_argument("FILES", nargs="+")
+    split_parser = subparsers.add_parser("split", help="Compares the throughput and peak memory use of splitting "
+                                                       "files reading segments in memory, copying them in the kernel, "
+                                                       "cloning them and hashing them while they are copied.")
+    split_parser.add_argument("--output-dir", help="Where the segments are written, preferably in the same "
+                                                   "filesystem as the files. A temporary directory by default.")
+    split_parser.add_argument("FILES", nargs="+")
+    manifests_parser = subparsers.add_parser("manifests", help="Compares the write time, size and load time of "
+                                                               "manifests in each format.")
+    manifests_parser.add_argument("--segments", type=int, default=100_000)
+    suite_parser = subparsers.add_parser("suite", help="Measures the parsers, manifestgen.py and segmentsplit.py on "
+                                                       "synthetic MP4 and WebM files of several sizes, writing the "
+                                                       "results to a JSON file.")
+    suite_parser.add_argument("--sizes", nargs="+", default=["10M", "100M", "1G"],
+                              help="Sizes of the synthetic files, like 500M or 20G.")
+    suite_parser.add_argument("--tools", nargs="+", choices=SUITE_TOOLS, default=list(SUITE_TOOLS))
+    suite_parser.add_argument("--output-dir", help="Where the synthetic files are generated, a temporary directory "
+                                                   "by default. They are sparse where the filesystem supports it, but "
+                                                   "segmentsplit needs as much free space as the largest file.")
+    suite_parser.add_argument("--results", default="benchmark-results.json", help="JSON file to write the results to.")
+    suite_parser.add_argument("--baseline", help="Results of an earlier run, to show the change in time of each "
+                                                 "measurement.")
+    args = parser.parse_args()
+
+    if args.benchmark == "readers":
+        bench_readers(args.FILES, args.repeat)
+    elif args.benchmark == "regions":
+        bench_regions(args.depths, args.reads, args.repeat)
+    elif args.benchmark == "fragments":
+        bench_fragments(args.FILES, args.repeat)
+    elif args.benchmark == "split":
+        with TemporaryDirectory(dir=args.output_dir) as output_dir:
+            bench_split(args.FILES, output_dir, args.repeat)
+    elif args.benchmark == "manifests":
+        with TemporaryDirectory() as output_dir:
+            bench_manifests(args.segments, output_dir, args.repeat)
+    elif args.benchmark == "suite":
+        for size in args.sizes:
+            try:
+                parse_size(size)
+            except ValueError as e:
+                parser.error(str(e))
+        with TemporaryDirectory(dir=args.output_dir) as output_dir:
+            bench_suite(args.sizes, args.tools, output_dir, args.results, args.baseline, args.repeat)
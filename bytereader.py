@@ -1,9 +1,17 @@
+import asyncio
+import mmap
 import os
 from abc import abstractmethod, ABCMeta
-from io import BytesIO
-from typing import Optional, BinaryIO
+from collections import OrderedDict
+from concurrent.futures import Executor
+from functools import partial
+from io import BytesIO, UnsupportedOperation
+from tempfile import NamedTemporaryFile
+from typing import Any, Callable, Optional, BinaryIO
 from unittest import TestCase
 
+import instrumentation
+
 
 class ByteReader(metaclass=ABCMeta):
     def __init__(self, start: int, size: int):
@@ -21,6 +29,11 @@ class ByteReader(metaclass=ABCMeta):
             raise RuntimeError(f"Illegal read, attempted to read [{position}, {position + num_bytes}) in "
                                f"[{self.start}, {self.end})")
         num_bytes = min(num_bytes, self.end - position)
+        if instrumentation.current is not None:
+            data = self._read_at(position, num_bytes)
+            instrumentation.current.count("io", "reads")
+            instrumentation.current.count("io", "bytes read", len(data))
+            return data
         return self._read_at(position, num_bytes)
 
     @abstractmethod
@@ -30,6 +43,10 @@ class ByteReader(metaclass=ABCMeta):
     def close(self):
         pass
 
+    def release(self, position: int):
+        """Hints that nothing before position will be read again, so that readers over streams can drop it."""
+        pass
+
     def read(self, num_bytes: Optional[int] = None) -> bytes:
         if num_bytes is None:
             num_bytes = self.end - self.position
@@ -59,11 +76,153 @@ class FileByteReader(ByteReader):
         self._file.close()
 
     def _read_at(self, pos: int, num_bytes: int) -> bytes:
+        if instrumentation.current is not None:
+            instrumentation.current.count("io", "seeks")
+            instrumentation.current.count("io", "file reads")
         self._file.seek(pos, os.SEEK_SET)
         ret = self._file.read(num_bytes)
         return ret
 
 
+class CachedFileByteReader(FileByteReader):
+    """
+    Reads the file in aligned blocks of block_size bytes and keeps the max_blocks most recently used ones in memory,
+    so that the many tiny header reads done by the parsers are served without a syscall each. Blocks are a page by
+    default: headers are usually spread further apart than that, e.g. one per fragment, and a bigger block read for
+    each of them would cost more than the syscalls it saves.
+    """
+
+    def __init__(self, file: BinaryIO, block_size: int = 4096, max_blocks: int = 256):
+        assert block_size > 0 and max_blocks > 0
+        super().__init__(file)
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self._blocks = OrderedDict()
+        try:
+            self._fd = file.fileno()
+        except (AttributeError, UnsupportedOperation):
+            self._fd = None
+
+    def close(self):
+        self._blocks.clear()
+        super().close()
+
+    def _read_direct(self, pos: int, num_bytes: int) -> bytes:
+        if self._fd is not None:
+            instrumentation.count("io", "file reads")
+            return os.pread(self._fd, num_bytes, pos)
+        return super()._read_at(pos, num_bytes)
+
+    def _block(self, index: int) -> bytes:
+        block = self._blocks.get(index)
+        if block is not None:
+            self._blocks.move_to_end(index)
+            if instrumentation.current is not None:
+                instrumentation.current.count("io", "cache hits")
+            return block
+        instrumentation.count("io", "cache misses")
+        block = self._read_direct(index * self.block_size, self.block_size)
+        self._blocks[index] = block
+        if len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        return block
+
+    def _read_at(self, pos: int, num_bytes: int) -> bytes:
+        if num_bytes > self.block_size:
+            # Big reads would just thrash the cache
+            return self._read_direct(pos, num_bytes)
+        index, block_offset = divmod(pos, self.block_size)
+        block = self._block(index)
+        ret = block[block_offset:block_offset + num_bytes]
+        if len(ret) < num_bytes and len(block) == self.block_size:
+            ret += self._block(index + 1)[:num_bytes - len(ret)]
+        return ret
+
+
+class MmapByteReader(ByteReader):
+    """
+    Maps the whole file in memory. Reads return memoryview slices of the mapping, so no data is copied.
+    """
+
+    def __init__(self, file: BinaryIO):
+        self._file = file
+        size = os.fstat(file.fileno()).st_size
+        # Empty files can't be mapped
+        self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+        self._view = memoryview(self._mmap) if self._mmap is not None else memoryview(b"")
+        super().__init__(start=0, size=size)
+
+    def close(self):
+        self._view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Slices handed out by reads are still alive, the mapping is closed when they are collected.
+                pass
+        self._file.close()
+
+    def _read_at(self, pos: int, num_bytes: int) -> memoryview:
+        return self._view[pos:pos + num_bytes]
+
+
+class StreamByteReader(ByteReader):
+    """
+    Reads forward-only streams like pipes. Only the data from the last release() on is kept in memory, reads before
+    it fail. The size of the stream is unknown until its end has been reached, until then it is UNKNOWN_SIZE.
+    """
+
+    UNKNOWN_SIZE = 2 ** 62
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, file: BinaryIO):
+        self._file = file
+        self._buffer = bytearray()
+        self._buffer_start = 0  # stream offset of the first byte in the buffer
+        self._stream_position = 0  # bytes read from the stream so far
+        super().__init__(start=0, size=self.UNKNOWN_SIZE)
+
+    def close(self):
+        self._buffer.clear()
+        self._file.close()
+
+    def release(self, position: int):
+        if position > self._buffer_start:
+            del self._buffer[:position - self._buffer_start]
+            self._buffer_start = position
+
+    def _fill(self, end: int):
+        while self._stream_position < end and self.size == self.UNKNOWN_SIZE:
+            instrumentation.count("io", "file reads")
+            chunk = self._file.read(min(end - self._stream_position, self.CHUNK_SIZE))
+            if not chunk:
+                self.size = self._stream_position - self.start
+                break
+            # Data that was released before being read is dropped as it goes by
+            skipped = self._buffer_start - self._stream_position
+            self._buffer += chunk[skipped:] if skipped > 0 else chunk
+            self._stream_position += len(chunk)
+
+    def _read_at(self, pos: int, num_bytes: int) -> bytes:
+        if pos < self._buffer_start:
+            raise RuntimeError(f"Illegal read at {pos}, the data before {self._buffer_start} has been released")
+        self._fill(pos + num_bytes)
+        buffer_offset = pos - self._buffer_start
+        return bytes(self._buffer[buffer_offset:buffer_offset + num_bytes])
+
+    @property
+    def ended(self):
+        self._fill(self.position + 1)
+        return self.position >= self.end
+
+
+def open_file_reader(path: str, use_mmap: bool = False) -> ByteReader:
+    if use_mmap:
+        return MmapByteReader(open(path, "rb"))
+    # The cache already does the buffering, an additional buffer in the file object would only add copies.
+    return CachedFileByteReader(open(path, "rb", buffering=0))
+
+
 class RegionByteReader(ByteReader):
     def __init__(self, parent: ByteReader, offset: int, size: Optional[int]):
         assert offset >= 0
@@ -72,11 +231,57 @@ class RegionByteReader(ByteReader):
         assert size >= 0
         assert offset + size <= parent.end
         super().__init__(start=offset, size=size)
-        self._parent = parent
+        # Reads are resolved against the root reader directly instead of recursing through every ancestor. This is
+        # safe because read_at() has already checked the read against this region, which is contained in all of them.
+        if offset < parent.start:
+            # Not contained in the parent, let it report the illegal reads
+            self._read_root = parent.read_at
+        elif isinstance(parent, RegionByteReader):
+            self._read_root = parent._read_root
+        else:
+            self._read_root = parent._read_at
 
     def _read_at(self, position: int, num_bytes: int) -> Optional[bytes]:
-        num_bytes = min(num_bytes, self.end - position)
-        return self._parent.read_at(position, num_bytes)
+        return self._read_root(position, num_bytes)
+
+
+class AsyncByteReader:
+    """
+    Asynchronous counterpart of a ByteReader for asyncio code. The reads of the wrapped reader are done in an executor
+    (the default one of the loop if None), so they never block the event loop, and the async methods of the parsers
+    run their parsing there too. Calls are serialized, as readers are not thread-safe.
+    """
+
+    def __init__(self, reader: ByteReader, executor: Optional[Executor] = None):
+        self.reader = reader
+        self.executor = executor
+        self._lock = asyncio.Lock()
+
+    @property
+    def start(self) -> int:
+        return self.reader.start
+
+    @property
+    def size(self) -> int:
+        return self.reader.size
+
+    @property
+    def end(self) -> int:
+        return self.reader.end
+
+    async def run(self, function: Callable, *args) -> Any:
+        """Runs function, which may use the wrapped reader, in the executor."""
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, partial(function, *args))
+
+    async def read_at(self, position: int, num_bytes: int) -> bytes:
+        return await self.run(self.reader.read_at, position, num_bytes)
+
+    async def release(self, position: int):
+        await self.run(self.reader.release, position)
+
+    async def close(self):
+        await self.run(self.reader.close)
 
 
 class TestReaders(TestCase):
@@ -102,3 +307,74 @@ class TestReaders(TestCase):
         self.assertEqual(bytes([4, 5]), nested_reader.read(2))
         self.assertEqual(6, nested_reader.position)
         self.assertTrue(nested_reader.ended)
+
+    def test_region_bounds(self):
+        file_reader = FileByteReader(BytesIO(bytes(range(10))))
+        region_reader = RegionByteReader(RegionByteReader(file_reader, 2, 6), 4, 2)
+        with self.assertRaises(RuntimeError):
+            region_reader.read_at(7, 1)
+        with self.assertRaises(AssertionError):
+            RegionByteReader(region_reader, 5, 2)
+
+        # Regions starting before their parent can be created, but reading outside the parent is still illegal
+        outside_reader = RegionByteReader(RegionByteReader(file_reader, 4, 4), 2, 4)
+        with self.assertRaises(RuntimeError):
+            outside_reader.read_at(2, 1)
+        self.assertEqual(bytes([4, 5]), outside_reader.read_at(4, 2))
+
+    def test_cached(self):
+        data = bytes(range(256)) * 4
+        cached_reader = CachedFileByteReader(BytesIO(data), block_size=16, max_blocks=4)
+        self.assertEqual(len(data), cached_reader.size)
+        self.assertEqual(data[10:14], cached_reader.read_at(10, 4))
+        self.assertEqual(data[14:20], cached_reader.read_at(14, 6))  # spans two blocks
+        self.assertEqual(data[100:200], cached_reader.read_at(100, 100))  # bigger than a block
+        self.assertEqual(data[-3:], cached_reader.read_at(len(data) - 3, 10))
+        self.assertLessEqual(len(cached_reader._blocks), 4)
+
+        region_reader = RegionByteReader(cached_reader, 30, 40)
+        self.assertEqual(data[30:70], b"".join(iter(lambda: region_reader.read(3), b"")))
+        self.assertLessEqual(len(cached_reader._blocks), 4)
+
+    def test_mmap(self):
+        with NamedTemporaryFile() as f:
+            f.write(bytes(range(10)))
+            f.flush()
+            mmap_reader = MmapByteReader(open(f.name, "rb"))
+            self.assertEqual(10, mmap_reader.size)
+            view = mmap_reader.read_at(2, 3)
+            self.assertIsInstance(view, memoryview)
+            self.assertEqual(bytes([2, 3, 4]), view)
+            nested_reader = RegionByteReader(RegionByteReader(mmap_reader, 4, 6), 6, 2)
+            self.assertEqual(bytes([6, 7]), nested_reader.read(5))
+            mmap_reader.close()
+
+    def test_stream(self):
+        class Pipe(BytesIO):
+            def seek(self, *args):
+                raise UnsupportedOperation("seek")
+
+        stream_reader = StreamByteReader(Pipe(bytes(range(200))))
+        self.assertEqual(bytes([0, 1]), stream_reader.read(2))
+        self.assertEqual(bytes([1, 2]), stream_reader.read_at(1, 2))
+        stream_reader.release(100)
+        with self.assertRaises(RuntimeError):
+            stream_reader.read_at(99, 1)
+        self.assertEqual(bytes([150]), stream_reader.read_at(150, 1))
+        self.assertEqual(bytes([100]), stream_reader.read_at(100, 1))
+        stream_reader.release(190)
+        stream_reader.position = 198
+        self.assertFalse(stream_reader.ended)
+        self.assertEqual(bytes([198, 199]), stream_reader.read(5))
+        self.assertTrue(stream_reader.ended)
+        self.assertEqual(200, stream_reader.end)
+
+    def test_async(self):
+        async def read():
+            async_reader = AsyncByteReader(FileByteReader(BytesIO(bytes(range(10)))))
+            self.assertEqual((0, 10), (async_reader.start, async_reader.end))
+            chunks = await asyncio.gather(*(async_reader.read_at(position, 2) for position in range(0, 10, 2)))
+            await async_reader.close()
+            return b"".join(chunks)
+
+        self.assertEqual(bytes(range(10)), asyncio.run(read()))
@@ -3,11 +3,10 @@ import struct
 from bytereader import ByteReader
 
 
+# Both parsing functions accept any bytes-like object, e.g. memoryview slices from MmapByteReader.
+
 def parse_big_endian_number(the_bytes: bytes):
-    ret = 0
-    for byte in the_bytes:
-        ret = (ret << 8) | byte
-    return ret
+    return int.from_bytes(the_bytes, "big")
 
 
 def parse_signed_big_endian_number(the_bytes: bytes):
@@ -0,0 +1,116 @@
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterator, Optional, TextIO
+from unittest import TestCase
+
+
+class Stats:
+    """
+    Counters and phase times collected while instrumentation is enabled. Counters are grouped in sections, like "io"
+    for reads, bytes, seeks and cache hits, or "boxes" and "elements" for the ones visited by type. Phase times are
+    inclusive: a phase nested in another one is counted in both.
+    """
+
+    def __init__(self):
+        self.counters: Dict[str, Counter] = {}
+        self.phase_times = Counter()
+        self.phase_calls = Counter()
+        # Collection may happen in several threads, e.g. the writers of segmentsplit.py
+        self._lock = threading.Lock()
+
+    def count(self, section: str, name: str, amount: int = 1):
+        with self._lock:
+            self.counters.setdefault(section, Counter())[name] += amount
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phase_times[name] += elapsed
+                self.phase_calls[name] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "counters": {section: dict(counter) for section, counter in self.counters.items()},
+            "phases": {name: {"calls": self.phase_calls[name], "seconds": self.phase_times[name]}
+                       for name in self.phase_times},
+        }
+
+    def merge(self, stats: dict):
+        """Adds the stats of to_dict(), e.g. collected in another process."""
+        with self._lock:
+            for section, counter in stats["counters"].items():
+                self.counters.setdefault(section, Counter()).update(counter)
+            for name, phase in stats["phases"].items():
+                self.phase_times[name] += phase["seconds"]
+                self.phase_calls[name] += phase["calls"]
+
+    def report(self, file: TextIO = sys.stderr):
+        for section in sorted(self.counters):
+            print(f"{section}:", file=file)
+            for name, value in self.counters[section].most_common():
+                print(f"    {name:30} {value:>14}", file=file)
+        if self.phase_times:
+            print(f"phases:{'calls':>31} {'time (s)':>14}", file=file)
+            for name, seconds in self.phase_times.most_common():
+                print(f"    {name:30} {self.phase_calls[name]:>6} {seconds:14.3f}", file=file)
+
+
+# The stats being collected, None while instrumentation is disabled. Hot paths check it themselves before doing
+# anything else, so that instrumentation costs next to nothing when disabled.
+current: Optional[Stats] = None
+
+_NO_PHASE = nullcontext()
+
+
+def count(section: str, name: str, amount: int = 1):
+    if current is not None:
+        current.count(section, name, amount)
+
+
+def phase(name: str):
+    """Context manager timing a phase while instrumentation is enabled."""
+    return current.phase(name) if current is not None else _NO_PHASE
+
+
+@contextmanager
+def collect() -> Iterator[Stats]:
+    """Enables instrumentation in all threads, collecting into new stats until exiting the context."""
+    global current
+    previous = current
+    current = Stats()
+    try:
+        yield current
+    finally:
+        current = previous
+
+
+class TestInstrumentation(TestCase):
+    def test_collect(self):
+        count("io", "reads")
+        with collect() as stats:
+            count("io", "reads")
+            count("io", "bytes read", 100)
+            with phase("scan"):
+                with phase("moov"):
+                    pass
+            with phase("moov"):
+                pass
+        count("io", "reads")
+        self.assertIsNone(current)
+        self.assertEqual({"reads": 1, "bytes read": 100}, stats.to_dict()["counters"]["io"])
+        self.assertEqual(2, stats.phase_calls["moov"])
+        self.assertGreaterEqual(stats.phase_times["scan"], 0)
+
+        total = Stats()
+        total.merge(stats.to_dict())
+        total.merge(stats.to_dict())
+        self.assertEqual(200, total.counters["io"]["bytes read"])
+        self.assertEqual(2, total.phase_calls["scan"])
@@ -0,0 +1,71 @@
+import json
+import os
+import socket
+from typing import Optional, Tuple
+
+# What the command line of manifestgen.py needs to get manifests from a running manifestd.py. Nothing here imports
+# the parsers, so that asking the daemon doesn't pay for importing them.
+
+FORMATS = ("json", "compact-json", "binary")
+EXTENSIONS = {
+    "json": ".json",
+    "compact-json": ".json",
+    "binary": ".msem",
+}
+
+DEFAULT_SOCKET = os.environ.get("MANIFESTD_SOCKET") or \
+    os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), "manifestd.sock")
+
+
+def manifest_path(file_path: str, manifest_format: str = "json") -> str:
+    return file_path + "-manifest" + EXTENSIONS[manifest_format]
+
+
+class DaemonError(Exception):
+    """The daemon couldn't generate a manifest, e.g. because the file doesn't exist or is not valid."""
+    pass
+
+
+class ManifestClient:
+    """
+    Connection to manifestd.py. Each request is a line of JSON, answered by a line of JSON with either the size of the
+    manifest, which follows it, or an error.
+    """
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET, timeout: Optional[float] = None):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.settimeout(timeout)
+            self._socket.connect(socket_path)
+        except OSError:
+            self._socket.close()
+            raise
+        self._file = self._socket.makefile("rb")
+
+    def manifest(self, file_path: str, manifest_format: str = "json") -> Tuple[bytes, bool]:
+        """
+        Returns the manifest of a file with file_path as its URL, like manifestgen.py writes it, and whether the
+        daemon had the file indexed already.
+        """
+        request = {"path": os.path.abspath(file_path), "url": file_path, "format": manifest_format}
+        self._socket.sendall(json.dumps(request).encode() + b"\n")
+        line = self._file.readline()
+        if not line:
+            raise ConnectionResetError("Connection closed by manifestd.py")
+        response = json.loads(line)
+        if "error" in response:
+            raise DaemonError(response["error"])
+        manifest = self._file.read(response["size"])
+        if len(manifest) < response["size"]:
+            raise ConnectionResetError("Connection closed by manifestd.py")
+        return manifest, response["cached"]
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self) -> "ManifestClient":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,326 @@
+#!/usr/bin/python3
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import sys
+from argparse import ArgumentParser
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from stat import S_IMODE, S_ISSOCK
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional, Tuple
+from unittest import TestCase
+
+from manifestclient import DEFAULT_SOCKET, FORMATS, DaemonError, ManifestClient
+from manifestformat import dump_manifest
+from manifestgen import find_segments, format_error
+from mseparser import SegmentTable
+from segmentcache import SegmentCache
+
+MEDIA_EXTENSIONS = (".mp4", ".webm")
+# Longest request accepted, a line of JSON
+MAX_REQUEST_SIZE = 64 * 1024
+# Encoded manifests kept for each file, as their URLs are chosen by the clients
+MAX_MANIFESTS = 4
+
+
+def index_file(file_path: str, cache: Optional[SegmentCache] = None) -> SegmentTable:
+    """Runs in the worker processes."""
+    return find_segments(file_path, cache)[0]
+
+
+class IndexedFile:
+    def __init__(self, size: int, mtime_ns: int, media_segments: SegmentTable):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.media_segments = media_segments
+        # Encoded manifests by format and URL, as the same ones are usually asked for again and again
+        self.manifests: Dict[Tuple[str, str], bytes] = {}
+
+    def manifest(self, url: str, manifest_format: str = "json") -> bytes:
+        key = (manifest_format, url)
+        if key not in self.manifests:
+            if len(self.manifests) >= MAX_MANIFESTS:
+                self.manifests.clear()
+            f = BytesIO()
+            dump_manifest(url, self.media_segments, f, manifest_format)
+            self.manifests[key] = f.getvalue()
+        return self.manifests[key]
+
+
+class Indexer:
+    """
+    Segment tables of the files indexed by the workers of executor, kept in memory for at most max_files files,
+    evicting the least recently used ones. A file is indexed once even if it's requested several times meanwhile,
+    and again when its size or modification time changes.
+    """
+
+    def __init__(self, executor: Executor, max_files: int, cache: Optional[SegmentCache] = None):
+        self.executor = executor
+        self.max_files = max_files
+        self.cache = cache
+        self.files: "OrderedDict[str, IndexedFile]" = OrderedDict()
+        # Indexing in progress by path, size and modification time, so that a file that changed meanwhile is indexed
+        # again instead of being given the segments of its previous version
+        self._indexing: Dict[Tuple[str, int, int], asyncio.Future] = {}
+
+    async def get(self, file_path: str) -> Tuple[IndexedFile, bool]:
+        """Returns the index of a file by absolute path, and whether it was in memory already."""
+        stat = os.stat(file_path)
+        indexed = self.files.get(file_path)
+        if indexed is not None and (indexed.size, indexed.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            self.files.move_to_end(file_path)
+            return indexed, True
+        return await self.index(file_path, stat), False
+
+    async def index(self, file_path: str, stat: os.stat_result) -> IndexedFile:
+        key = (file_path, stat.st_size, stat.st_mtime_ns)
+        future = self._indexing.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._index(file_path, stat))
+            self._indexing[key] = future
+            future.add_done_callback(lambda _: self._indexing.pop(key, None))
+        # A client going away doesn't cancel the indexing the others are waiting for
+        return await asyncio.shield(future)
+
+    async def _index(self, file_path: str, stat: os.stat_result) -> IndexedFile:
+        media_segments = await asyncio.get_running_loop().run_in_executor(self.executor, index_file, file_path,
+                                                                          self.cache)
+        indexed = IndexedFile(stat.st_size, stat.st_mtime_ns, media_segments)
+        self.files[file_path] = indexed
+        self.files.move_to_end(file_path)
+        while len(self.files) > self.max_files:
+            self.files.popitem(last=False)
+        return indexed
+
+    def forget(self, file_path: str):
+        self.files.pop(file_path, None)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Answers each request, a line of JSON with the absolute path of a file and optionally the URL and format of
+        its manifest, with a line of JSON with the size of the manifest followed by it, or with an error.
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    file_path = request["path"]
+                    manifest_format = request.get("format", "json")
+                    if not os.path.isabs(file_path):
+                        raise ValueError("The path must be absolute")
+                    if manifest_format not in FORMATS:
+                        raise ValueError(f"Unknown format {manifest_format}")
+                    indexed, cached = await self.get(file_path)
+                    manifest = indexed.manifest(request.get("url", file_path), manifest_format)
+                except Exception as e:
+                    writer.write(json.dumps({"error": format_error(e)}).encode() + b"\n")
+                else:
+                    writer.write(json.dumps({"size": len(manifest), "cached": cached}).encode() + b"\n")
+                    writer.write(manifest)
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+def scan_directories(directories: List[str]) -> Dict[str, os.stat_result]:
+    files = {}
+    for directory in directories:
+        for dir_path, _, file_names in os.walk(directory):
+            for file_name in file_names:
+                if file_name.endswith(MEDIA_EXTENSIONS):
+                    file_path = os.path.abspath(os.path.join(dir_path, file_name))
+                    try:
+                        files[file_path] = os.stat(file_path)
+                    except FileNotFoundError:
+                        pass
+    return files
+
+
+async def watch(indexer: Indexer, directories: List[str], interval: float, jobs: int):
+    """
+    Indexes the media files in directories and their subdirectories as they appear or change, polling them every
+    interval seconds. At most jobs of them are indexed at a time, leaving room for the files asked for by clients.
+    """
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(jobs)
+    # Size and modification time of each file when it was last indexed, so that evicted or failed files are not
+    # indexed again until they change
+    seen: Dict[str, Tuple[int, int]] = {}
+
+    async def index(file_path: str, stat: os.stat_result):
+        async with slots:
+            try:
+                await indexer.index(file_path, stat)
+            except Exception as e:
+                print(f"{file_path}: {format_error(e)}", file=sys.stderr)
+
+    while True:
+        files = await loop.run_in_executor(None, scan_directories, directories)
+        tasks = []
+        for file_path, stat in files.items():
+            if seen.get(file_path) != (stat.st_size, stat.st_mtime_ns):
+                seen[file_path] = (stat.st_size, stat.st_mtime_ns)
+                tasks.append(index(file_path, stat))
+        for file_path in seen.keys() - files.keys():
+            del seen[file_path]
+            indexer.forget(file_path)
+        await asyncio.gather(*tasks)
+        await asyncio.sleep(interval)
+
+
+def remove_stale_socket(socket_path: str):
+    """Removes the socket left by a daemon that didn't exit cleanly, fails if one is still listening on it."""
+    try:
+        ManifestClient(socket_path).close()
+    except FileNotFoundError:
+        return
+    except ConnectionRefusedError:
+        # Also refused for files that are not sockets, which are left alone
+        if not S_ISSOCK(os.lstat(socket_path).st_mode):
+            raise RuntimeError(f"{socket_path} exists and is not a socket")
+        os.unlink(socket_path)
+        return
+    raise RuntimeError(f"manifestd.py is already running on {socket_path}")
+
+
+async def serve(indexer: Indexer, socket_path: str, directories: List[str], interval: float, jobs: int):
+    remove_stale_socket(socket_path)
+    # Anyone connecting can have any file readable by the daemon parsed, so the socket is created for its owner only
+    umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(indexer.handle_client, socket_path, limit=MAX_REQUEST_SIZE)
+    finally:
+        os.umask(umask)
+    print(f"Listening on {socket_path}", file=sys.stderr)
+    watcher = asyncio.ensure_future(watch(indexer, directories, interval, jobs)) if directories else None
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+
+
+async def main(args):
+    # SIGTERM stops serving like Ctrl+C, removing the socket
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    cache = SegmentCache(args.cache, args.cache_entries) if args.cache is not None else None
+    with ProcessPoolExecutor(args.jobs, mp_context=multiprocessing.get_context("spawn")) as executor:
+        await serve(Indexer(executor, args.max_files, cache), args.socket, args.DIRECTORIES, args.interval, args.jobs)
+
+
+class TestDaemon(TestCase):
+    def test_queries(self):
+        from synthetic import write_file
+
+        with TemporaryDirectory() as directory:
+            file_paths = [os.path.join(directory, name) for name in ("a.mp4", "b.webm", "c.mp4")]
+            for file_path in file_paths:
+                write_file(file_path, 5)
+            socket_path = os.path.join(directory, "manifestd.sock")
+            loop = asyncio.new_event_loop()
+            indexer = Indexer(ThreadPoolExecutor(3), max_files=2)
+            # The watcher indexes the files before they are asked for, evicting one of them
+            serving = loop.create_task(serve(indexer, socket_path, [directory], 60, 3))
+            for _ in range(200):
+                loop.run_until_complete(asyncio.sleep(0.05))
+                if len(indexer.files) == 2 and not indexer._indexing:
+                    break
+            self.assertEqual(2, len(indexer.files))
+            indexed_path = next(iter(indexer.files))
+            evicted_path, = set(file_paths) - indexer.files.keys()
+            self.assertTrue(loop.run_until_complete(indexer.get(indexed_path))[1])
+
+            async def query(file_path: str, manifest_format: str = "json") -> Tuple[bytes, bool]:
+                with ManifestClient(socket_path) as client:
+                    return await loop.run_in_executor(None, client.manifest, file_path, manifest_format)
+
+            for manifest_format in FORMATS:
+                f = BytesIO()
+                dump_manifest(indexed_path, find_segments(indexed_path)[0], f, manifest_format)
+                self.assertEqual((f.getvalue(), True), loop.run_until_complete(query(indexed_path, manifest_format)))
+            self.assertFalse(loop.run_until_complete(query(evicted_path))[1])
+            self.assertTrue(loop.run_until_complete(query(evicted_path))[1])
+            stat = os.stat(evicted_path)
+            os.utime(evicted_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+            self.assertFalse(loop.run_until_complete(query(evicted_path))[1])
+            with self.assertRaises(DaemonError):
+                loop.run_until_complete(query(os.path.join(directory, "missing.mp4")))
+
+            self.assertEqual(0o600, S_IMODE(os.stat(socket_path).st_mode))
+            with self.assertRaises(RuntimeError):
+                remove_stale_socket(socket_path)
+            with self.assertRaises(RuntimeError):
+                remove_stale_socket(file_paths[0])
+            self.assertTrue(os.path.exists(file_paths[0]))
+            serving.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                loop.run_until_complete(serving)
+            self.assertFalse(os.path.exists(socket_path))
+            loop.close()
+            indexer.executor.shutdown()
+
+    def test_changed_while_indexing(self):
+        from synthetic import write_file
+
+        with TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, "a.mp4")
+            write_file(file_path, 3)
+            indexer = Indexer(ThreadPoolExecutor(1), max_files=2)
+
+            async def index() -> Tuple[IndexedFile, IndexedFile]:
+                indexing = asyncio.ensure_future(indexer.index(file_path, os.stat(file_path)))
+                await asyncio.sleep(0)
+                write_file(file_path, 5)
+                indexed, _ = await indexer.get(file_path)
+                return await indexing, indexed
+
+            with indexer.executor:
+                previous, indexed = asyncio.run(index())
+            self.assertNotEqual(previous.size, indexed.size)
+            self.assertEqual((os.path.getsize(file_path), 5), (indexed.size, len(indexed.media_segments)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Keeps the segments of MP4 and WebM MSE Bytestream files in memory and serves "
+                                        "their manifests to manifestgen.py over a Unix socket.")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Path of the Unix socket to listen on.")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(),
+                        help="Number of worker processes indexing files.")
+    parser.add_argument("--max-files", type=int, default=10_000,
+                        help="Maximum number of files kept in memory, the least recently used ones are evicted.")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="Directory where the segments found in each file are kept, like in manifestgen.py, so "
+                             "that evicted files and those indexed before a restart are not parsed again.")
+    parser.add_argument("--cache-entries", type=int, default=100_000,
+                        help="Maximum number of files kept in the cache.")
+    parser.add_argument("--interval", type=float, default=5.0,
+                        help="Seconds between scans of the watched directories.")
+    parser.add_argument("DIRECTORIES", nargs="*",
+                        help="Directories whose .mp4 and .webm files, and those of their subdirectories, are indexed "
+                             "as they appear or change. Other files are indexed when they are asked for.")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    except RuntimeError as e:
+        parser.error(str(e))
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+import json
+import mmap
+import struct
+import sys
+from argparse import ArgumentParser
+from array import array
+from io import BytesIO
+from typing import BinaryIO, NamedTuple, Sequence
+from unittest import TestCase
+
+from manifestclient import FORMATS
+from mseparser import NO_TIME, MediaSegment, SegmentTable, TrackTicks, jsonify
+
+# Binary manifests start with this header, all little-endian: magic, format version, flags, timescale of the segment
+# times, init segment size, number of segments and length of the UTF-8 URL that follows. Then, aligned to 8 bytes so
+# that they can be used in place from a mapped file, come the int64 arrays of the segment offsets, sizes and start
+# times in ticks of the timescale.
+#
+# With BINARY_FLAG_TRACK_TIMES, for multi-track files, they are followed by the number of tracks and their IDs as
+# int64, and by the start times of each track in the segments like the other columns, NO_TIME where there are none.
+BINARY_MAGIC = b"MSEM"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sHHqqqI")
+BINARY_FLAG_TRACK_TIMES = 0x1
+
+# Times in JSON manifests are floats, they are read with this precision
+JSON_TIMESCALE = 1_000_000_000
+
+
+class Manifest(NamedTuple):
+    url: str
+    init_size: int
+    media_segments: SegmentTable
+
+
+def build_manifest(url: str, media_segments: Sequence[MediaSegment]) -> dict:
+    return {
+        "url": url,
+        "init": {"offset": 0, "size": media_segments[0].offset},
+        "media": media_segments,
+    }
+
+
+def _padding(position: int) -> int:
+    return -position % 8
+
+
+def dump_manifest(url: str, media_segments: Sequence[MediaSegment], f: BinaryIO, manifest_format: str = "json"):
+    if manifest_format != "binary":
+        f.write(jsonify(build_manifest(url, media_segments), compact=manifest_format == "compact-json").encode())
+        return
+
+    if not isinstance(media_segments, SegmentTable):
+        media_segments = SegmentTable.from_segments(media_segments)
+    encoded_url = url.encode("utf-8")
+    flags = BINARY_FLAG_TRACK_TIMES if media_segments.track_ticks else 0
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, flags, media_segments.timescale,
+                                media_segments[0].offset, len(media_segments), len(encoded_url)) + encoded_url
+    f.write(header + bytes(_padding(len(header))))
+    columns = [media_segments.offsets, media_segments.sizes, media_segments.ticks]
+    if media_segments.track_ticks:
+        columns.append(array("q", [len(media_segments.track_ticks), *media_segments.track_ticks]))
+        columns.extend(media_segments.track_ticks.values())
+    for column in columns:
+        if sys.byteorder != "little":
+            column = array("q", column)
+            column.byteswap()
+        f.write(column)
+
+
+def load_manifest(path: str) -> Manifest:
+    """Loads a manifest in any of the formats. The segments of binary manifests are used in place from the file."""
+    with open(path, "rb") as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            f.seek(0)
+            return _load_json_manifest(f)
+        # The mapping stays open as long as the memoryviews of the returned columns are alive
+        data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    return load_binary_manifest(data)
+
+
+def load_binary_manifest(data: memoryview) -> Manifest:
+    if len(data) < BINARY_HEADER.size:
+        raise ValueError("Truncated binary manifest header")
+    magic, version, flags, timescale, init_size, count, url_size = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC:
+        raise ValueError("Not a binary manifest")
+    if version != BINARY_VERSION:
+        raise ValueError(f"Unsupported binary manifest version {version}")
+    url = bytes(data[BINARY_HEADER.size:BINARY_HEADER.size + url_size]).decode("utf-8")
+    position = BINARY_HEADER.size + url_size
+    position += _padding(position)
+
+    def read_column(size: int) -> Sequence[int]:
+        nonlocal position
+        if len(data) < position + 8 * size:
+            raise ValueError("Truncated binary manifest")
+        column_data = data[position:position + 8 * size]
+        position += 8 * size
+        if sys.byteorder == "little":
+            return column_data.cast("q")
+        column = array("q", column_data)
+        column.byteswap()
+        return column
+
+    offsets, sizes, ticks = read_column(count), read_column(count), read_column(count)
+    track_ticks = {}
+    if flags & BINARY_FLAG_TRACK_TIMES:
+        track_count, = read_column(1)
+        track_ticks = {track: read_column(count) for track in read_column(track_count)}
+    return Manifest(url, init_size, SegmentTable.from_columns(offsets, sizes, ticks, timescale, track_ticks))
+
+
+def _load_json_manifest(f: BinaryIO) -> Manifest:
+    manifest = json.load(f)
+    media = manifest["media"]
+    tracks = media[0].get("tracks", {}) if media else {}
+    media_segments = SegmentTable.from_columns(
+        array("q", (segment["offset"] for segment in media)),
+        array("q", (segment["size"] for segment in media)),
+        array("q", (round(segment["timestamp"] * JSON_TIMESCALE) for segment in media)),
+        JSON_TIMESCALE,
+        {int(track): array("q", (round(segment["tracks"][track] * JSON_TIMESCALE)
+                                 if segment["tracks"][track] is not None else NO_TIME for segment in media))
+         for track in tracks})
+    return Manifest(manifest["url"], manifest["init"]["size"], media_segments)
+
+
+class TestManifestFormat(TestCase):
+    def test_round_trip(self):
+        media_segments = SegmentTable()
+        media_segments.extend_ticks([100, 150, 300], [50, 150, 20], [0, 2002, 4004], 1000)
+        multi_track_segments = SegmentTable()
+        multi_track_segments.extend_ticks([100, 150, 300], [50, 150, 20], [0, 2002, 4004], 1000, tracks={
+            1: TrackTicks([0, 2002, 4004], 1000),
+            2: TrackTicks([-21, NO_TIME, 3983], 1000),
+        })
+        for segments in (media_segments, multi_track_segments):
+            for manifest_format in FORMATS:
+                f = BytesIO()
+                dump_manifest("media.mp4", segments, f, manifest_format)
+                data = f.getvalue()
+                if manifest_format == "binary":
+                    manifest = load_binary_manifest(memoryview(data))
+                    self.assertEqual(1000, manifest.media_segments.timescale)
+                else:
+                    manifest = _load_json_manifest(BytesIO(data))
+                self.assertEqual(("media.mp4", 100), manifest[:2])
+                self.assertEqual(jsonify(segments), jsonify(manifest.media_segments))
+            with self.assertRaises(ValueError):
+                load_binary_manifest(memoryview(data[:-1]))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Converts manifests generated by manifestgen.py between formats.")
+    parser.add_argument("--format", "-f", choices=FORMATS, required=True, help="Format to convert to.")
+    parser.add_argument("INPUT", help="Manifest in any of the formats.")
+    parser.add_argument("OUTPUT")
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.INPUT)
+    with open(args.OUTPUT, "wb") as f:
+        dump_manifest(manifest.url, manifest.media_segments, f, args.format)
@@ -1,37 +1,326 @@
 #!/usr/bin/python3
+from __future__ import annotations
+
+import os
 import sys
+import time
 from argparse import ArgumentParser
+from contextlib import nullcontext
+from functools import partial
+from typing import TYPE_CHECKING, List, NamedTuple, Optional, Sequence, Tuple
+
+from manifestclient import DEFAULT_SOCKET, FORMATS, DaemonError, ManifestClient, manifest_path
 
-from bytereader import FileByteReader
-from matroska import MatroskaParser
-from mp4 import MP4Parser
-from mseparser import jsonify
+# The parsers are imported by the functions using them, as importing them takes longer than getting a manifest from
+# a running manifestd.py
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
 
-parser = ArgumentParser(description="Generates manifests for MP4 and WebM MSE Bytestream files.")
-parser.add_argument("FILES", nargs="+")
-args = parser.parse_args()
+    from bytereader import ByteReader
+    from mseparser import MSEParser, MediaSegment, SegmentTable
+    from segmentcache import SegmentCache
 
 
-def generate_manifest(file_path):
+def parser_for_path(file_path: str) -> MSEParser:
+    from matroska import MatroskaParser
+    from mp4 import MP4Parser
     if file_path.endswith(".mp4"):
-        parser = MP4Parser()
+        return MP4Parser()
     elif file_path.endswith(".webm"):
-        parser = MatroskaParser()
-    else:
-        print(f"Unsupported extension: {file_path}", file=sys.stderr)
+        return MatroskaParser()
+    raise ValueError("Unsupported extension")
+
+
+def parser_for_stream(reader: ByteReader) -> MSEParser:
+    """Picks the parser from the first bytes, for inputs without a name like stdin."""
+    from matroska import EBML_ID, MatroskaParser
+    from mp4 import MP4Parser
+    if reader.read_at(reader.start, 4) == EBML_ID.to_bytes(4, "big"):
+        return MatroskaParser()
+    return MP4Parser()
+
+
+def write_manifest(file_path: str, media_segments: Sequence[MediaSegment], manifest_format: str = "json"):
+    import instrumentation
+    from manifestformat import dump_manifest
+    if file_path == "-":
+        with instrumentation.phase("manifest encode"):
+            dump_manifest(file_path, media_segments, sys.stdout.buffer, manifest_format)
+        if manifest_format != "binary":
+            sys.stdout.buffer.write(b"\n")
+        sys.stdout.buffer.flush()
         return
+    with open(manifest_path(file_path, manifest_format), "wb") as f, instrumentation.phase("manifest encode"):
+        dump_manifest(file_path, media_segments, f, manifest_format)
+
+
+def write_samples(file_path: str, executor: Optional[Executor] = None, shards: int = 1):
+    """
+    Writes the deep index of the samples of a file, with the keyframes and exact timing of each one. With an
+    executor, shards of the file are indexed by its workers.
+    """
+    import instrumentation
+    from bytereader import open_file_reader
+    from mseparser import jsonify
+    parser = parser_for_path(file_path)
+    if executor is not None:
+        samples = parser.find_samples_sharded(file_path, executor, shards)
+    else:
+        samples = parser.find_samples(open_file_reader(file_path))
+    with open(file_path + "-samples.json", "w") as f, instrumentation.phase("samples encode"):
+        f.write(jsonify(samples, compact=True))
+
+
+def generate_manifest(file_path, cache: Optional[SegmentCache] = None, manifest_format: str = "json",
+                      samples: bool = False, executor: Optional[Executor] = None, shards: int = 1) -> bool:
+    """
+    Writes the manifest of a file, or the one of stdin to stdout for "-", and with samples its sample index. Returns
+    whether its segments were found in the cache. With an executor, shards of the file are parsed by its workers.
+    """
+    if file_path == "-":
+        from bytereader import StreamByteReader
+        from mseparser import SegmentTable
+        reader = StreamByteReader(sys.stdin.buffer)
+        write_manifest(file_path, SegmentTable.from_segments(parser_for_stream(reader).iter_media_segments(reader)),
+                       manifest_format)
+        return False
+    media_segments, cached = find_segments(file_path, cache, executor, shards)
+    write_manifest(file_path, media_segments, manifest_format)
+    if samples:
+        write_samples(file_path, executor, shards)
+    return cached
+
+
+def find_segments(file_path: str, cache: Optional[SegmentCache] = None, executor: Optional[Executor] = None,
+                  shards: int = 1) -> Tuple[SegmentTable, bool]:
+    """
+    Returns the media segments of a file, and whether they were found in the cache. With an executor, shards of the
+    file are parsed by its workers.
+    """
+    from bytereader import open_file_reader
+    # Taken before parsing, so that a file changing meanwhile doesn't get the segments of what was parsed cached
+    identity = cache.identity(file_path) if cache is not None else None
+    media_segments = cache.get(file_path, identity) if cache is not None else None
+    if media_segments is not None:
+        return media_segments, True
+    # A file that was only appended to since it was cached is parsed from its last known segment on
+    previous = cache.get_appended(file_path) if cache is not None else None
+    parser = parser_for_path(file_path)
+    if executor is not None:
+        media_segments = parser.find_media_segments_sharded(file_path, executor, shards, previous)
+    else:
+        media_segments = parser.find_media_segments(open_file_reader(file_path), previous)
+    if cache is not None:
+        cache.put(file_path, media_segments, identity)
+    return media_segments, False
+
+
+def follow_files(file_paths: List[str], interval: float, cache: Optional[SegmentCache] = None,
+                 manifest_format: str = "json"):
+    """
+    Keeps the manifests of files that are still being written up to date, polling them every interval seconds. Only
+    complete segments are listed, and each update only parses what was appended since the previous one.
+    """
+    from bytereader import open_file_reader
+    known = {}  # file path -> (size, mtime, media segments)
+    while True:
+        for file_path in file_paths:
+            try:
+                stat = os.stat(file_path)
+                if file_path in known:
+                    size, mtime_ns, previous = known[file_path]
+                    if (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns):
+                        continue
+                else:
+                    previous = cache.get_appended(file_path) if cache is not None else None
+                identity = cache.identity(file_path) if cache is not None else None
+                media_segments = parser_for_path(file_path).find_media_segments(open_file_reader(file_path),
+                                                                                previous, growing=True)
+                if media_segments and not (previous and len(previous) == len(media_segments) and
+                                           previous[-1].offset == media_segments[-1].offset):
+                    write_manifest(file_path, media_segments, manifest_format)
+                    if cache is not None:
+                        cache.put(file_path, media_segments, identity)
+                known[file_path] = (stat.st_size, stat.st_mtime_ns, media_segments)
+            except Exception as e:
+                known.pop(file_path, None)
+                print(f"{file_path}: {format_error(e)}", file=sys.stderr)
+        time.sleep(interval)
+
+
+def format_error(e: Exception) -> str:
+    return f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+
+
+class FileResult(NamedTuple):
+    file_path: str
+    size: int
+    elapsed: float
+    error: Optional[str]
+    cached: bool = False
+    # Instrumentation stats, as Stats.to_dict()
+    stats: Optional[dict] = None
+
+
+def process_file(file_path: str, cache: Optional[SegmentCache] = None, manifest_format: str = "json",
+                 samples: bool = False, stats: bool = False, executor: Optional[Executor] = None,
+                 shards: int = 1) -> FileResult:
+    """
+    Generates the manifest of a file, reporting failures instead of raising them so that batches continue. With
+    stats, instrumentation stats are collected while doing it.
+    """
+    import instrumentation
+    start = time.perf_counter()
+    error = None
+    size = 0
+    cached = False
+    with instrumentation.collect() if stats else nullcontext() as file_stats:
+        try:
+            size = os.path.getsize(file_path) if file_path != "-" else 0
+            cached = generate_manifest(file_path, cache, manifest_format, samples, executor, shards)
+        except Exception as e:
+            error = format_error(e)
+    return FileResult(file_path, size, time.perf_counter() - start, error, cached,
+                      file_stats.to_dict() if file_stats is not None else None)
+
+
+def process_files(file_paths: List[str], jobs: int, cache: Optional[SegmentCache] = None,
+                  manifest_format: str = "json", samples: bool = False, stats: bool = False,
+                  shards: int = 1) -> List[FileResult]:
+    """
+    Processes the files in jobs processes. With more than one shard, the files are processed one after the other
+    instead, each split into shards parsed by the processes, which suits a few very large files better.
+    """
+    process = partial(process_file, cache=cache, manifest_format=manifest_format, samples=samples, stats=stats)
+    if (jobs == 1 and shards == 1) or "-" in file_paths:
+        # stdin can only be read from this process
+        return [report_file(result) for result in map(process, file_paths)]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        if shards > 1:
+            return [report_file(process(file_path, executor=executor, shards=shards)) for file_path in file_paths]
+        return [report_file(result) for result in executor.map(process, file_paths)]
+
+
+def query_daemon(file_paths: List[str], socket_path: str = DEFAULT_SOCKET,
+                 manifest_format: str = "json") -> List[FileResult]:
+    """
+    Writes the manifests of files generated by a running manifestd.py. Returns the results of the files it handled,
+    which are none when it isn't running and stop at the first file if the connection is lost, for the rest to be
+    processed locally.
+    """
+    results = []
+    try:
+        client = ManifestClient(socket_path)
+    except OSError:
+        return results
+    with client:
+        for file_path in file_paths:
+            start = time.perf_counter()
+            try:
+                manifest, cached = client.manifest(file_path, manifest_format)
+            except DaemonError as e:
+                results.append(report_file(FileResult(file_path, 0, time.perf_counter() - start, str(e))))
+                continue
+            except (OSError, ValueError):
+                break
+            try:
+                with open(manifest_path(file_path, manifest_format), "wb") as f:
+                    f.write(manifest)
+                size = os.path.getsize(file_path)
+                error = None
+            except OSError as e:
+                size = 0
+                error = format_error(e)
+            results.append(report_file(FileResult(file_path, size, time.perf_counter() - start, error, cached)))
+    return results
+
+
+def report_file(result: FileResult) -> FileResult:
+    if result.error is not None:
+        print(f"{result.file_path}: {result.error}", file=sys.stderr)
+    return result
+
 
-    media_segments = parser.find_media_segments(FileByteReader(open(file_path, "rb")))
-    manifest = {
-        "url": file_path,
-        "init": {"offset": 0, "size": media_segments[0].offset},
-        "media": media_segments,
-    }
+def print_summary(results: List[FileResult], elapsed: float):
+    print(f"{'file':50} {'size (MB)':>10} {'time (s)':>9}", file=sys.stderr)
+    for result in results:
+        status = "  FAILED" if result.error is not None else "  cached" if result.cached else ""
+        print(f"{result.file_path[-50:]:50} {result.size / 1e6:10.1f} {result.elapsed:9.3f}{status}", file=sys.stderr)
+    failed = sum(1 for result in results if result.error is not None)
+    cached = sum(1 for result in results if result.cached)
+    total_size = sum(result.size for result in results if result.error is None)
+    print(f"{len(results)} files ({failed} failed, {cached} cached) in {elapsed:.2f} s: "
+          f"{len(results) / elapsed:.1f} files/s, {total_size / 1e9 / elapsed:.2f} GB/s scanned", file=sys.stderr)
 
-    manifest_path = file_path + "-manifest.json"
-    with open(manifest_path, "w") as f:
-        f.write(jsonify(manifest))
 
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Generates manifests for MP4 and WebM MSE Bytestream files.")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of files processed in parallel, 0 to use one process per CPU.")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="Directory where the segments found in each file are kept, so that files that didn't "
+                             "change since a previous run are not parsed again.")
+    parser.add_argument("--cache-entries", type=int, default=100_000,
+                        help="Maximum number of files kept in the cache, the least recently used ones are evicted.")
+    parser.add_argument("--format", choices=FORMATS, default="json",
+                        help="Manifest format: indented JSON, JSON without whitespace, or binary (see "
+                             "manifestformat.py), written to <file>-manifest.msem.")
+    parser.add_argument("--samples", action="store_true",
+                        help="Also write <file>-samples.json, indexing every sample (or block) with its offset, "
+                             "size, exact timing and whether it's a keyframe.")
+    parser.add_argument("--stats", action="store_true",
+                        help="Print the reads, boxes and elements visited and time spent in each phase, for all the "
+                             "files together.")
+    parser.add_argument("--follow", "-f", action="store_true",
+                        help="Keep watching the files while they are being written, updating their manifests as "
+                             "segments are completed.")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="Seconds between checks for new data with --follow.")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Split each file into this many shards of segments parsed by the --jobs processes, "
+                             "processing the files one after the other, for a few very large files.")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET,
+                        help="Socket of the manifestd.py daemon, used to get the manifests when it's running.")
+    parser.add_argument("--no-daemon", action="store_true",
+                        help="Parse the files in this process even if manifestd.py is running.")
+    parser.add_argument("FILES", nargs="+", help="Files to process, - reads a stream from stdin and writes its "
+                                                  "manifest to stdout.")
+    args = parser.parse_args()
+    if args.follow and "-" in args.FILES:
+        parser.error("--follow can't be used with stdin")
+    if args.samples and ("-" in args.FILES or args.follow):
+        parser.error("--samples can't be used with stdin or --follow")
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
 
-for file_path in args.FILES:
-    generate_manifest(file_path)
+    start = time.perf_counter()
+    results = []
+    if not (args.no_daemon or args.samples or args.stats or args.follow or args.shards > 1 or "-" in args.FILES):
+        results = query_daemon(args.FILES, args.socket, args.format)
+    remaining = args.FILES[len(results):]
+    cache = None
+    if args.cache is not None and remaining:
+        from segmentcache import SegmentCache
+        cache = SegmentCache(args.cache, args.cache_entries)
+    if args.follow:
+        try:
+            follow_files(args.FILES, args.interval, cache, args.format)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    if remaining:
+        results += process_files(remaining, args.jobs or os.cpu_count(), cache, args.format, args.samples, args.stats,
+                                 args.shards)
+    if cache is not None:
+        cache.evict()
+    print_summary(results, time.perf_counter() - start)
+    if args.stats:
+        import instrumentation
+        total_stats = instrumentation.Stats()
+        for result in results:
+            if result.stats is not None:
+                total_stats.merge(result.stats)
+        total_stats.report()
+    if any(result.error is not None for result in results):
+        sys.exit(1)
@@ -0,0 +1,351 @@
+#!/usr/bin/python3
+import asyncio
+import os
+import re
+import sys
+from argparse import ArgumentParser
+from contextlib import nullcontext
+from tempfile import TemporaryDirectory
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Tuple
+from unittest import TestCase
+from urllib.parse import unquote, urlsplit
+
+from manifestformat import build_manifest
+from manifestgen import find_segments
+from mseparser import SegmentTable, jsonify
+from segmentcache import SegmentCache
+
+CONTENT_TYPES = {
+    ".mp4": "video/mp4",
+    ".webm": "video/webm",
+}
+# Seconds an idle keep-alive connection is kept open
+KEEP_ALIVE_TIMEOUT = 60
+MAX_HEADERS = 100
+STATUS_REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+}
+
+
+class ServedFile(NamedTuple):
+    path: str
+    size: int
+    content_type: str
+    media_segments: SegmentTable
+    manifest: bytes
+
+
+class Resource(NamedTuple):
+    """A byte range of a served file, or a body generated in memory."""
+    content_type: str
+    size: int
+    file_path: Optional[str] = None
+    offset: int = 0
+    body: Optional[bytes] = None
+
+
+def parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Returns the [start, end) range requested by a Range header, or None when it can't be satisfied. Only single
+    ranges are supported, for others the whole resource is served as allowed by RFC 9110.
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if match is None:
+        return 0, size
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return 0, size
+        # The last bytes, of which asking for none can't be satisfied
+        if int(last) == 0:
+            return None
+        return max(0, size - int(last)), size
+    start = int(first)
+    end = min(int(last) + 1, size) if last else size
+    if start >= size or start >= end:
+        return None
+    return start, end
+
+
+class ManifestServer:
+    """
+    Serves the manifest, the init segment and each media segment of files parsed once at startup, directly from the
+    original files. For a file named video.webm:
+
+    - /video.webm/manifest.json: its manifest, with the same format as manifestgen.py
+    - /video.webm/init and /video.webm/media<N>: its segments, numbered from 1 like segmentsplit.py does
+    - /video.webm: the whole file, for the ranges listed in the manifest
+
+    Byte ranges are accepted for all of them, and connections are kept alive.
+    """
+
+    def __init__(self, files: Dict[str, ServedFile]):
+        self.files = files
+        self._index = jsonify({name: f"/{name}/manifest.json" for name in files}).encode()
+
+    def resolve(self, path: str) -> Optional[Resource]:
+        if path == "/":
+            return Resource("application/json", len(self._index), body=self._index)
+        name, _, part = path[1:].partition("/")
+        served_file = self.files.get(name)
+        if served_file is None:
+            return None
+        if part == "":
+            return Resource(served_file.content_type, served_file.size, served_file.path)
+        if part == "manifest.json":
+            return Resource("application/json", len(served_file.manifest), body=served_file.manifest)
+        if part == "init":
+            return Resource(served_file.content_type, served_file.media_segments[0].offset, served_file.path)
+        match = re.fullmatch(r"media(\d+)", part)
+        if match is not None and 1 <= int(match.group(1)) <= len(served_file.media_segments):
+            segment = served_file.media_segments[int(match.group(1)) - 1]
+            return Resource(served_file.content_type, segment.size, served_file.path, segment.offset)
+        return None
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                headers = {}
+                for _ in range(MAX_HEADERS):
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                else:
+                    await self._send_headers(writer, 400, {"Content-Length": "0"}, keep_alive=False)
+                    break
+
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self._send_headers(writer, 400, {"Content-Length": "0"}, keep_alive=False)
+                    break
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+                if "content-length" in headers:
+                    # Nothing served here takes a body, it's just skipped
+                    await reader.readexactly(int(headers["content-length"]))
+                keep_alive = await self._respond(writer, method, unquote(urlsplit(target).path), headers,
+                                                 keep_alive)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _respond(self, writer: asyncio.StreamWriter, method: str, path: str, headers: Dict[str, str],
+                       keep_alive: bool) -> bool:
+        """Returns whether the connection can be kept alive, which it can't after a response cut short."""
+        if method not in ("GET", "HEAD"):
+            await self._send_headers(writer, 405, {"Allow": "GET, HEAD", "Content-Length": "0"}, keep_alive)
+            return keep_alive
+        resource = self.resolve(path)
+        file = None
+        if resource is not None and resource.file_path is not None:
+            # Opened for each response before the headers are sent, so a file removed or truncated since it was parsed
+            # is not found instead of breaking the response
+            try:
+                file = open(resource.file_path, "rb")
+                if os.fstat(file.fileno()).st_size < resource.offset + resource.size:
+                    file.close()
+                    file = None
+            except OSError:
+                pass
+            if file is None:
+                resource = None
+        if resource is None:
+            await self._send_headers(writer, 404, {"Content-Length": "0"}, keep_alive)
+            return keep_alive
+        with file if file is not None else nullcontext():
+            return await self._send_resource(writer, method, headers, keep_alive, resource, file)
+
+    async def _send_resource(self, writer: asyncio.StreamWriter, method: str, headers: Dict[str, str],
+                             keep_alive: bool, resource: Resource, file: Optional[BinaryIO]) -> bool:
+        response_headers = {"Content-Type": resource.content_type, "Accept-Ranges": "bytes"}
+        status = 200
+        start, end = 0, resource.size
+        if "range" in headers:
+            requested_range = parse_range(headers["range"], resource.size)
+            if requested_range is None:
+                response_headers.update({"Content-Range": f"bytes */{resource.size}", "Content-Length": "0"})
+                await self._send_headers(writer, 416, response_headers, keep_alive)
+                return keep_alive
+            start, end = requested_range
+            if (start, end) != (0, resource.size):
+                status = 206
+                response_headers["Content-Range"] = f"bytes {start}-{end - 1}/{resource.size}"
+        response_headers["Content-Length"] = str(end - start)
+        await self._send_headers(writer, status, response_headers, keep_alive)
+        if method == "HEAD" or end == start:
+            return keep_alive
+
+        if file is None:
+            writer.write(resource.body[start:end])
+            await writer.drain()
+            return keep_alive
+        # sendfile falls back to seeking and reading the file where it can't be done by the kernel
+        try:
+            sent = await asyncio.get_running_loop().sendfile(writer.transport, file, resource.offset + start,
+                                                              end - start)
+        except ConnectionError:
+            raise
+        except OSError:
+            return False
+        # The file may still be truncated while it's sent, then only closing the connection tells the client
+        return keep_alive and sent == end - start
+
+    @staticmethod
+    async def _send_headers(writer: asyncio.StreamWriter, status: int, headers: Dict[str, str], keep_alive: bool):
+        lines = [f"HTTP/1.1 {status} {STATUS_REASONS[status]}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        lines.append("Access-Control-Allow-Origin: *")
+        lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+
+def load_files(file_paths: List[str], cache: Optional[SegmentCache] = None) -> Dict[str, ServedFile]:
+    files = {}
+    for file_path in file_paths:
+        name = os.path.basename(file_path)
+        if name in files:
+            raise ValueError(f"More than one file named {name}")
+        media_segments, _ = find_segments(file_path, cache)
+        files[name] = ServedFile(file_path, os.path.getsize(file_path), CONTENT_TYPES[os.path.splitext(name)[1]],
+                                 media_segments, jsonify(build_manifest(f"/{name}", media_segments)).encode())
+    return files
+
+
+async def serve(files: Dict[str, ServedFile], host: str, port: int):
+    server = await asyncio.start_server(ManifestServer(files).handle_client, host, port)
+    for sock in server.sockets:
+        print(f"Serving {len(files)} files on http://{sock.getsockname()[0]}:{sock.getsockname()[1]}/",
+              file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+class TestServer(TestCase):
+    def test_parse_range(self):
+        self.assertEqual((10, 20), parse_range("bytes=10-19", 100))
+        self.assertEqual((90, 100), parse_range("bytes=90-", 100))
+        self.assertEqual((90, 100), parse_range("bytes=-10", 100))
+        self.assertEqual((0, 100), parse_range("bytes=-1000", 100))
+        self.assertEqual((0, 100), parse_range("bytes=0-10,20-30", 100))
+        self.assertIsNone(parse_range("bytes=100-", 100))
+        self.assertIsNone(parse_range("bytes=20-10", 100))
+        self.assertIsNone(parse_range("bytes=-0", 100))
+
+    def test_requests(self):
+        from synthetic import write_file
+
+        with TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, "video.mp4")
+            write_file(file_path, 3)
+            with open(file_path, "rb") as f:
+                data = f.read()
+            files = load_files([file_path])
+            init_size = files["video.mp4"].media_segments[0].offset
+            media2 = files["video.mp4"].media_segments[1]
+
+            async def requests() -> List[Tuple[int, Dict[str, str], bytes]]:
+                server = await asyncio.start_server(ManifestServer(files).handle_client, "127.0.0.1", 0)
+                async with server:
+                    reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+                    responses = []
+                    # All on the same connection, which is kept alive until asked to close
+                    for request in ("GET /video.mp4/manifest.json HTTP/1.1\r\n",
+                                    "GET /video.mp4/media2 HTTP/1.1\r\nRange: bytes=10-19\r\n",
+                                    "HEAD /video.mp4 HTTP/1.1\r\n",
+                                    "GET /video.mp4/media4 HTTP/1.1\r\n",
+                                    "GET /video.mp4/init HTTP/1.1\r\nRange: bytes=-0\r\n",
+                                    "GET /video.mp4/init HTTP/1.1\r\nConnection: close\r\n"):
+                        writer.write(f"{request}\r\n".encode())
+                        status_line = await reader.readline()
+                        headers = {}
+                        while True:
+                            line = (await reader.readline()).decode()
+                            if line == "\r\n":
+                                break
+                            name, _, value = line.partition(":")
+                            headers[name] = value.strip()
+                        body = await reader.readexactly(int(headers["Content-Length"])) \
+                            if not request.startswith("HEAD") else b""
+                        responses.append((int(status_line.split()[1]), headers, body))
+                    self.assertEqual(b"", await reader.read())
+                    writer.close()
+                return responses
+
+            responses = asyncio.run(requests())
+            self.assertEqual(["keep-alive"] * 5 + ["close"], [headers["Connection"] for _, headers, _ in responses])
+            manifest, media2_range, head, missing, unsatisfiable, init = responses
+            self.assertEqual((200, files["video.mp4"].manifest), (manifest[0], manifest[2]))
+            self.assertEqual((206, f"bytes 10-19/{media2.size}", data[media2.offset + 10:media2.offset + 20]),
+                             (media2_range[0], media2_range[1]["Content-Range"], media2_range[2]))
+            self.assertEqual((200, str(len(data)), b""), (head[0], head[1]["Content-Length"], head[2]))
+            self.assertEqual(404, missing[0])
+            self.assertEqual((416, f"bytes */{init_size}"), (unsatisfiable[0], unsatisfiable[1]["Content-Range"]))
+            self.assertEqual((200, data[:init_size]), (init[0], init[2]))
+
+    def test_changed_files(self):
+        from synthetic import write_file
+
+        with TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, "video.mp4")
+            write_file(file_path, 3)
+            files = load_files([file_path])
+            media3 = files["video.mp4"].media_segments[2]
+
+            async def request(path: str) -> bytes:
+                server = await asyncio.start_server(ManifestServer(files).handle_client, "127.0.0.1", 0)
+                async with server:
+                    reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+                    writer.write(f"GET {path} HTTP/1.1\r\nConnection: close\r\n\r\n".encode())
+                    response = await reader.read()
+                    writer.close()
+                return response
+
+            # Files changed since they were parsed are not found rather than served short of their Content-Length
+            with open(file_path, "r+b") as f:
+                f.truncate(media3.offset + 10)
+            self.assertTrue(asyncio.run(request("/video.mp4/media3")).startswith(b"HTTP/1.1 404 "))
+            self.assertTrue(asyncio.run(request("/video.mp4/media1")).startswith(b"HTTP/1.1 200 "))
+            os.remove(file_path)
+            self.assertTrue(asyncio.run(request("/video.mp4/init")).startswith(b"HTTP/1.1 404 "))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Serves the segments and manifests of MP4 and WebM MSE Bytestream files over "
+                                        "HTTP, straight from the original files.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", "-p", type=int, default=8080)
+    parser.add_argument("--cache", metavar="DIR",
+                        help="Directory where the segments found in each file are kept, like in manifestgen.py.")
+    parser.add_argument("FILES", nargs="+")
+    args = parser.parse_args()
+
+    cache = SegmentCache(args.cache) if args.cache is not None else None
+    try:
+        files = load_files(args.FILES, cache)
+    except Exception as e:
+        parser.error(str(e))
+    try:
+        asyncio.run(serve(files, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -1,14 +1,83 @@
+import asyncio
+from array import array
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from fractions import Fraction
-from typing import List, Optional
+from io import BytesIO
+from math import gcd
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 from unittest import TestCase
 
-from bytereader import ByteReader, FileByteReader, RegionByteReader
+import instrumentation
+from bytereader import AsyncByteReader, ByteReader, FileByteReader, RegionByteReader, StreamByteReader, \
+    open_file_reader
 from byteutils import parse_big_endian_number, read_uint
-from mseparser import WrongFile, MSEParser, MediaSegment, jsonify
+from mseparser import NO_TIME, WrongFile, MSEParser, MediaSegment, SampleTable, SegmentTable, Sharding, TrackTicks, \
+    jsonify, open_walk_reader
+
+EBML_ID = 0x1A45DFA3
+SEGMENT_ID = 0x18538067
+SEEK_HEAD_ID = 0x114D9B74
+SEEK_ID = 0x4DBB
+SEEK_ID_ID = 0x53AB
+SEEK_POSITION_ID = 0x53AC
+INFO_ID = 0x1549A966
+TIMESTAMP_SCALE_ID = 0x2AD7B1
+CLUSTER_ID = 0x1F43B675
+CLUSTER_TIMESTAMP_ID = 0xE7
+CUES_ID = 0x1C53BB6B
+CUE_POINT_ID = 0xBB
+CUE_TIME_ID = 0xB3
+CUE_TRACK_POSITIONS_ID = 0xB7
+CUE_CLUSTER_POSITION_ID = 0xF1
+TRACKS_ID = 0x1654AE6B
+CHAPTERS_ID = 0x1043A770
+ATTACHMENTS_ID = 0x1941A469
+TAGS_ID = 0x1254C367
+TRACK_ENTRY_ID = 0xAE
+TRACK_NUMBER_ID = 0xD7
+TRACK_TYPE_ID = 0x83
+SIMPLE_BLOCK_ID = 0xA3
+BLOCK_GROUP_ID = 0xA0
+BLOCK_ID = 0xA1
+BLOCK_DURATION_ID = 0x9B
+REFERENCE_BLOCK_ID = 0xFB
+
+# Names of the elements counted by instrumentation, others are counted by ID
+ELEMENT_NAMES = {
+    EBML_ID: "EBML", SEGMENT_ID: "Segment", SEEK_HEAD_ID: "SeekHead", SEEK_ID: "Seek", SEEK_ID_ID: "SeekID",
+    SEEK_POSITION_ID: "SeekPosition", INFO_ID: "Info", TIMESTAMP_SCALE_ID: "TimestampScale", CLUSTER_ID: "Cluster",
+    CLUSTER_TIMESTAMP_ID: "Timestamp", CUES_ID: "Cues", CUE_POINT_ID: "CuePoint", CUE_TIME_ID: "CueTime",
+    CUE_TRACK_POSITIONS_ID: "CueTrackPositions", CUE_CLUSTER_POSITION_ID: "CueClusterPosition", TRACKS_ID: "Tracks",
+    CHAPTERS_ID: "Chapters", ATTACHMENTS_ID: "Attachments", TAGS_ID: "Tags", TRACK_ENTRY_ID: "TrackEntry",
+    TRACK_NUMBER_ID: "TrackNumber", TRACK_TYPE_ID: "TrackType", SIMPLE_BLOCK_ID: "SimpleBlock",
+    BLOCK_GROUP_ID: "BlockGroup", BLOCK_ID: "Block", BLOCK_DURATION_ID: "BlockDuration",
+    REFERENCE_BLOCK_ID: "ReferenceBlock",
+}
+
+# Elements that can follow a Cluster but not be inside one, which is how the end of an unknown-size Cluster is found
+CLUSTER_SIBLING_IDS = {EBML_ID, SEGMENT_ID, SEEK_HEAD_ID, INFO_ID, TRACKS_ID, CHAPTERS_ID, CLUSTER_ID, CUES_ID,
+                       ATTACHMENTS_ID, TAGS_ID}
+
+# Enough for the longest element header (4 bytes of ID and 8 of size) followed by a Block header (up to 8 bytes of
+# track number, 2 of timestamp and 1 of flags)
+BLOCK_HEADERS_SIZE = 32
+# Read at once by find_cluster_end(), which needs the header of every child of an unknown-size Cluster. Reading them
+# one by one would take a read for each VINT, a syscall each with the direct reader of a sharded walk.
+CLUSTER_SCAN_SIZE = 64 * 1024
+SIMPLE_BLOCK_KEYFRAME_FLAG = 0x80
+# TrackType of the tracks whose start time is found in each Cluster, others like subtitles often have no block in it
+MEDIA_TRACK_TYPES = {1, 2}  # video, audio
+# Blocks walked at the start of a Cluster to find the first one of each track. Muxers interleave the tracks by time,
+# so a track without a block among them is taken as having none in the Cluster instead of reading every block header.
+CLUSTER_START_BLOCKS = 64
 
 
 def read_vint(reader: ByteReader, raw: bool = False):
-    header_byte = ord(reader.read(1))
+    header = reader.read(1)
+    if not header:
+        raise WrongFile("Unexpected end of data in VINT")
+    header_byte = header[0]
     if header_byte == 0:
         raise WrongFile("VINT with zero header byte")
     tail_length = 0
@@ -18,34 +87,130 @@ def read_vint(reader: ByteReader, raw: bool = False):
         mask >>= 1
 
     header_number_part = header_byte & ~mask if not raw else header_byte
-    return parse_big_endian_number(bytes([header_number_part]) + reader.read(tail_length))
+    tail = reader.read(tail_length)
+    if len(tail) < tail_length:
+        raise WrongFile("Unexpected end of data in VINT")
+    return (header_number_part << (8 * tail_length)) | parse_big_endian_number(tail)
 
 
 def read_element_header(reader: ByteReader):
+    """Returns the element ID and its content size, which is None when unknown (all the VINT bits set)."""
     element_id = read_vint(reader, raw=True)
+    size_offset = reader.position
     size = read_vint(reader)
+    if size == (1 << (7 * (reader.position - size_offset))) - 1:
+        size = None
     return element_id, size
 
 
+def parse_vint(data: bytes, position: int, raw: bool = False) -> Tuple[int, int]:
+    """Like read_vint() for VINTs in memory, returns the value and the position after it."""
+    if data[position] == 0:
+        raise WrongFile("VINT with zero header byte")
+    length = 9 - data[position].bit_length()
+    if position + length > len(data):
+        raise WrongFile("Unexpected end of data in VINT")
+    value = int.from_bytes(data[position:position + length], "big")
+    if not raw:
+        value &= (1 << (7 * length)) - 1
+    return value, position + length
+
+
+def parse_element_header(data: bytes, position: int = 0) -> Tuple[int, Optional[int], int]:
+    """Like read_element_header() for headers in memory, also returning the position of the content."""
+    element_id, position = parse_vint(data, position, raw=True)
+    size_position = position
+    size, position = parse_vint(data, position)
+    if size == (1 << (7 * (position - size_position))) - 1:
+        size = None
+    return element_id, size, position
+
+
+def iter_parsed_elements(data: bytes, position: int = 0,
+                         end: Optional[int] = None) -> Iterator[Tuple[int, int, int]]:
+    """Like iter_elements() for elements in memory, yields the ID, content position and content size of each."""
+    if end is None:
+        end = len(data)
+    while position < end:
+        element_id, size, content_position = parse_element_header(data, position)
+        if size is None or content_position + size > end:
+            raise WrongFile(f"Invalid element at {position} in memory")
+        yield element_id, content_position, size
+        position = content_position + size
+
+
 class Element:
     # offset and full_size here include the element header too
-    def __init__(self, element_id, header_offset, header_size, content_size, parent_reader):
+    def __init__(self, element_id, header_offset, header_size, content_size, parent_reader, unknown_size=False):
         self.element_id = element_id
         self.offset = header_offset
         self.full_size = header_size + content_size
         self.reader = RegionByteReader(parent_reader, header_offset + header_size, content_size)
+        self.unknown_size = unknown_size
+
+
+def find_cluster_end(reader: ByteReader) -> int:
+    """
+    Finds where an unknown-size Cluster whose content starts at the reader position ends, walking its children. The
+    Cluster is read in chunks of CLUSTER_SCAN_SIZE bytes, the headers of its children are parsed from them.
+    """
+    start = reader.position
+    position = start
+    data = b""
+    data_position = start
+    while True:
+        offset = position - data_position
+        if offset + BLOCK_HEADERS_SIZE > len(data):
+            # The next header may not be in data, which is read again from it
+            data = reader.read_at(position, CLUSTER_SCAN_SIZE)
+            data_position = position
+            offset = 0
+            if not data:
+                return position
+        element_id, size, content_offset = parse_element_header(data, offset)
+        if element_id in CLUSTER_SIBLING_IDS:
+            return position
+        content_position = data_position + content_offset
+        if size is None or content_position + size > reader.end:
+            raise WrongFile(f"Invalid element at {position} in unknown-size Cluster at {start}")
+        position = content_position + size
 
 
 def read_element(reader: ByteReader):
     header_offset = reader.position
     element_id, content_size = read_element_header(reader)
     header_size = reader.position - header_offset
-    return Element(element_id, header_offset, header_size, content_size, reader)
+    unknown_size = content_size is None
+    if unknown_size:
+        # Only allowed for Segments, which are handled separately, and Clusters
+        if element_id != CLUSTER_ID:
+            raise WrongFile(f"Unsupported unknown-size element at {header_offset}")
+        content_size = find_cluster_end(reader) - reader.position
+    if reader.position + content_size > reader.end:
+        raise WrongFile(f"Element at {header_offset} extends past the end of its parent")
+    if instrumentation.current is not None:
+        instrumentation.current.count("elements", ELEMENT_NAMES.get(element_id, f"0x{element_id:X}"))
+    return Element(element_id, header_offset, header_size, content_size, reader, unknown_size)
 
 
-def iter_elements(reader: ByteReader):
+def iter_elements(reader: ByteReader, complete_only: bool = False):
+    """
+    With complete_only, the walk stops before the first element cut short by the end of the reader, e.g. because it's
+    still being written.
+    """
     while not reader.ended:
-        element = read_element(reader)
+        header_offset = reader.position
+        try:
+            element = read_element(reader)
+        except WrongFile:
+            if complete_only:
+                reader.position = header_offset
+                return
+            raise
+        if complete_only and element.unknown_size and element.offset + element.full_size == reader.end:
+            # More children may still be written
+            reader.position = header_offset
+            return
         yield element
         reader.skip(element.reader.size)
 
@@ -56,40 +221,671 @@ def find_element(reader: ByteReader, element_id: int) -> Optional[Element]:
             return element
 
 
+def find_elements(reader: ByteReader, element_id: int) -> List[Element]:
+    return [element for element in iter_elements(reader) if element.element_id == element_id]
+
+
 class Cluster:
     def __init__(self, element: Element, timestamp_scale_value: int):
-        assert element.element_id == 0x1F43B675
+        assert element.element_id == CLUSTER_ID
         self.element = element
-        self.timestamp = Fraction(read_uint(find_element(element.reader, 0xE7).reader),
-                                  Fraction(1_000_000_000, timestamp_scale_value))
+        self.timestamp_value = read_uint(find_element(element.reader, CLUSTER_TIMESTAMP_ID).reader)
+        self.timestamp_scale_value = timestamp_scale_value
+
+    @property
+    def timestamp(self) -> Fraction:
+        return Fraction(self.timestamp_value, Fraction(1_000_000_000, self.timestamp_scale_value))
+
+
+def cluster_timescale(timestamp_scale_value: int) -> Tuple[int, int]:
+    """Returns the smallest integer timescale of cluster timestamps, and the factor that converts them to it."""
+    divisor = gcd(1_000_000_000, timestamp_scale_value)
+    return 1_000_000_000 // divisor, timestamp_scale_value // divisor
+
+
+Block = namedtuple("Block", ["offset", "size", "track_number", "timestamp", "duration", "keyframe"])
+
+
+def parse_block_header(data: bytes, position: int) -> Tuple[int, int, int]:
+    """
+    Decodes the header of a Block or SimpleBlock whose content starts at position of data: the track number, the
+    timestamp relative to the Cluster and the flags.
+    """
+    track_number, position = parse_vint(data, position)
+    if position + 3 > len(data):
+        raise WrongFile("Unexpected end of data in Block header")
+    return track_number, int.from_bytes(data[position:position + 2], "big", signed=True), data[position + 2]
+
+
+def iter_blocks(reader: ByteReader, cluster: Element) -> Iterator[Block]:
+    """
+    Walks the SimpleBlock and BlockGroup elements of a Cluster with one small read for each of them, skipping their
+    frames. A BlockGroup is a keyframe when it has no ReferenceBlock.
+    """
+    position = cluster.reader.start
+    end = cluster.reader.end
+    while position < end:
+        headers = reader.read_at(position, BLOCK_HEADERS_SIZE)
+        element_id, size, header_size = parse_element_header(headers)
+        content_position = position + header_size
+        if size is None or content_position + size > end:
+            raise WrongFile(f"Invalid element at {position} in Cluster at {cluster.offset}")
+        if instrumentation.current is not None:
+            instrumentation.current.count("elements", ELEMENT_NAMES.get(element_id, f"0x{element_id:X}"))
+        if element_id == SIMPLE_BLOCK_ID:
+            track_number, timestamp, flags = parse_block_header(headers, header_size)
+            yield Block(position, header_size + size, track_number, timestamp, 0,
+                        bool(flags & SIMPLE_BLOCK_KEYFRAME_FLAG))
+        elif element_id == BLOCK_GROUP_ID:
+            yield read_block_group(reader, position, header_size, size)
+        position = content_position + size
+
+
+def read_block_group(reader: ByteReader, position: int, header_size: int, size: int) -> Block:
+    block = None
+    duration = 0
+    keyframe = True
+    content_position = position + header_size
+    child_position = content_position
+    while child_position < content_position + size:
+        child_headers = reader.read_at(child_position, BLOCK_HEADERS_SIZE)
+        child_id, child_size, child_header_size = parse_element_header(child_headers)
+        if child_size is None:
+            raise WrongFile(f"Invalid element at {child_position} in BlockGroup at {position}")
+        if child_id == BLOCK_ID:
+            block = parse_block_header(child_headers, child_header_size)
+        elif child_id == REFERENCE_BLOCK_ID:
+            keyframe = False
+        elif child_id == BLOCK_DURATION_ID:
+            duration = parse_big_endian_number(reader.read_at(child_position + child_header_size, child_size))
+        child_position += child_header_size + child_size
+    if block is None:
+        raise WrongFile(f"BlockGroup without Block at {position}")
+    track_number, timestamp, _ = block
+    return Block(position, header_size + size, track_number, timestamp, duration, keyframe)
+
+
+def read_track_numbers(tracks: Element) -> List[int]:
+    """The numbers of the video and audio tracks, and of those without a TrackType."""
+    track_numbers = []
+    for track_entry in find_elements(tracks.reader, TRACK_ENTRY_ID):
+        children = {child.element_id: child for child in iter_elements(track_entry.reader)}
+        track_number = children.get(TRACK_NUMBER_ID)
+        track_type = children.get(TRACK_TYPE_ID)
+        if track_number is not None and (track_type is None or read_uint(track_type.reader) in MEDIA_TRACK_TYPES):
+            track_numbers.append(read_uint(track_number.reader))
+    return track_numbers
+
+
+def read_cluster_starts(reader: ByteReader, cluster: Element,
+                        track_numbers: Sequence[int]) -> Tuple[int, Dict[int, int]]:
+    """
+    Returns the timestamp of a Cluster and the one of the first block of each track in it, in TimestampScale units.
+    Like in iter_blocks(), each child takes one small read, and they are only walked until the Cluster timestamp
+    and every track have been found, or CLUSTER_START_BLOCKS blocks have been.
+    """
+    cluster_timestamp = None
+    starts = {}  # relative to the Cluster timestamp
+    blocks = 0
+    position = cluster.reader.start
+    end = cluster.reader.end
+    while position < end and (cluster_timestamp is None or
+                              len(starts) < len(track_numbers) and blocks < CLUSTER_START_BLOCKS):
+        headers = reader.read_at(position, BLOCK_HEADERS_SIZE)
+        element_id, size, header_size = parse_element_header(headers)
+        content_position = position + header_size
+        if size is None or content_position + size > end:
+            raise WrongFile(f"Invalid element at {position} in Cluster at {cluster.offset}")
+        if instrumentation.current is not None:
+            instrumentation.current.count("elements", ELEMENT_NAMES.get(element_id, f"0x{element_id:X}"))
+        track_number = None
+        if element_id == CLUSTER_TIMESTAMP_ID and cluster_timestamp is None:
+            cluster_timestamp = parse_big_endian_number(headers[header_size:header_size + size]) \
+                if header_size + size <= len(headers) else read_uint(RegionByteReader(reader, content_position, size))
+        elif element_id == SIMPLE_BLOCK_ID:
+            track_number, timestamp, _ = parse_block_header(headers, header_size)
+            blocks += 1
+        elif element_id == BLOCK_GROUP_ID:
+            block = read_block_group(reader, position, header_size, size)
+            track_number, timestamp = block.track_number, block.timestamp
+            blocks += 1
+        if track_number in track_numbers and track_number not in starts:
+            starts[track_number] = timestamp
+        position = content_position + size
+    if cluster_timestamp is None:
+        raise WrongFile(f"Cluster without Timestamp at {cluster.offset}")
+    return cluster_timestamp, {track_number: cluster_timestamp + timestamp
+                               for track_number, timestamp in starts.items()}
+
+
+def append_cluster_timestamps(reader: ByteReader, cluster: Element, timestamp_scale_value: int, timestamps: array,
+                              track_timestamps: Dict[int, array]):
+    """
+    Appends the timestamp of a Cluster to timestamps and, for the tracks in track_timestamps, the one of their first
+    block in it to their column, NO_TIME when it has no blocks of the track.
+    """
+    if track_timestamps:
+        timestamp, starts = read_cluster_starts(reader, cluster, track_timestamps.keys())
+        timestamps.append(timestamp)
+        for track_number, column in track_timestamps.items():
+            column.append(starts.get(track_number, NO_TIME))
+    else:
+        timestamps.append(Cluster(cluster, timestamp_scale_value).timestamp_value)
+
+
+def read_clusters_timestamps(file_path: str, offsets: Sequence[int], header_sizes: Sequence[int],
+                             sizes: Sequence[int], timestamp_scale_value: int,
+                             track_numbers: Sequence[int]) -> Tuple[array, Dict[int, array]]:
+    """Runs in the workers of a Sharding: the timestamps of the Clusters at offsets, and of each track in them."""
+    reader = open_file_reader(file_path)
+    try:
+        timestamps = array("q")
+        track_timestamps = {track_number: array("q") for track_number in track_numbers}
+        for offset, header_size, size in zip(offsets, header_sizes, sizes):
+            append_cluster_timestamps(reader, Element(CLUSTER_ID, offset, header_size, size - header_size, reader),
+                                      timestamp_scale_value, timestamps, track_timestamps)
+        return timestamps, track_timestamps
+    finally:
+        reader.close()
+
+
+def index_clusters(file_path: str, offsets: Sequence[int], header_sizes: Sequence[int], sizes: Sequence[int],
+                   timestamp_scale_value: int, track_number: Optional[int]) -> Tuple[Tuple[array, ...], array]:
+    """
+    Runs in the workers of a Sharding: the columns of the blocks of the Clusters at offsets, like
+    MatroskaParser.find_samples() builds them, and where the blocks of each Cluster start in them.
+    """
+    reader = open_file_reader(file_path)
+    try:
+        parser = MatroskaParser()
+        columns = tuple(array("q") for _ in range(4)) + (array("B"),)
+        segment_starts = array("q")
+        for offset, header_size, size in zip(offsets, header_sizes, sizes):
+            segment_starts.append(len(columns[0]))
+            element = Element(CLUSTER_ID, offset, header_size, size - header_size, reader)
+            parser._index_cluster(columns, reader, Cluster(element, timestamp_scale_value), track_number)
+        return columns, segment_starts
+    finally:
+        reader.close()
 
 
 class MatroskaParser(MSEParser):
-    def find_media_segments(self, reader: ByteReader) -> List[MediaSegment]:
+    # Clusters checked against the Cues before trusting them, besides the first and last ones
+    INDEX_CHECK_SAMPLES = 8
+
+    def find_media_segments(self, reader: ByteReader, previous: Optional[Sequence[MediaSegment]] = None,
+                            growing: bool = False, sharding: Optional[Sharding] = None) -> SegmentTable:
+        try:
+            try:
+                ebml_id, size = read_element_header(reader)
+                assert ebml_id == EBML_ID
+                reader.skip(size)
+
+                segment_id, _ = read_element_header(reader)
+                assert segment_id == SEGMENT_ID
+            except WrongFile:
+                if growing:
+                    return SegmentTable()  # the headers are not written yet
+                raise
+
+            segment_reader = RegionByteReader(reader, reader.position, size=None)
+
+            segment_info = None
+            seek_head = None
+            cues = None
+            tracks = None
+            first_cluster = None
+            with instrumentation.phase("top-level scan"):
+                for element in iter_elements(segment_reader, complete_only=growing):
+                    if element.element_id == INFO_ID and segment_info is None:
+                        segment_info = element
+                    elif element.element_id == SEEK_HEAD_ID and seek_head is None:
+                        seek_head = element
+                    elif element.element_id == TRACKS_ID and tracks is None:
+                        tracks = element
+                    elif element.element_id == CUES_ID and cues is None:
+                        cues = element
+                    elif element.element_id == CLUSTER_ID:
+                        first_cluster = element
+                        break
+            if segment_info is None:
+                if growing:
+                    return SegmentTable()
+                raise WrongFile("Could not find Segment Info element")
+            with instrumentation.phase("segment info"):
+                timestamp_scale = find_element(segment_info.reader, TIMESTAMP_SCALE_ID)
+                timestamp_scale_value = read_uint(timestamp_scale.reader) if timestamp_scale is not None \
+                    else 1000000
+            if first_cluster is None:
+                return SegmentTable()
+            # The times of each track are only kept for multi-track files
+            track_numbers = read_track_numbers(tracks) if tracks is not None else []
+            if len(track_numbers) < 2:
+                track_numbers = []
+
+            with instrumentation.phase("clusters"):
+                if previous and self._can_resume(segment_reader, first_cluster, previous[-1], timestamp_scale_value,
+                                                 track_numbers):
+                    last_segment = previous[-1]
+                    media_segments = SegmentTable.from_segments(previous)
+                    media_segments.extend(self._scan_clusters(segment_reader,
+                                                              last_segment.offset + last_segment.size,
+                                                              timestamp_scale_value, growing, track_numbers, sharding))
+                    return media_segments
+
+                media_segments = None
+                if not growing and not track_numbers:
+                    # Cues don't give the times of each track
+                    media_segments = self._segments_from_cues(segment_reader, seek_head, cues, first_cluster,
+                                                              timestamp_scale_value)
+                if media_segments is None:
+                    media_segments = self._scan_clusters(segment_reader, first_cluster.offset, timestamp_scale_value,
+                                                         growing, track_numbers, sharding)
+                return media_segments
+        finally:
+            reader.close()
+
+    def iter_media_segments(self, reader: ByteReader, keep_data: bool = False) -> Iterator[MediaSegment]:
         try:
             ebml_id, size = read_element_header(reader)
-            assert ebml_id == 0x1A45DFA3
+            assert ebml_id == EBML_ID
             reader.skip(size)
 
-            segment_id, _ = read_element_header(reader)
-            assert segment_id == 0x18538067
+            segment_id, segment_size = read_element_header(reader)
+            assert segment_id == SEGMENT_ID
+            # The Segment children are walked in the reader itself, as the end of a stream or of an unknown-size
+            # Segment is only found when reaching it.
+            segment_end = reader.position + segment_size if segment_size is not None else reader.end
+
+            timestamp_scale_value = None
+            track_numbers = []
+            found_cluster = False
+            for element in iter_elements(reader):
+                if element.offset >= segment_end:
+                    break
+                if element.element_id == INFO_ID and timestamp_scale_value is None:
+                    timestamp_scale = find_element(element.reader, TIMESTAMP_SCALE_ID)
+                    timestamp_scale_value = read_uint(timestamp_scale.reader) if timestamp_scale is not None \
+                        else 1000000
+                elif element.element_id == TRACKS_ID and not found_cluster:
+                    track_numbers = read_track_numbers(element)
+                    if len(track_numbers) < 2:
+                        track_numbers = []
+                elif element.element_id == CLUSTER_ID:
+                    if timestamp_scale_value is None:
+                        raise WrongFile("Could not find Segment Info element")
+                    cluster = Cluster(element, timestamp_scale_value)
+                    yield MediaSegment(offset=element.offset, size=element.full_size, time=cluster.timestamp,
+                                       track_times=self._track_times(reader, cluster, track_numbers))
+                    found_cluster = True
+                if found_cluster or not keep_data:
+                    reader.release(element.offset + element.full_size)
+        finally:
+            reader.close()
 
+    def find_samples(self, reader: ByteReader, sharding: Optional[Sharding] = None) -> SampleTable:
+        """
+        Deep index of the blocks of the first track, from the headers of the SimpleBlocks and BlockGroups of every
+        Cluster. Durations are only known for blocks in a BlockGroup with a BlockDuration, they are 0 otherwise.
+        """
+        try:
+            ebml_id, size = read_element_header(reader)
+            assert ebml_id == EBML_ID
+            reader.skip(size)
+            segment_id, _ = read_element_header(reader)
+            assert segment_id == SEGMENT_ID
             segment_reader = RegionByteReader(reader, reader.position, size=None)
 
-            segment_info = next(
-                element for element in iter_elements(segment_reader) if element.element_id == 0x1549A966)
-            timestamp_scale = next(
-                (element for element in iter_elements(segment_info.reader) if element.element_id == 0x2AD7B1), None)
-            timestamp_scale_value = read_uint(timestamp_scale.reader) if timestamp_scale is not None else 1000000
+            timestamp_scale_value = None
+            track_number = None
+            # The columns are built for the whole file first, as most clusters only have a few blocks
+            segment_starts = array("q")
+            columns = tuple(array("q") for _ in range(4)) + (array("B"),)
+            cluster_columns = (array("q"), array("q"), array("q"))  # offsets, header sizes and sizes when sharding
+            with open_walk_reader(segment_reader, sharding) as walk_reader:
+                if walk_reader is not segment_reader:
+                    walk_reader = RegionByteReader(walk_reader, segment_reader.start, segment_reader.size)
+                for element in iter_elements(walk_reader):
+                    if element.element_id == INFO_ID and timestamp_scale_value is None:
+                        timestamp_scale = find_element(element.reader, TIMESTAMP_SCALE_ID)
+                        timestamp_scale_value = read_uint(timestamp_scale.reader) if timestamp_scale is not None \
+                            else 1000000
+                    elif element.element_id == TRACKS_ID and track_number is None:
+                        track_entry = find_element(element.reader, TRACK_ENTRY_ID)
+                        track_number_element = find_element(track_entry.reader, TRACK_NUMBER_ID) \
+                            if track_entry is not None else None
+                        if track_number_element is not None:
+                            track_number = read_uint(track_number_element.reader)
+                    elif element.element_id == CLUSTER_ID:
+                        if timestamp_scale_value is None:
+                            raise WrongFile("Could not find Segment Info element")
+                        if sharding is not None:
+                            for column, value in zip(cluster_columns, (element.offset,
+                                                                       element.reader.start - element.offset,
+                                                                       element.full_size)):
+                                column.append(value)
+                            continue
+                        segment_starts.append(len(columns[0]))
+                        with instrumentation.phase("cluster decode"):
+                            self._index_cluster(columns, segment_reader, Cluster(element, timestamp_scale_value),
+                                                track_number)
+            if sharding is not None:
+                with instrumentation.phase("cluster decode"):
+                    for shard_columns, shard_segment_starts in sharding.map(index_clusters, cluster_columns,
+                                                                            timestamp_scale_value, track_number):
+                        segment_starts.extend(start + len(columns[0]) for start in shard_segment_starts)
+                        for column, shard_column in zip(columns, shard_columns):
+                            column.extend(shard_column)
 
-            clusters = [Cluster(element, timestamp_scale_value) for element in iter_elements(segment_reader) if
-                        element.element_id == 0x1F43B675]
-            return [MediaSegment(offset=cluster.element.offset, size=cluster.element.full_size, time=cluster.timestamp)
-                    for cluster in clusters]
+            samples = SampleTable()
+            if segment_starts:
+                offsets, sizes, timestamps, durations, keyframes = columns
+                timescale, factor = cluster_timescale(timestamp_scale_value)
+                samples.segment_starts = segment_starts
+                samples.extend_ticks(offsets, sizes, (timestamp * factor for timestamp in timestamps),
+                                     (duration * factor for duration in durations), keyframes, timescale)
+            return samples
         finally:
             reader.close()
 
+    def _index_cluster(self, columns: Tuple[array, ...], segment_reader: ByteReader, cluster: Cluster,
+                       track_number: Optional[int]):
+        offsets, sizes, timestamps, durations, keyframes = columns
+        for block in iter_blocks(segment_reader, cluster.element):
+            # Without Tracks, all the blocks are indexed
+            if track_number is None or block.track_number == track_number:
+                offsets.append(block.offset)
+                sizes.append(block.size)
+                timestamps.append(cluster.timestamp_value + block.timestamp)
+                durations.append(block.duration)
+                keyframes.append(block.keyframe)
+
+    def _scan_clusters(self, segment_reader: ByteReader, start: int, timestamp_scale_value: int,
+                       growing: bool = False, track_numbers: Sequence[int] = (),
+                       sharding: Optional[Sharding] = None) -> SegmentTable:
+        """
+        With track_numbers, the start time of each of those tracks is found in every cluster too. With sharding, the
+        times are found by its workers once all the clusters are known.
+        """
+        offsets = array("q")
+        sizes = array("q")
+        header_sizes = array("q")
+        timestamps = array("q")
+        track_timestamps = {track_number: array("q") for track_number in track_numbers}
+        with open_walk_reader(segment_reader, sharding) as walk_reader:
+            if walk_reader is not segment_reader:
+                walk_reader = RegionByteReader(walk_reader, segment_reader.start, segment_reader.size)
+            walk_reader.position = start
+            for element in iter_elements(walk_reader, complete_only=growing):
+                if element.element_id == CLUSTER_ID:
+                    offsets.append(element.offset)
+                    sizes.append(element.full_size)
+                    if sharding is None:
+                        append_cluster_timestamps(segment_reader, element, timestamp_scale_value, timestamps,
+                                                  track_timestamps)
+                    else:
+                        header_sizes.append(element.reader.start - element.offset)
+        if sharding is not None:
+            for shard_timestamps, shard_track_timestamps in sharding.map(
+                    read_clusters_timestamps, [offsets, header_sizes, sizes], timestamp_scale_value,
+                    list(track_numbers)):
+                timestamps.extend(shard_timestamps)
+                for track_number, column in shard_track_timestamps.items():
+                    track_timestamps[track_number].extend(column)
+        timescale, factor = cluster_timescale(timestamp_scale_value)
+        media_segments = SegmentTable()
+        media_segments.extend_ticks(offsets, sizes, (timestamp * factor for timestamp in timestamps), timescale,
+                                    tracks={track_number: TrackTicks((timestamp * factor if timestamp != NO_TIME
+                                                                      else NO_TIME for timestamp in column), timescale)
+                                            for track_number, column in track_timestamps.items()})
+        return media_segments
+
+    @staticmethod
+    def _track_times(reader: ByteReader, cluster: Cluster,
+                     track_numbers: Sequence[int]) -> Optional[Dict[int, Optional[Fraction]]]:
+        """Start times of each track in a cluster like _scan_clusters() finds them, None without track_numbers."""
+        if not track_numbers:
+            return None
+        _, starts = read_cluster_starts(reader, cluster.element, track_numbers)
+        timestamp_duration = Fraction(1_000_000_000, cluster.timestamp_scale_value)
+        return {track_number: Fraction(starts[track_number], timestamp_duration) if track_number in starts else None
+                for track_number in track_numbers}
+
+    def _segments_from_cues(self, segment_reader: ByteReader, seek_head: Optional[Element], cues: Optional[Element],
+                            first_cluster: Element, timestamp_scale_value: int) -> Optional[SegmentTable]:
+        """
+        Builds the segment list from the cluster positions and times in the Cues element instead of walking the
+        segment. Cues may leave clusters out, e.g. those without a keyframe, so None is returned, like without usable
+        Cues, unless each cued cluster ends where the next one starts, which takes a read of each cluster header, and
+        no cluster follows the last one. Times are only checked against the Timestamp of a sample of the clusters.
+        """
+        try:
+            if cues is None and seek_head is not None:
+                cues = self._seek(segment_reader, seek_head, CUES_ID)
+            if cues is None:
+                return None
+
+            # Clusters can be referenced by several cue points, e.g. one per track, the earliest gives the cluster time.
+            # The Cues are parsed in memory, they would take several reads per cue point otherwise.
+            data = cues.reader.read_at(cues.reader.start, cues.reader.size)
+            cue_times = {}
+            for cue_point_id, cue_point_position, cue_point_size in iter_parsed_elements(data):
+                if cue_point_id != CUE_POINT_ID:
+                    continue
+                cue_time = None
+                cluster_positions = []
+                for child_id, child_position, child_size in \
+                        iter_parsed_elements(data, cue_point_position, cue_point_position + cue_point_size):
+                    if child_id == CUE_TIME_ID:
+                        cue_time = parse_big_endian_number(data[child_position:child_position + child_size])
+                    elif child_id == CUE_TRACK_POSITIONS_ID:
+                        cluster_positions.extend(
+                            segment_reader.start + parse_big_endian_number(data[position:position + size])
+                            for element_id, position, size in
+                            iter_parsed_elements(data, child_position, child_position + child_size)
+                            if element_id == CUE_CLUSTER_POSITION_ID)
+                if cue_time is None:
+                    return None
+                for position in cluster_positions:
+                    cue_times[position] = min(cue_time, cue_times.get(position, cue_time))
+            positions = sorted(cue_times)
+            if not positions or positions[0] != first_cluster.offset:
+                return None
+
+            sizes = array("q", (next_position - position for position, next_position in zip(positions, positions[1:])))
+            for position, size in zip(positions, sizes):
+                element_id, content_size, content_position = \
+                    parse_element_header(segment_reader.read_at(position, 12))
+                if element_id != CLUSTER_ID or content_size is None or content_position + content_size != size:
+                    return None
+            segment_reader.position = positions[-1]
+            sizes.append(read_element(segment_reader).full_size)
+
+            count = len(positions)
+            checked = {0, count - 1} | {count * (i + 1) // (self.INDEX_CHECK_SAMPLES + 1)
+                                        for i in range(self.INDEX_CHECK_SAMPLES)}
+            for i in sorted(checked):
+                segment_reader.position = positions[i]
+                element = read_element(segment_reader)
+                if element.element_id != CLUSTER_ID or \
+                        Cluster(element, timestamp_scale_value).timestamp_value != cue_times[positions[i]]:
+                    return None
+            # Any cluster after the last cued one would be missing
+            segment_reader.position = positions[-1] + sizes[-1]
+            if any(element.element_id == CLUSTER_ID for element in iter_elements(segment_reader)):
+                return None
+
+            timescale, factor = cluster_timescale(timestamp_scale_value)
+            media_segments = SegmentTable()
+            media_segments.extend_ticks(positions, sizes, (cue_times[position] * factor for position in positions),
+                                        timescale)
+            return media_segments
+        except (WrongFile, RuntimeError, AssertionError, IndexError):
+            # Broken Cues are not fatal, the segment is just scanned instead
+            return None
+
+    def _can_resume(self, segment_reader: ByteReader, first_cluster: Element, last_segment: MediaSegment,
+                    timestamp_scale_value: int, track_numbers: Sequence[int]) -> bool:
+        if not first_cluster.offset <= last_segment.offset < segment_reader.end:
+            return False
+        segment_reader.position = last_segment.offset
+        try:
+            element = read_element(segment_reader)
+            if element.element_id != CLUSTER_ID or element.full_size != last_segment.size:
+                return False
+            cluster = Cluster(element, timestamp_scale_value)
+            return cluster.timestamp == last_segment.time and \
+                self._track_times(segment_reader, cluster, track_numbers) == last_segment.track_times
+        except (WrongFile, RuntimeError):
+            return False
+
+    def _seek(self, segment_reader: ByteReader, seek_head: Element, element_id: int) -> Optional[Element]:
+        seek_id = element_id.to_bytes(4, "big")
+        for seek in find_elements(seek_head.reader, SEEK_ID):
+            children = {child.element_id: child for child in iter_elements(seek.reader)}
+            if SEEK_ID_ID in children and SEEK_POSITION_ID in children and \
+                    children[SEEK_ID_ID].reader.read() == seek_id:
+                segment_reader.position = segment_reader.start + read_uint(children[SEEK_POSITION_ID].reader)
+                element = read_element(segment_reader)
+                return element if element.element_id == element_id else None
+        return None
+
+
+class TestUnknownSizes(TestCase):
+    def test_unknown_sizes(self):
+        from synthetic import ebml_element as element
+
+        def cluster(timestamp: int) -> bytes:
+            simple_block = element(0xA3, b"\x81\x00\x00\x80" + bytes(20))
+            return element(CLUSTER_ID, element(CLUSTER_TIMESTAMP_ID, bytes([timestamp])) + simple_block,
+                           unknown_size=True)
+
+        info = element(INFO_ID, element(TIMESTAMP_SCALE_ID, b"\x0f\x42\x40"))
+        data = element(EBML_ID, b"") + element(SEGMENT_ID, info + cluster(0) + cluster(50) + element(CUES_ID, b""),
+                                               unknown_size=True)
+        first_cluster = data.index(CLUSTER_ID.to_bytes(4, "big"))
+        cluster_size = len(cluster(0))
+        expected = [(first_cluster, cluster_size, 0), (first_cluster + cluster_size, cluster_size, Fraction(1, 20))]
+        # The children of a Cluster are found with one read, not one for each VINT
+        reader = FileByteReader(BytesIO(data))
+        reader.position = first_cluster + 12
+        with instrumentation.collect() as stats:
+            self.assertEqual(first_cluster + cluster_size, find_cluster_end(reader))
+        self.assertEqual(1, stats.counters["io"]["reads"])
+        for segments in (MatroskaParser().find_media_segments(FileByteReader(BytesIO(data))),
+                         MatroskaParser().iter_media_segments(StreamByteReader(BytesIO(data)))):
+            self.assertEqual(expected, [(segment.offset, segment.size, segment.time) for segment in segments])
+        # While the file is being written, an unknown-size Cluster is only complete once something follows it
+        growing = data[:first_cluster + 2 * cluster_size]
+        self.assertEqual(expected[:1], [(segment.offset, segment.size, segment.time) for segment in
+                                        MatroskaParser().find_media_segments(FileByteReader(BytesIO(growing)),
+                                                                             growing=True)])
+
+
+class TestBlocks(TestCase):
+    def test_find_samples(self):
+        from synthetic import ebml_element as element
+
+        def block_header(track_number: int, timestamp: int, flags: int) -> bytes:
+            return bytes([0x80 | track_number]) + timestamp.to_bytes(2, "big", signed=True) + bytes([flags])
+
+        cluster = element(CLUSTER_ID, element(CLUSTER_TIMESTAMP_ID, bytes([10])) + b"".join([
+            element(SIMPLE_BLOCK_ID, block_header(1, 0, SIMPLE_BLOCK_KEYFRAME_FLAG) + bytes(30)),
+            element(SIMPLE_BLOCK_ID, block_header(2, 0, SIMPLE_BLOCK_KEYFRAME_FLAG) + bytes(5)),
+            element(BLOCK_GROUP_ID, element(BLOCK_ID, block_header(1, 40, 0) + bytes(20)) +
+                    element(REFERENCE_BLOCK_ID, b"\xd8") + element(BLOCK_DURATION_ID, bytes([20]))),
+            element(SIMPLE_BLOCK_ID, block_header(1, -5, 0) + bytes(10)),
+        ]))
+        info = element(INFO_ID, element(TIMESTAMP_SCALE_ID, b"\x0f\x42\x40"))
+        tracks = element(TRACKS_ID, element(TRACK_ENTRY_ID, element(TRACK_NUMBER_ID, b"\x01")))
+        data = element(EBML_ID, b"") + element(SEGMENT_ID, info + tracks + cluster + cluster)
+        samples = MatroskaParser().find_samples(FileByteReader(BytesIO(data)))
+
+        self.assertEqual([0, 3], samples.segment_starts.tolist())
+        self.assertEqual(1000, samples.timescale)
+        self.assertEqual([10, 50, 5], samples.ticks[:3].tolist())
+        self.assertEqual([0, 20, 0], samples.durations[:3].tolist())
+        self.assertEqual([1, 0, 0], samples.keyframes[:3].tolist())
+        first_block = data.index(SIMPLE_BLOCK_ID.to_bytes(1, "big") + bytes([0x80 | 34]))
+        self.assertEqual((first_block, 36), (samples.offsets[0], samples.sizes[0]))
+        self.assertEqual([3], samples.segment_keyframes(1))
+
+    def test_cluster_starts(self):
+        from synthetic import ebml_element as element
+
+        tracks = element(TRACKS_ID, b"".join(
+            element(TRACK_ENTRY_ID, element(TRACK_NUMBER_ID, bytes([number])) +
+                    (element(TRACK_TYPE_ID, bytes([track_type])) if track_type is not None else b""))
+            for number, track_type in ((1, 1), (2, 2), (3, 0x11), (4, None))))
+        self.assertEqual([1, 2, 4], read_track_numbers(read_element(FileByteReader(BytesIO(tracks)))))
+
+        # Track 2 has no block in the Cluster, which is only walked until CLUSTER_START_BLOCKS blocks
+        cluster = element(CLUSTER_ID, element(CLUSTER_TIMESTAMP_ID, bytes([10])) + b"".join(
+            element(SIMPLE_BLOCK_ID, bytes([0x81]) + (5 + i).to_bytes(2, "big") + b"\x80" + bytes(10))
+            for i in range(2 * CLUSTER_START_BLOCKS)))
+        reader = FileByteReader(BytesIO(cluster))
+        with instrumentation.collect() as stats:
+            self.assertEqual((10, {1: 15}), read_cluster_starts(reader, read_element(reader), [1, 2]))
+        self.assertEqual(CLUSTER_START_BLOCKS, stats.counters["elements"]["SimpleBlock"])
+
+
+class TestAsync(TestCase):
+    def test_concurrent_files(self):
+        from synthetic import ebml_element as element
+
+        info = element(INFO_ID, element(TIMESTAMP_SCALE_ID, b"\x0f\x42\x40"))
+        clusters = b"".join(element(CLUSTER_ID, element(CLUSTER_TIMESTAMP_ID, (i * 40).to_bytes(3, "big")) +
+                                    element(SIMPLE_BLOCK_ID, b"\x81\x00\x00\x80" + bytes(20)))
+                            for i in range(1000))
+        data = element(EBML_ID, b"") + element(SEGMENT_ID, info + clusters, unknown_size=True)
+        expected = [(segment.offset, segment.size, segment.time)
+                    for segment in MatroskaParser().find_media_segments(FileByteReader(BytesIO(data)))]
+
+        executor = ThreadPoolExecutor(max_workers=4)
+
+        async def index_files():
+            # Counts the turns of the event loop, which only go on while the files are indexed if they are indexed in
+            # the executor
+            turns = 0
+            order = []  # which of the iterators yielded each segment
+            indexed = asyncio.Event()
+
+            async def count_turns():
+                nonlocal turns
+                while not indexed.is_set():
+                    await asyncio.sleep(0)
+                    turns += 1
+
+            async def find() -> Tuple[List[MediaSegment], int]:
+                start = turns
+                segments = await MatroskaParser().find_media_segments_async(
+                    AsyncByteReader(FileByteReader(BytesIO(data)), executor))
+                return segments, turns - start
+
+            async def collect(index: int) -> List[MediaSegment]:
+                segments = []
+                async for segment in MatroskaParser().iter_media_segments_async(
+                        AsyncByteReader(StreamByteReader(BytesIO(data)), executor)):
+                    order.append(index)
+                    segments.append(segment)
+                return segments
+
+            counter = asyncio.create_task(count_turns())
+            results = await asyncio.gather(*(find() for _ in range(8)), *(collect(i) for i in range(2)))
+            indexed.set()
+            await counter
+            return results[:8], results[8:], order
+
+        with executor:
+            found, collected, order = asyncio.run(index_files())
+        for segments in [segments for segments, _ in found] + collected:
+            self.assertEqual(expected, [(segment.offset, segment.size, segment.time) for segment in segments])
+        # Indexing them in the event loop itself would block it until each file is done
+        self.assertTrue(all(turns > 0 for _, turns in found))
+        # and each iterator would only start once the previous one is done
+        self.assertLess(order.index(1), len(order) - 1 - order[::-1].index(0))
+
 
 class TestGolf(TestCase):
     def test_golf(self):
-        print(jsonify(MatroskaParser().find_media_segments(FileByteReader(open("media/golf-v-250k-160x90.webm", "rb")))))
+        print(jsonify(MatroskaParser().find_media_segments(open_file_reader("media/golf-v-250k-160x90.webm"))))
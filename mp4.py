@@ -1,33 +1,86 @@
 import struct
+import sys
+from array import array
 from collections import namedtuple
 from enum import Enum
 from fractions import Fraction
-from typing import List
+from io import BytesIO
+from itertools import accumulate
+from math import lcm
+from operator import add
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
 from unittest import TestCase
 
-from bytereader import ByteReader, RegionByteReader, FileByteReader
+import instrumentation
+from bytereader import ByteReader, RegionByteReader, FileByteReader, open_file_reader
 from byteutils import parse_big_endian_number, parse_signed_big_endian_number
-from mseparser import MSEParser, MediaSegment, jsonify
+from mseparser import NO_TIME, MSEParser, MediaSegment, SampleTable, SegmentTable, Sharding, TrackTicks, jsonify, \
+    open_walk_reader
+
+
+BoxHeader = namedtuple("BoxHeader", ["kind", "offset", "content_offset", "end"])
+
+
+def read_box_header(reader: ByteReader, position: int) -> BoxHeader:
+    size, kind = struct.unpack_from(">I4s", reader.read_at(position, 8))
+    content_offset = position + 8
+    if size == 1:
+        large_size = reader.read_at(content_offset, 8)
+        if len(large_size) < 8:
+            raise RuntimeError(f"Truncated header for box at {position}")
+        size = parse_big_endian_number(large_size)
+        content_offset += 8
+    elif size == 0:
+        # The box extends to the end of the file
+        size = reader.end - position
+    if kind == b"uuid":
+        kind += bytes(reader.read_at(content_offset, 16))
+        content_offset += 16
+    if size < content_offset - position:
+        raise RuntimeError(f"Invalid size {size} for box at {position}")
+    if instrumentation.current is not None:
+        name = kind.decode("latin-1")
+        instrumentation.current.count("boxes", name if name.isprintable() else kind.hex())
+    return BoxHeader(kind, position, content_offset, position + size)
+
+
+def iter_box_headers(reader: ByteReader, start: int, end: int, complete_only: bool = False):
+    """
+    Walks the boxes in [start, end) reading only their headers, without creating a reader for each one. With
+    complete_only, the walk stops before the first box cut short by the end, e.g. because it's still being written.
+    """
+    position = start
+    while position < end:
+        try:
+            header = read_box_header(reader, position)
+        except (RuntimeError, struct.error):
+            if complete_only:
+                return
+            raise
+        if complete_only and header.end > end:
+            return
+        yield header
+        position = header.end
 
 
 class Box:
     def __init__(self, reader: ByteReader):
-        self.offset = reader.position
-        size = parse_big_endian_number(reader.read(4))
-        kind = reader.read(4)
-        if size == 1:
-            size = parse_big_endian_number(reader.read(8))
-        elif size == 0:
-            size = reader.end - reader.position
-        if kind == b"uuid":
-            kind += reader.read(16)
-        content_offset = reader.position
-        content_size = size - (content_offset - self.offset)
-
-        self.kind = kind
-        self.full_size = size
-        self.reader = RegionByteReader(reader, content_offset, content_size)
-        reader.skip(content_size)
+        header = read_box_header(reader, reader.position)
+        self.offset = header.offset
+        self.kind = header.kind
+        self.full_size = header.end - header.offset
+        self.reader = RegionByteReader(reader, header.content_offset, header.end - header.content_offset)
+        reader.position = min(header.end, reader.end)
+        self._children = None
+
+    @property
+    def children(self) -> Dict[bytes, List["Box"]]:
+        """Child boxes by kind. They are found in a single pass the first time they are needed."""
+        if self._children is None:
+            self._children = {}
+            for child in iter_boxes(self.reader, rewind=True):
+                self._children.setdefault(child.kind, []).append(child)
+        return self._children
 
 
 class FullBox:
@@ -41,18 +94,26 @@ class FullBox:
 class MovieBox:
     def __init__(self, box: Box):
         self.box = box
-        self.movie_header = next(
-            MovieHeaderBox(box) for box in iter_boxes(box.reader, rewind=True) if box.kind == b"mvhd")
-        self.tracks = [TrackBox(box) for box in iter_boxes(box.reader, rewind=True) if box.kind == b"trak"]
-        assert len(self.tracks) == 1  # only one track supported
+        self.movie_header = MovieHeaderBox(find_box(box, b"mvhd", required=True))
+        self.tracks = [TrackBox(box) for box in find_boxes(box, b"trak")]
+        if not self.tracks:
+            raise RuntimeError("Could not find trak box")
+        mvex = find_box(box, b"mvex")
+        self.track_extends = [TrackExtendsBox(box) for box in find_boxes(mvex, b"trex")] if mvex is not None else []
+
+    def find_track_extends(self, track_ID: int) -> Optional["TrackExtendsBox"]:
+        return next((trex for trex in self.track_extends if trex.track_ID == track_ID), None)
 
-    def presentation_offset(self) -> Fraction:
-        elst = self.tracks[0].elst
+    def presentation_offset(self, track: Optional["TrackBox"] = None) -> Fraction:
+        """Offset from media time to presentation time given by the edit list of a track, the first one by default."""
+        if track is None:
+            track = self.tracks[0]
+        elst = track.elst
         if elst is None:
             return Fraction(0, 1)
 
         movie_timescale = self.movie_header.timescale
-        track_timescale = self.tracks[0].mdia.mdhd.timescale
+        track_timescale = track.mdia.mdhd.timescale
         offset = Fraction(0, 1)
         for i, edit in enumerate(elst.edits):
             if edit.media_time == -1:
@@ -65,6 +126,14 @@ class MovieBox:
         return offset
 
 
+class TrackExtendsBox:
+    def __init__(self, box: Box):
+        self.box = box
+        self.full_box = FullBox(box)
+        (self.track_ID, self.default_sample_description_index, self.default_sample_duration,
+         self.default_sample_size, self.default_sample_flags) = struct.unpack(">5I", self.full_box.reader.read(20))
+
+
 class MovieHeaderBox:
     def __init__(self, box: Box):
         self.box = box
@@ -77,9 +146,10 @@ class MovieHeaderBox:
 class TrackBox:
     def __init__(self, box: Box):
         self.box = box
-        self.tkhd = next(TrackHeaderBox(box) for box in iter_boxes(box.reader, rewind=True) if box.kind == b"tkhd")
-        self.mdia = next(MediaBox(box) for box in iter_boxes(box.reader, rewind=True) if box.kind == b"mdia")
-        self.edts = next((EditBox(box) for box in iter_boxes(box.reader, rewind=True) if box.kind == b"edts"), None)
+        self.tkhd = TrackHeaderBox(find_box(box, b"tkhd", required=True))
+        self.mdia = MediaBox(find_box(box, b"mdia", required=True))
+        edts_box = find_box(box, b"edts")
+        self.edts = EditBox(edts_box) if edts_box is not None else None
         self.elst = self.edts.elst if self.edts is not None else None
 
 
@@ -95,7 +165,7 @@ class TrackHeaderBox:
 class MediaBox:
     def __init__(self, box: Box):
         self.box = box
-        self.mdhd = next((MediaHeaderBox(box) for box in iter_boxes(box.reader) if box.kind == b"mdhd"))
+        self.mdhd = MediaHeaderBox(find_box(box, b"mdhd", required=True))
 
 
 class MediaHeaderBox:
@@ -110,7 +180,8 @@ class MediaHeaderBox:
 class EditBox:
     def __init__(self, box: Box):
         self.box = box
-        self.elst = next((EditListBox(box) for box in iter_boxes(box.reader) if box.kind == b"elst"), None)
+        elst_box = find_box(box, b"elst")
+        self.elst = EditListBox(elst_box) if elst_box is not None else None
 
 
 Edit = namedtuple("Edit", ["segment_duration", "media_time"])
@@ -135,19 +206,16 @@ class EditListBox:
 class MovieFragmentBox:
     def __init__(self, box: Box):
         self.box = box
-        self.trafs = [TrackFragmentBox(box) for box in iter_boxes(box.reader) if box.kind == b"traf"]
+        self.trafs = [TrackFragmentBox(box) for box in find_boxes(box, b"traf")]
         assert len(self.trafs) > 0
 
 
 class TrackFragmentBox:
     def __init__(self, box: Box):
         self.box = box
-        self.tfhd = next(
-            TrackFragmentHeaderBox(box) for box in iter_boxes(box.reader, rewind=True) if box.kind == b"tfhd")
-        self.tfdt = next(
-            TrackFragmentBaseMediaDecodeTimeBox(box) for box in iter_boxes(box.reader, rewind=True) if
-            box.kind == b"tfdt")
-        self.truns = [TrackRunBox(box) for box in iter_boxes(box.reader, rewind=True) if box.kind == b"trun"]
+        self.tfhd = TrackFragmentHeaderBox(find_box(box, b"tfhd", required=True))
+        self.tfdt = TrackFragmentBaseMediaDecodeTimeBox(find_box(box, b"tfdt", required=True))
+        self.truns = [TrackRunBox(box) for box in find_boxes(box, b"trun")]
 
 
 class TFFlags:
@@ -159,6 +227,7 @@ class TFFlags:
     DURATION_IS_EMPTY = 0x10000
     DEFAULT_BASE_IS_MOOF = 0x20000
 
+
 class TRFlags:
     DATA_OFFSET_PRESENT = 0x1
     FIRST_SAMPLE_FLAGS_PRESENT = 0x4
@@ -168,11 +237,36 @@ class TRFlags:
     SAMPLE_COMPOSITION_TIME_OFFSETS_PRESENT = 0x800
 
 
+# The sample_is_non_sync_sample bit of sample flags
+SAMPLE_IS_NON_SYNC_SAMPLE = 0x10000
+# Maps the byte of sample flags holding that bit to whether the sample is a keyframe, to decode them with translate()
+KEYFRAME_TABLE = bytes(0 if byte & (SAMPLE_IS_NON_SYNC_SAMPLE >> 16) else 1 for byte in range(256))
+
+# Fields of a trun sample in the order they are stored, each one being present or not according to the trun flags
+TRUN_SAMPLE_FIELDS = (TRFlags.SAMPLE_DURATION_PRESENT, TRFlags.SAMPLE_SIZE_PRESENT, TRFlags.SAMPLE_FLAGS_PRESENT,
+                      TRFlags.SAMPLE_COMPOSITION_TIME_OFFSETS_PRESENT)
+
+# array type codes of 32 bit integers, which depend on the platform
+UINT32 = next(code for code in "IL" if array(code).itemsize == 4)
+INT32 = UINT32.lower()
+
+
 class TrackFragmentHeaderBox:
     def __init__(self, box: Box):
         self.box = box
         self.full_box = FullBox(box)
         self.tf_flags = self.full_box.flags
+        reader = self.full_box.reader
+        self.track_ID = parse_big_endian_number(reader.read(4))
+
+        def read_optional(flag: int, size: int) -> Optional[int]:
+            return parse_big_endian_number(reader.read(size)) if self.tf_flags & flag else None
+
+        self.base_data_offset = read_optional(TFFlags.BASE_DATA_OFFSET_PRESENT, 8)
+        self.sample_description_index = read_optional(TFFlags.SAMPLE_DESCRIPTION_INDEX_PRESENT, 4)
+        self.default_sample_duration = read_optional(TFFlags.DEFAULT_SAMPLE_DURATION_PRESENT, 4)
+        self.default_sample_size = read_optional(TFFlags.DEFAULT_SAMPLE_SIZE_PRESENT, 4)
+        self.default_sample_flags = read_optional(TFFlags.DEFAULT_SAMPLE_FLAGS_PRESENT, 4)
 
 
 class TrackFragmentBaseMediaDecodeTimeBox:
@@ -183,18 +277,23 @@ class TrackFragmentBaseMediaDecodeTimeBox:
         self.base_media_decode_time = parse_big_endian_number(self.full_box.reader.read(int_size))
 
 
+TrunSamples = namedtuple("TrunSamples", ["durations", "sizes", "flags", "composition_time_offsets"])
+
+
 class TrackRunBox:
     def __init__(self, box: Box):
         self.box = box
         self.full_box = FullBox(box)
         tr_flags = self.full_box.flags
+        self.tr_flags = tr_flags
         self.sample_count = parse_big_endian_number(self.full_box.reader.read(4))
+        self.data_offset = None
         if tr_flags & TRFlags.DATA_OFFSET_PRESENT:
-            self.full_box.reader.skip(4)
+            self.data_offset = parse_signed_big_endian_number(self.full_box.reader.read(4))
+        self.first_sample_flags = None
         if tr_flags & TRFlags.FIRST_SAMPLE_FLAGS_PRESENT:
-            self.full_box.reader.skip(4)
-        if tr_flags & TRFlags.FIRST_SAMPLE_FLAGS_PRESENT:
-            self.full_box.reader.skip(4)
+            self.first_sample_flags = parse_big_endian_number(self.full_box.reader.read(4))
+        self._samples_position = self.full_box.reader.position
 
         assert self.sample_count > 0
         # First sample
@@ -209,6 +308,84 @@ class TrackRunBox:
         else:
             self.first_sample_composition_time_offset = 0
 
+    def read_samples(self) -> TrunSamples:
+        """
+        Decodes the fields of all the samples at once into arrays, one per field, or None for the fields that are not
+        present and take their default values from tfhd or trex instead.
+        """
+        fields = [field for field in TRUN_SAMPLE_FIELDS if self.tr_flags & field]
+        if not fields:
+            return TrunSamples(None, None, None, None)
+        size = 4 * len(fields) * self.sample_count
+        data = self.full_box.reader.read_at(self._samples_position, size)
+        if len(data) < size:
+            raise RuntimeError(f"Truncated trun box at {self.box.offset}")
+        values = array(UINT32)
+        values.frombytes(data)
+        if sys.byteorder == "little":
+            values.byteswap()
+        # The fields of each sample are interleaved, so each one is a strided slice
+        columns = {field: values[i::len(fields)] for i, field in enumerate(fields)}
+        composition_time_offsets = columns.get(TRFlags.SAMPLE_COMPOSITION_TIME_OFFSETS_PRESENT)
+        if composition_time_offsets is not None and self.full_box.version == 1:
+            composition_time_offsets = array(INT32, composition_time_offsets.tobytes())
+        return TrunSamples(columns.get(TRFlags.SAMPLE_DURATION_PRESENT), columns.get(TRFlags.SAMPLE_SIZE_PRESENT),
+                           columns.get(TRFlags.SAMPLE_FLAGS_PRESENT), composition_time_offsets)
+
+
+SegmentReference = namedtuple("SegmentReference", ["reference_type", "referenced_size", "subsegment_duration"])
+
+
+class SegmentIndexBox:
+    def __init__(self, box: Box):
+        self.box = box
+        self.full_box = FullBox(box)
+        int_size = 8 if self.full_box.version == 1 else 4
+        self.reference_ID = parse_big_endian_number(self.full_box.reader.read(4))
+        self.timescale = parse_big_endian_number(self.full_box.reader.read(4))
+        self.earliest_presentation_time = parse_big_endian_number(self.full_box.reader.read(int_size))
+        self.first_offset = parse_big_endian_number(self.full_box.reader.read(int_size))
+        self.full_box.reader.skip(2)  # reserved
+        reference_count = parse_big_endian_number(self.full_box.reader.read(2))
+        self.references = [
+            SegmentReference(reference >> 31, reference & 0x7FFFFFFF, subsegment_duration)
+            for reference, subsegment_duration, _sap in
+            struct.iter_unpack(">III", self.full_box.reader.read(12 * reference_count))
+        ]
+
+
+RandomAccessEntry = namedtuple("RandomAccessEntry", ["time", "moof_offset", "traf_number", "trun_number",
+                                                     "sample_number"])
+
+
+class TrackFragmentRandomAccessBox:
+    def __init__(self, box: Box):
+        self.box = box
+        self.full_box = FullBox(box)
+        int_size = 8 if self.full_box.version == 1 else 4
+        self.track_ID = parse_big_endian_number(self.full_box.reader.read(4))
+        lengths = parse_big_endian_number(self.full_box.reader.read(4))
+        traf_size, trun_size, sample_size = (((lengths >> shift) & 0x3) + 1 for shift in (4, 2, 0))
+        entry_count = parse_big_endian_number(self.full_box.reader.read(4))
+
+        field_sizes = (int_size, int_size, traf_size, trun_size, sample_size)
+        entry_size = sum(field_sizes)
+        data = self.full_box.reader.read(entry_size * entry_count)
+        self.entries = []
+        for entry_offset in range(0, entry_size * entry_count, entry_size):
+            fields = []
+            for field_size in field_sizes:
+                fields.append(parse_big_endian_number(data[entry_offset:entry_offset + field_size]))
+                entry_offset += field_size
+            self.entries.append(RandomAccessEntry(*fields))
+
+
+class MovieFragmentRandomAccessOffsetBox:
+    def __init__(self, box: Box):
+        self.box = box
+        self.full_box = FullBox(box)
+        self.mfra_size = parse_big_endian_number(self.full_box.reader.read(4))
+
 
 def iter_boxes(reader: ByteReader, rewind: bool = False):
     if rewind:
@@ -217,43 +394,658 @@ def iter_boxes(reader: ByteReader, rewind: bool = False):
         yield Box(reader)
 
 
-def find_boxes(reader: ByteReader, kind: bytes, rewind: bool = False) -> List[Box]:
-    return [box for box in iter_boxes(reader, rewind) if box.kind == kind]
+# Both functions accept either a container Box, which is looked up in its child index, or a reader, which is scanned.
+
+def find_boxes(container: Union[Box, ByteReader], kind: bytes, rewind: bool = False) -> List[Box]:
+    if isinstance(container, Box):
+        return container.children.get(kind, [])
+    return [box for box in iter_boxes(container, rewind) if box.kind == kind]
 
 
-def find_box(reader: ByteReader, kind: bytes, rewind: bool = False, required: bool = False) -> Box:
-    for box in iter_boxes(reader, rewind):
-        if box.kind == kind:
-            return box
+def find_box(container: Union[Box, ByteReader], kind: bytes, rewind: bool = False,
+             required: bool = False) -> Optional[Box]:
+    if isinstance(container, Box):
+        boxes = container.children.get(kind)
+        if boxes:
+            return boxes[0]
+    else:
+        for box in iter_boxes(container, rewind):
+            if box.kind == kind:
+                return box
     if required:
         raise RuntimeError(f"Could not find {kind} box")
 
 
+def read_fragment_start(reader: ByteReader, moof: BoxHeader) -> int:
+    """
+    Returns the composition time of the first sample of the first traf of a moof, in track timescale units, like
+    MovieFragmentBox would. Only the headers in the way and the start of tfdt and the first trun are read.
+    """
+    traf = next((header for header in iter_box_headers(reader, moof.content_offset, moof.end)
+                 if header.kind == b"traf"), None)
+    if traf is None:
+        raise RuntimeError(f"Could not find traf box in moof at {moof.offset}")
+
+    base_media_decode_time = None
+    trun = None
+    for header in iter_box_headers(reader, traf.content_offset, traf.end):
+        if header.kind == b"tfdt" and base_media_decode_time is None:
+            version = reader.read_at(header.content_offset, 1)[0]
+            int_size = 8 if version == 1 else 4
+            base_media_decode_time = parse_big_endian_number(reader.read_at(header.content_offset + 4, int_size))
+        elif header.kind == b"trun" and trun is None:
+            trun = header
+        if base_media_decode_time is not None and trun is not None:
+            break
+    if base_media_decode_time is None:
+        raise RuntimeError(f"Could not find tfdt box in moof at {moof.offset}")
+    if trun is None:
+        raise RuntimeError(f"Could not find trun box in moof at {moof.offset}")
+
+    # version and flags, sample_count, and at most 6 more 32 bit fields up to the first sample composition offset
+    trun_header = reader.read_at(trun.content_offset, 32)
+    field_offset = first_composition_time_offset_position(parse_big_endian_number(trun_header[1:4]))
+    if field_offset is None:
+        return base_media_decode_time
+    return base_media_decode_time + parse_signed_big_endian_number(trun_header[field_offset:field_offset + 4])
+
+
+def first_composition_time_offset_position(tr_flags: int) -> Optional[int]:
+    """Position of the composition time offset of the first sample in a trun with tr_flags, None if it has none."""
+    if not tr_flags & TRFlags.SAMPLE_COMPOSITION_TIME_OFFSETS_PRESENT:
+        return None
+    field_offset = 8
+    for flag in (TRFlags.DATA_OFFSET_PRESENT, TRFlags.FIRST_SAMPLE_FLAGS_PRESENT, TRFlags.SAMPLE_DURATION_PRESENT,
+                 TRFlags.SAMPLE_SIZE_PRESENT, TRFlags.SAMPLE_FLAGS_PRESENT):
+        if tr_flags & flag:
+            field_offset += 4
+    return field_offset
+
+
+def parse_box_header(data: bytes, position: int, end: int) -> Tuple[bytes, int, int]:
+    """
+    Like read_box_header() for a box in data[position:end], returns its kind and the positions of its content and of
+    its end in data.
+    """
+    if position + 8 > end:
+        raise RuntimeError(f"Truncated box header at {position}")
+    size, kind = struct.unpack_from(">I4s", data, position)
+    content_position = position + 8
+    if size == 1:
+        if content_position + 8 > end:
+            raise RuntimeError(f"Truncated box header at {position}")
+        size, = struct.unpack_from(">Q", data, content_position)
+        content_position += 8
+    elif size == 0:
+        size = end - position
+    if kind == b"uuid":
+        kind += bytes(data[content_position:content_position + 16])
+        content_position += 16
+    if size < content_position - position or position + size > end:
+        raise RuntimeError(f"Invalid size {size} for box at {position}")
+    if instrumentation.current is not None:
+        name = kind.decode("latin-1")
+        instrumentation.current.count("boxes", name if name.isprintable() else kind.hex())
+    return kind, content_position, position + size
+
+
+def read_fragment_starts(reader: ByteReader, moof: BoxHeader) -> Dict[int, int]:
+    """
+    Like read_fragment_start(), for each track with samples in a moof by track_ID. The moof is read at once and its
+    trafs parsed in memory, so that each of them doesn't take more reads.
+    """
+    size = moof.end - moof.content_offset
+    data = reader.read_at(moof.content_offset, size)
+    if len(data) < size:
+        raise RuntimeError(f"Truncated moof at {moof.offset}")
+    starts = {}
+    position = 0
+    while position < size:
+        kind, content_position, end = parse_box_header(data, position, size)
+        if kind == b"traf":
+            track_ID = None
+            base_media_decode_time = None
+            trun_position = None
+            child_position = content_position
+            while child_position < end and (track_ID is None or base_media_decode_time is None or
+                                            trun_position is None):
+                child_kind, child_content_position, child_end = parse_box_header(data, child_position, end)
+                if child_kind == b"tfhd" and track_ID is None:
+                    track_ID, = struct.unpack_from(">I", data, child_content_position + 4)
+                elif child_kind == b"tfdt" and base_media_decode_time is None:
+                    base_media_decode_time, = struct.unpack_from(">Q" if data[child_content_position] == 1 else ">I",
+                                                                 data, child_content_position + 4)
+                elif child_kind == b"trun" and trun_position is None:
+                    trun_position = child_content_position
+                child_position = child_end
+            if track_ID is None:
+                raise RuntimeError(f"Could not find tfhd box in moof at {moof.offset}")
+            if base_media_decode_time is None:
+                raise RuntimeError(f"Could not find tfdt box in moof at {moof.offset}")
+            if trun_position is None:
+                raise RuntimeError(f"Could not find trun box in moof at {moof.offset}")
+            field_offset = first_composition_time_offset_position(
+                parse_big_endian_number(data[trun_position + 1:trun_position + 4]))
+            if field_offset is not None:
+                base_media_decode_time += struct.unpack_from(">i", data, trun_position + field_offset)[0]
+            # The first traf of a track comes first in decode order
+            starts.setdefault(track_ID, base_media_decode_time)
+        position = end
+    if not starts:
+        raise RuntimeError(f"Could not find traf box in moof at {moof.offset}")
+    return starts
+
+
+def append_fragment_ticks(reader: ByteReader, moof: BoxHeader, track_ticks: Dict[int, array]):
+    """Appends the start ticks of each track in a moof to its column of track_ticks, NO_TIME when it has no samples."""
+    if len(track_ticks) == 1:
+        (ticks,) = track_ticks.values()
+        ticks.append(read_fragment_start(reader, moof))
+    else:
+        starts = read_fragment_starts(reader, moof)
+        for track_ID, ticks in track_ticks.items():
+            ticks.append(starts.get(track_ID, NO_TIME))
+
+
+def read_fragments_ticks(file_path: str, offsets: Sequence[int], track_IDs: Sequence[int]) -> Dict[int, array]:
+    """Runs in the workers of a Sharding: the start ticks of each track in the moofs at offsets."""
+    reader = open_file_reader(file_path)
+    try:
+        track_ticks = {track_ID: array("q") for track_ID in track_IDs}
+        for offset in offsets:
+            append_fragment_ticks(reader, read_box_header(reader, offset), track_ticks)
+        return track_ticks
+    finally:
+        reader.close()
+
+
+def index_fragments(file_path: str, offsets: Sequence[int], moov_offset: int) -> SampleTable:
+    """Runs in the workers of a Sharding: the samples of the moofs at offsets, a media segment for each."""
+    reader = open_file_reader(file_path)
+    try:
+        reader.position = moov_offset
+        moov = MovieBox(Box(reader))
+        presentation_offset = moov.presentation_offset()
+        parser = MP4Parser()
+        samples = SampleTable()
+        for offset in offsets:
+            reader.position = offset
+            samples.start_segment()
+            parser._index_fragment(samples, moov, presentation_offset, MovieFragmentBox(Box(reader)))
+        return samples
+    finally:
+        reader.close()
+
+
+# Fragment offsets and their start times in media time, before applying the edit list, in ticks of a timescale
+Fragments = Tuple[array, array, int]
+
+
 class MP4Parser(MSEParser):
-    def find_media_segments(self, reader: ByteReader) -> List[MediaSegment]:
+    # Fragments checked against the actual moofs before trusting a sidx or mfra index, besides the first and last ones
+    INDEX_CHECK_SAMPLES = 8
+
+    def find_media_segments(self, reader: ByteReader, previous: Optional[Sequence[MediaSegment]] = None,
+                            growing: bool = False, sharding: Optional[Sharding] = None) -> SegmentTable:
         try:
-            moov = MovieBox(next(box for box in iter_boxes(reader) if box.kind == b"moov"))
-            moofs = [MovieFragmentBox(box) for box in iter_boxes(reader) if box.kind == b"moof"]
+            moov = None
+            sidx = None
+            first_moof = None
+            with instrumentation.phase("top-level scan"):
+                for header in iter_box_headers(reader, reader.start, reader.end, complete_only=growing):
+                    if header.kind == b"moov" and moov is None:
+                        reader.position = header.offset
+                        with instrumentation.phase("moov"):
+                            moov = MovieBox(Box(reader))
+                    elif header.kind == b"sidx" and moov is not None and sidx is None:
+                        sidx = header
+                    elif header.kind == b"moof" and moov is not None:
+                        first_moof = header
+                        break
+            if moov is None and not growing:
+                raise RuntimeError("Could not find moov box")
+            if first_moof is None:
+                return SegmentTable()
 
-            def fragment_size(fragment_index):
-                if fragment_index < len(moofs) - 1:
-                    return moofs[fragment_index + 1].box.offset - moofs[fragment_index].box.offset
+            track = moov.tracks[0]
+            timescale = track.mdia.mdhd.timescale
+            media_segments = SegmentTable()
+            fragments = None
+            end = reader.end
+            with instrumentation.phase("fragments"):
+                if previous and self._can_resume(reader, moov, first_moof, previous[-1]):
+                    # The last segment may have grown, so it's parsed again
+                    media_segments.extend(previous[:-1])
+                    offsets, track_ticks, end = self._scan_fragments(reader, moov, previous[-1].offset, growing,
+                                                                     sharding)
                 else:
-                    movie_size = reader.size
-                    return movie_size - moofs[fragment_index].box.offset
+                    if not growing and len(moov.tracks) == 1:
+                        # Indexes only give the times of one track
+                        fragments = self._fragments_from_index(reader, moov, sidx, first_moof)
+                    if fragments is not None:
+                        offsets, ticks, timescale = fragments
+                        track_ticks = {track.tkhd.track_ID: ticks}
+                    else:
+                        offsets, track_ticks, end = self._scan_fragments(reader, moov, first_moof.offset, growing,
+                                                                         sharding)
 
-            return [MediaSegment(moof.box.offset, fragment_size(i), self._moof_start_time(moov, moof))
-                    for i, moof in enumerate(moofs)]
+            ends = offsets[1:]
+            ends.append(end)
+            sizes = (end - offset for offset, end in zip(offsets, ends))
+            if len(moov.tracks) == 1:
+                media_segments.extend_ticks(offsets, sizes, track_ticks[track.tkhd.track_ID], timescale,
+                                            moov.presentation_offset())
+            else:
+                tracks = {track.tkhd.track_ID: TrackTicks(track_ticks[track.tkhd.track_ID], track.mdia.mdhd.timescale,
+                                                          moov.presentation_offset(track))
+                          for track in moov.tracks}
+                ticks, timescale = self._earliest_ticks(offsets, tracks)
+                media_segments.extend_ticks(offsets, sizes, ticks, timescale, tracks=tracks)
+            return media_segments
+        finally:
+            reader.close()
+
+    def iter_media_segments(self, reader: ByteReader, keep_data: bool = False) -> Iterator[MediaSegment]:
+        try:
+            moov = None
+            fragment = None  # offset and times of the last moof, its size is known when the next one starts
+            position = reader.start
+            while position < reader.end and reader.read_at(position, 1):
+                header = read_box_header(reader, position)
+                if header.kind == b"moov" and moov is None:
+                    reader.position = header.offset
+                    with instrumentation.phase("moov"):
+                        moov = MovieBox(Box(reader))
+                elif header.kind == b"moof":
+                    if moov is None:
+                        raise RuntimeError("Could not find moov box")
+                    if fragment is not None:
+                        yield MediaSegment(fragment[0], header.offset - fragment[0], *fragment[1])
+                        reader.release(header.offset)
+                    fragment = (header.offset, self._fragment_times(reader, moov, header))
+                if header.end == reader.end:
+                    # A box of size 0 extends to the end, which a stream only knows once it has been reached. Reading
+                    # its last byte gets there, dropping the rest as it goes by unless the data is kept.
+                    if not keep_data:
+                        reader.release(header.end - 1)
+                    reader.read_at(header.end - 1, 1)
+                elif not keep_data:
+                    # Skipped boxes, like the mdat, are dropped as they go by instead of staying buffered
+                    reader.release(header.end)
+                position = header.end
+            # The end of a stream is only known once it has been reached
+            if fragment is not None:
+                yield MediaSegment(fragment[0], reader.end - fragment[0], *fragment[1])
+        finally:
+            reader.close()
+
+    def find_samples(self, reader: ByteReader, sharding: Optional[Sharding] = None) -> SampleTable:
+        """
+        Deep index of every sample of the track, decoding all the truns. Media segments start at each moof, as when
+        find_media_segments() scans the file.
+        """
+        try:
+            moov = None
+            moov_offset = None
+            presentation_offset = None
+            moof_offsets = array("q")
+            samples = SampleTable()
+            with open_walk_reader(reader, sharding) as walk_reader:
+                for header in iter_box_headers(walk_reader, reader.start, reader.end):
+                    if header.kind == b"moov" and moov is None:
+                        moov_offset = reader.position = header.offset
+                        with instrumentation.phase("moov"):
+                            moov = MovieBox(Box(reader))
+                        presentation_offset = moov.presentation_offset()
+                    elif header.kind == b"moof":
+                        if moov is None:
+                            raise RuntimeError("Could not find moov box")
+                        if sharding is not None:
+                            moof_offsets.append(header.offset)
+                            continue
+                        reader.position = header.offset
+                        samples.start_segment()
+                        with instrumentation.phase("fragment decode"):
+                            self._index_fragment(samples, moov, presentation_offset, MovieFragmentBox(Box(reader)))
+            if moov is None:
+                raise RuntimeError("Could not find moov box")
+            if sharding is not None:
+                with instrumentation.phase("fragment decode"):
+                    for shard_samples in sharding.map(index_fragments, [moof_offsets], moov_offset):
+                        samples.extend(shard_samples)
+            return samples
         finally:
             reader.close()
 
-    def _moof_start_time(self, moov: MovieBox, moof: MovieFragmentBox):
-        traf = moof.trafs[0]
+    def _index_fragment(self, samples: SampleTable, moov: MovieBox, presentation_offset: Fraction,
+                        moof: MovieFragmentBox):
+        track = moov.tracks[0]
+        track_timescale = track.mdia.mdhd.timescale
+        # Without an explicit base, the data of a traf follows the one of the previous traf, or the moof for the first
+        data_end = moof.box.offset
+        for traf in moof.trafs:
+            tfhd = traf.tfhd
+            trex = moov.find_track_extends(tfhd.track_ID)
+            if tfhd.base_data_offset is not None:
+                base_data_offset = tfhd.base_data_offset
+            elif tfhd.tf_flags & TFFlags.DEFAULT_BASE_IS_MOOF:
+                base_data_offset = moof.box.offset
+            else:
+                base_data_offset = data_end
+            data_end = base_data_offset
+            decode_time = traf.tfdt.base_media_decode_time
+            for trun in traf.truns:
+                count = trun.sample_count
+                durations, sizes, flags, composition_time_offsets = trun.read_samples()
+                if durations is None:
+                    durations = array(UINT32, [self._required_default(tfhd, trex, "default_sample_duration")]) * count
+                if sizes is None:
+                    sizes = array(UINT32, [self._required_default(tfhd, trex, "default_sample_size")]) * count
+                if trun.data_offset is not None:
+                    data_end = base_data_offset + trun.data_offset
+                offsets = array("q", accumulate(sizes, initial=data_end))
+                data_end = offsets.pop()
+                decode_ticks = array("q", accumulate(durations, initial=decode_time))
+                decode_time = decode_ticks.pop()
+                if tfhd.track_ID != track.tkhd.track_ID:
+                    # Other tracks are only walked to know where the data of the next traf is
+                    continue
+
+                if flags is not None:
+                    # The third least significant byte of each flags value, wherever it is in native byte order
+                    flags_byte = 2 if sys.byteorder == "little" else 1
+                    keyframes = array("B", flags.tobytes()[flags_byte::4].translate(KEYFRAME_TABLE))
+                else:
+                    default_flags = self._required_default(tfhd, trex, "default_sample_flags")
+                    keyframes = array("B", [not default_flags & SAMPLE_IS_NON_SYNC_SAMPLE]) * count
+                if trun.first_sample_flags is not None:
+                    keyframes[0] = not trun.first_sample_flags & SAMPLE_IS_NON_SYNC_SAMPLE
+                ticks = decode_ticks
+                if composition_time_offsets is not None:
+                    ticks = map(add, decode_ticks, composition_time_offsets)
+                samples.extend_ticks(offsets, array("q", sizes), ticks, array("q", durations), keyframes,
+                                     track_timescale, presentation_offset)
+
+    @staticmethod
+    def _required_default(tfhd: TrackFragmentHeaderBox, trex: Optional[TrackExtendsBox], field: str) -> int:
+        value = getattr(tfhd, field)
+        if value is None and trex is not None:
+            value = getattr(trex, field)
+        if value is None:
+            raise RuntimeError(f"No {field} for the samples of track {tfhd.track_ID}")
+        return value
+
+    def _scan_fragments(self, reader: ByteReader, moov: MovieBox, start: int, growing: bool,
+                        sharding: Optional[Sharding] = None) -> Tuple[array, Dict[int, array], int]:
+        """
+        Returns the offsets of the fragments from start on, the start times of each track in them by track_ID (in
+        media time, before applying the edit list, in ticks of the track timescale, and NO_TIME in the fragments
+        without samples of the track) and where the data they span ends. With sharding, the times are found by its
+        workers once all the fragments are known.
+        """
+        offsets = array("q")
+        track_ticks = {track.tkhd.track_ID: array("q") for track in moov.tracks}
+        last_end = start
+        with open_walk_reader(reader, sharding) as walk_reader:
+            for header in iter_box_headers(walk_reader, start, reader.end, complete_only=growing):
+                last_end = header.end
+                if header.kind == b"moof":
+                    offsets.append(header.offset)
+                    if sharding is None:
+                        append_fragment_ticks(reader, header, track_ticks)
+        end = reader.end
+        if growing and last_end < reader.end:
+            # A box is still being written. Unless it starts a new fragment, it belongs to the last one, which is
+            # left out until it's complete.
+            end = last_end
+            try:
+                incomplete_kind = read_box_header(reader, last_end).kind
+            except (RuntimeError, struct.error):
+                incomplete_kind = None
+            if incomplete_kind is not None and incomplete_kind != b"moof" and offsets:
+                end = offsets.pop()
+                for ticks in track_ticks.values():
+                    del ticks[len(offsets):]
+
+        if sharding is not None:
+            for shard_ticks in sharding.map(read_fragments_ticks, [offsets], list(track_ticks)):
+                for track_ID, ticks in shard_ticks.items():
+                    track_ticks[track_ID].extend(ticks)
+        return offsets, track_ticks, end
+
+    @staticmethod
+    def _earliest_ticks(offsets: Sequence[int], tracks: Dict[int, TrackTicks]) -> Tuple[List[int], int]:
+        """
+        Returns the start times of multi-track fragments, the earliest of their tracks, in ticks of a timescale that
+        can hold all of them exactly.
+        """
+        timescale = lcm(*(track.timescale for track in tracks.values()),
+                        *(track.time_offset.denominator for track in tracks.values()))
+        columns = [(track.ticks, timescale // track.timescale, int(track.time_offset * timescale))
+                   for track in tracks.values()]
+        ticks = []
+        for i, offset in enumerate(offsets):
+            starts = [column[i] * factor + base for column, factor, base in columns if column[i] != NO_TIME]
+            if not starts:
+                raise RuntimeError(f"No traf of the tracks in moov in moof at {offset}")
+            ticks.append(min(starts))
+        return ticks, timescale
+
+    @staticmethod
+    def _fragment_times(reader: ByteReader, moov: MovieBox,
+                        moof: BoxHeader) -> Tuple[Fraction, Optional[Dict[int, Optional[Fraction]]]]:
+        """
+        Returns the start time of a fragment and, in multi-track files, the one of each track, like
+        find_media_segments() finds them.
+        """
+        if len(moov.tracks) == 1:
+            return Fraction(read_fragment_start(reader, moof), moov.tracks[0].mdia.mdhd.timescale) + \
+                moov.presentation_offset(), None
+        starts = read_fragment_starts(reader, moof)
+        track_times = {track.tkhd.track_ID: Fraction(starts[track.tkhd.track_ID], track.mdia.mdhd.timescale) +
+                       moov.presentation_offset(track) if track.tkhd.track_ID in starts else None
+                       for track in moov.tracks}
+        if all(time is None for time in track_times.values()):
+            raise RuntimeError(f"No traf of the tracks in moov in moof at {moof.offset}")
+        return min(time for time in track_times.values() if time is not None), track_times
+
+    def _can_resume(self, reader: ByteReader, moov: MovieBox, first_moof: BoxHeader,
+                    last_segment: MediaSegment) -> bool:
+        if not first_moof.offset <= last_segment.offset < reader.end:
+            return False
+        try:
+            header = read_box_header(reader, last_segment.offset)
+            if header.kind != b"moof" or header.end > reader.end:
+                return False
+            time, track_times = self._fragment_times(reader, moov, header)
+        except (RuntimeError, struct.error):
+            return False
+        return time == last_segment.time and track_times == last_segment.track_times
+
+    def _fragments_from_index(self, reader: ByteReader, moov: MovieBox, sidx: Optional[BoxHeader],
+                              first_moof: BoxHeader) -> Optional[Fragments]:
+        track = moov.tracks[0]
+        for read_index, earliest in ((lambda: self._fragments_from_sidx(reader, track, sidx), True),
+                                     (lambda: self._fragments_from_mfra(reader, track), False)):
+            try:
+                fragments = read_index()
+                if fragments is not None and self._index_matches(reader, moov, fragments, first_moof, earliest):
+                    return fragments
+            except (RuntimeError, AssertionError, struct.error):
+                # A corrupt index is not fatal, the file is just scanned instead
+                pass
+        return None
+
+    def _fragments_from_sidx(self, reader: ByteReader, track: TrackBox,
+                             sidx_header: Optional[BoxHeader]) -> Optional[Fragments]:
+        if sidx_header is None:
+            return None
+        reader.position = sidx_header.offset
+        sidx = SegmentIndexBox(Box(reader))
+        if sidx.reference_ID != track.tkhd.track_ID or any(ref.reference_type != 0 for ref in sidx.references):
+            # Indexes of other tracks and hierarchical indexes are not supported
+            return None
+
+        offsets = array("q")
+        ticks = array("q")
+        offset = sidx_header.end + sidx.first_offset
+        time = sidx.earliest_presentation_time
+        for reference in sidx.references:
+            offsets.append(offset)
+            ticks.append(time)
+            offset += reference.referenced_size
+            time += reference.subsegment_duration
+        return offsets, ticks, sidx.timescale
+
+    def _fragments_from_mfra(self, reader: ByteReader, track: TrackBox) -> Optional[Fragments]:
+        if reader.size < 16:
+            return None
+        mfro_header = read_box_header(reader, reader.end - 16)
+        if mfro_header.kind != b"mfro" or mfro_header.end != reader.end:
+            return None
+        reader.position = mfro_header.offset
+        mfra_offset = reader.end - MovieFragmentRandomAccessOffsetBox(Box(reader)).mfra_size
+        if mfra_offset < reader.start:
+            return None
+        reader.position = mfra_offset
+        mfra = Box(reader)
+        if mfra.kind != b"mfra" or mfra.offset + mfra.full_size != reader.end:
+            return None
+        tfras = [TrackFragmentRandomAccessBox(box) for box in find_boxes(mfra, b"tfra")]
+        tfra = next((tfra for tfra in tfras if tfra.track_ID == track.tkhd.track_ID), None)
+        if tfra is None:
+            return None
+
+        offsets = array("q")
+        ticks = array("q")
+        for entry in tfra.entries:
+            if offsets and entry.moof_offset == offsets[-1]:
+                continue  # other sync samples of the same fragment
+            if (entry.traf_number, entry.trun_number, entry.sample_number) != (1, 1, 1):
+                # The entry doesn't give the time of the start of the fragment
+                return None
+            offsets.append(entry.moof_offset)
+            ticks.append(entry.time)
+        return offsets, ticks, track.mdia.mdhd.timescale
+
+    @staticmethod
+    def _index_lists_every_fragment(reader: ByteReader, offsets: Sequence[int]) -> bool:
+        """
+        Whether each indexed offset starts a moof whose mfhd sequence number follows the one of the previous indexed
+        moof, as tfra only lists the fragments with sync samples. Only the start of each moof is read.
+        """
+        previous = None
+        for offset in offsets:
+            start = reader.read_at(offset, 24)
+            if len(start) < 24 or start[4:8] != b"moof" or start[12:16] != b"mfhd":
+                return False
+            sequence_number = parse_big_endian_number(start[20:24])
+            if previous is not None and sequence_number != previous + 1:
+                return False
+            previous = sequence_number
+        return True
+
+    def _fragment_earliest_start(self, reader: ByteReader, moov: MovieBox, moof_header: BoxHeader) -> int:
+        """The smallest composition time of the samples of the first track in a moof, which sidx gives with B-frames."""
+        track_id = moov.tracks[0].tkhd.track_ID
+        reader.position = moof_header.offset
+        moof = MovieFragmentBox(Box(reader))
+        traf = next((traf for traf in moof.trafs if traf.tfhd.track_ID == track_id), None)
+        if traf is None:
+            raise RuntimeError(f"Could not find traf of track {track_id} in moof at {moof_header.offset}")
+        trex = moov.find_track_extends(track_id)
+        decode_time = traf.tfdt.base_media_decode_time
+        starts = []
+        for trun in traf.truns:
+            durations, _, _, composition_time_offsets = trun.read_samples()
+            if durations is None:
+                durations = array(UINT32, [self._required_default(traf.tfhd, trex, "default_sample_duration")]) * \
+                    trun.sample_count
+            decode_ticks = array("q", accumulate(durations, initial=decode_time))
+            decode_time = decode_ticks.pop()
+            ticks = decode_ticks
+            if composition_time_offsets is not None:
+                ticks = map(add, decode_ticks, composition_time_offsets)
+            if trun.sample_count:
+                starts.append(min(ticks))
+        if not starts:
+            raise RuntimeError(f"Could not find samples of track {track_id} in moof at {moof_header.offset}")
+        return min(starts)
+
+    def _index_matches(self, reader: ByteReader, moov: MovieBox, fragments: Fragments, first_moof: BoxHeader,
+                       earliest: bool) -> bool:
+        """
+        Whether the index lists every fragment, checking the bounds and start time of a sample of them. sidx gives the
+        earliest presentation time of each fragment, mfra the one of its first sample.
+        """
+        offsets, ticks, timescale = fragments
+        if not offsets or offsets[0] != first_moof.offset or offsets[-1] >= reader.end:
+            return False
+        if any(offset >= next_offset for offset, next_offset in zip(offsets, offsets[1:])):
+            return False
+        if not self._index_lists_every_fragment(reader, offsets):
+            return False
+
+        # Each checked fragment must be exactly one moof and whatever follows it until the next indexed fragment, and
+        # have the indexed start time.
         track_timescale = moov.tracks[0].mdia.mdhd.timescale
-        return Fraction(traf.tfdt.base_media_decode_time + traf.truns[0].first_sample_composition_time_offset,
-                        track_timescale) + moov.presentation_offset()
+        count = len(offsets)
+        checked = {0, count - 1} | {count * (i + 1) // (self.INDEX_CHECK_SAMPLES + 1)
+                                    for i in range(self.INDEX_CHECK_SAMPLES)}
+        for i in sorted(checked):
+            end = offsets[i + 1] if i + 1 < count else reader.end
+            headers = list(iter_box_headers(reader, offsets[i], end))
+            if headers[0].kind != b"moof" or headers[-1].end != end or \
+                    any(header.kind == b"moof" for header in headers[1:]):
+                return False
+            if earliest:
+                start = self._fragment_earliest_start(reader, moov, headers[0])
+            else:
+                start = read_fragment_start(reader, headers[0])
+            if Fraction(start, track_timescale) != Fraction(ticks[i], timescale):
+                return False
+        return True
+
+
+class TestBoxes(TestCase):
+    def test_children(self):
+        from synthetic import mp4_box as box
+
+        reader = FileByteReader(BytesIO(box(b"traf", box(b"tfhd") + box(b"trun", b"1") + box(b"trun", b"2"))))
+        traf = Box(reader)
+        self.assertEqual([b"tfhd", b"trun"], list(traf.children))
+        truns = find_boxes(traf, b"trun")
+        self.assertEqual([b"1", b"2"], [trun.reader.read() for trun in truns])
+        self.assertIs(truns[0], find_box(traf, b"trun"))
+        self.assertIsNone(find_box(traf, b"tfdt"))
+        with self.assertRaises(RuntimeError):
+            find_box(traf, b"tfdt", required=True)
+
+
+class TestTrackRun(TestCase):
+    def test_read_samples(self):
+        from synthetic import mp4_full_box as full_box
+
+        tfhd = TrackFragmentHeaderBox(Box(FileByteReader(BytesIO(full_box(
+            b"tfhd", 0, TFFlags.DEFAULT_SAMPLE_DURATION_PRESENT | TFFlags.DEFAULT_SAMPLE_FLAGS_PRESENT,
+            struct.pack(">III", 2, 1001, SAMPLE_IS_NON_SYNC_SAMPLE))))))
+        self.assertEqual((2, None, 1001, None, SAMPLE_IS_NON_SYNC_SAMPLE),
+                         (tfhd.track_ID, tfhd.base_data_offset, tfhd.default_sample_duration,
+                          tfhd.default_sample_size, tfhd.default_sample_flags))
+
+        tr_flags = TRFlags.DATA_OFFSET_PRESENT | TRFlags.FIRST_SAMPLE_FLAGS_PRESENT | TRFlags.SAMPLE_SIZE_PRESENT | \
+            TRFlags.SAMPLE_COMPOSITION_TIME_OFFSETS_PRESENT
+        payload = struct.pack(">IiI", 3, 100, 0) + struct.pack(">IiIiIi", 10, 2002, 20, -1001, 30, 0)
+        trun = TrackRunBox(Box(FileByteReader(BytesIO(full_box(b"trun", 1, tr_flags, payload)))))
+        self.assertEqual((100, 0, 2002), (trun.data_offset, trun.first_sample_flags,
+                                          trun.first_sample_composition_time_offset))
+        durations, sizes, flags, composition_time_offsets = trun.read_samples()
+        self.assertIsNone(durations)
+        self.assertIsNone(flags)
+        self.assertEqual([10, 20, 30], sizes.tolist())
+        self.assertEqual([2002, -1001, 0], composition_time_offsets.tolist())
 
 
 class TestCar(TestCase):
     def test_car(self):
-        print(jsonify(MP4Parser().find_media_segments(FileByteReader(open("media/car-20120827-86.mp4", "rb")))))
+        print(jsonify(MP4Parser().find_media_segments(open_file_reader("media/car-20120827-86.mp4"))))
@@ -1,41 +1,477 @@
 import json
 from abc import ABCMeta, abstractmethod
+from array import array
+from bisect import bisect_right
+from collections.abc import Sequence
+from concurrent.futures import Executor
+from contextlib import contextmanager
 from fractions import Fraction
-from typing import List
+from itertools import repeat
+from math import floor, lcm
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Union
+from unittest import TestCase
 
-from bytereader import ByteReader
+from bytereader import AsyncByteReader, ByteReader, FileByteReader, open_file_reader
 
 
 class WrongFile(Exception):
     pass
 
 
+# Start tick of a track in the segments without samples of it
+NO_TIME = -2 ** 63
+
+
 class MediaSegment:
-    def __init__(self, offset: int, size: int, time: Fraction):
+    def __init__(self, offset: int, size: int, time: Fraction,
+                 track_times: Optional[Dict[int, Optional[Fraction]]] = None):
         self.offset = offset
         self.size = size
         self.time = time
+        # Only for multi-track files: the start time of each track by ID, None when the segment has no samples of it
+        self.track_times = track_times
 
     def to_dict(self):
-        return {
+        segment = {
             "offset": self.offset,
             "size": self.size,
             "timestamp": float(self.time)
         }
+        if self.track_times is not None:
+            segment["tracks"] = {track: float(time) if time is not None else None
+                                 for track, time in self.track_times.items()}
+        return segment
+
+
+class TrackTicks(NamedTuple):
+    """Start times of a track in segments added with SegmentTable.extend_ticks(), NO_TIME where it has no samples."""
+    ticks: Iterable[int]
+    timescale: int
+    time_offset: Fraction = Fraction(0)
+
+
+class SegmentTable(Sequence):
+    """
+    Media segments stored as columns of 64-bit integers: offsets and sizes in bytes, and start times in ticks of a
+    timescale shared by all of them, which grows as needed to keep every time exact. MediaSegment objects are only
+    created when indexing or iterating.
+
+    Tables of multi-track files also have a column of start ticks for each track by ID in track_ticks, with NO_TIME
+    for the segments without samples of the track. All the segments of a table have the same tracks.
+    """
+
+    def __init__(self, timescale: int = 1):
+        self.timescale = timescale
+        self.offsets = array("q")
+        self.sizes = array("q")
+        self.ticks = array("q")
+        self.track_ticks: Dict[int, Sequence] = {}
+
+    @classmethod
+    def from_columns(cls, offsets: Sequence, sizes: Sequence, ticks: Sequence, timescale: int,
+                     track_ticks: Optional[Dict[int, Sequence]] = None) -> "SegmentTable":
+        """
+        Creates a table using the given columns as they are, which can be any sequences of integers, like memoryviews
+        of a mapped file. Tables with read-only columns can't be appended to.
+        """
+        assert len(offsets) == len(sizes) == len(ticks)
+        assert all(len(column) == len(offsets) for column in (track_ticks or {}).values())
+        table = cls(timescale)
+        table.offsets = offsets
+        table.sizes = sizes
+        table.ticks = ticks
+        table.track_ticks = dict(track_ticks or {})
+        return table
+
+    @classmethod
+    def from_segments(cls, segments: Iterable[MediaSegment]) -> "SegmentTable":
+        table = cls()
+        table.extend(segments)
+        return table
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[MediaSegment, "SegmentTable"]:
+        if isinstance(index, slice):
+            return SegmentTable.from_columns(self.offsets[index], self.sizes[index], self.ticks[index], self.timescale,
+                                             {track: ticks[index] for track, ticks in self.track_ticks.items()})
+        return MediaSegment(self.offsets[index], self.sizes[index], Fraction(self.ticks[index], self.timescale),
+                            self.track_times(index))
+
+    def __add__(self, other: Iterable[MediaSegment]) -> "SegmentTable":
+        table = SegmentTable()
+        table.extend(self)
+        table.extend(other)
+        return table
+
+    def _set_timescale(self, timescale: int):
+        if timescale != self.timescale:
+            assert timescale % self.timescale == 0
+            factor = timescale // self.timescale
+            self.ticks = array("q", (ticks * factor for ticks in self.ticks))
+            self.track_ticks = {track: array("q", (value * factor if value != NO_TIME else NO_TIME for value in ticks))
+                                for track, ticks in self.track_ticks.items()}
+            self.timescale = timescale
+
+    def _check_tracks(self, tracks: Iterable[int]):
+        tracks = sorted(tracks)
+        if not self:
+            self.track_ticks = {track: array("q") for track in tracks}
+        elif tracks != sorted(self.track_ticks):
+            raise ValueError(f"Segments with times for tracks {tracks} added to a table with tracks "
+                             f"{sorted(self.track_ticks)}")
+
+    def append(self, offset: int, size: int, time: Fraction,
+               track_times: Optional[Dict[int, Optional[Fraction]]] = None):
+        time = Fraction(time)
+        self._check_tracks(track_times or {})
+        track_times = {track: Fraction(time) for track, time in (track_times or {}).items() if time is not None}
+        self._set_timescale(lcm(self.timescale, time.denominator, *(time.denominator for time in track_times.values())))
+        self.offsets.append(offset)
+        self.sizes.append(size)
+        self.ticks.append(int(time * self.timescale))
+        for track, ticks in self.track_ticks.items():
+            ticks.append(int(track_times[track] * self.timescale) if track in track_times else NO_TIME)
+
+    def extend(self, segments: Iterable[MediaSegment]):
+        if isinstance(segments, SegmentTable):
+            self.extend_ticks(segments.offsets, segments.sizes, segments.ticks, segments.timescale,
+                              tracks={track: TrackTicks(ticks, segments.timescale)
+                                      for track, ticks in segments.track_ticks.items()})
+            return
+        for segment in segments:
+            self.append(segment.offset, segment.size, segment.time, segment.track_times)
+
+    def extend_ticks(self, offsets: Iterable[int], sizes: Iterable[int], ticks: Iterable[int], timescale: int,
+                     time_offset: Fraction = Fraction(0), tracks: Optional[Dict[int, TrackTicks]] = None):
+        """
+        Appends segments starting at ticks of timescale plus time_offset, without a Fraction for each of them, and
+        with the start times of each track in multi-track files.
+        """
+        tracks = tracks or {}
+        self._check_tracks(tracks)
+        self._set_timescale(lcm(self.timescale, timescale, time_offset.denominator,
+                                *(track.timescale for track in tracks.values()),
+                                *(track.time_offset.denominator for track in tracks.values())))
+        factor = self.timescale // timescale
+        base = int(time_offset * self.timescale)
+        self.offsets.extend(offsets)
+        self.sizes.extend(sizes)
+        self.ticks.extend(value * factor + base for value in ticks)
+        for track, track_ticks in tracks.items():
+            factor = self.timescale // track_ticks.timescale
+            base = int(track_ticks.time_offset * self.timescale)
+            self.track_ticks[track].extend(value * factor + base if value != NO_TIME else NO_TIME
+                                           for value in track_ticks.ticks)
+        assert len(self.offsets) == len(self.sizes) == len(self.ticks)
+        assert all(len(column) == len(self.offsets) for column in self.track_ticks.values())
+
+    def time(self, index: int) -> Fraction:
+        return Fraction(self.ticks[index], self.timescale)
+
+    def track_times(self, index: int) -> Optional[Dict[int, Optional[Fraction]]]:
+        """Start times of each track in a segment, None for single-track files."""
+        if not self.track_ticks:
+            return None
+        return {track: Fraction(ticks[index], self.timescale) if ticks[index] != NO_TIME else None
+                for track, ticks in self.track_ticks.items()}
+
+    def find_time(self, time: Union[Fraction, float]) -> Optional[int]:
+        """
+        Returns the index of the segment containing a time: the last one starting at or before it, as segments have
+        no end time. None if it's before the first one.
+        """
+        index = bisect_right(self.ticks, floor(time * self.timescale)) - 1
+        return index if index >= 0 else None
+
+    def find_offset(self, offset: int) -> Optional[int]:
+        """Returns the index of the segment containing a byte offset, None if there is none."""
+        index = bisect_right(self.offsets, offset) - 1
+        if index < 0 or offset >= self.offsets[index] + self.sizes[index]:
+            return None
+        return index
+
+    def to_list(self):
+        segments = [{"offset": offset, "size": size, "timestamp": ticks / self.timescale}
+                    for offset, size, ticks in zip(self.offsets, self.sizes, self.ticks)]
+        for track, track_ticks in self.track_ticks.items():
+            for segment, ticks in zip(segments, track_ticks):
+                segment.setdefault("tracks", {})[track] = ticks / self.timescale if ticks != NO_TIME else None
+        return segments
+
+
+class SampleTable:
+    """
+    Deep index of the samples (or blocks) of a file as columns: offset and size of their data in bytes, presentation
+    time and duration in ticks of a timescale, which grows like the one of SegmentTable, and whether they are
+    keyframes. segment_starts holds the index of the first sample of each media segment.
+    """
+
+    def __init__(self, timescale: int = 1):
+        self.timescale = timescale
+        self.offsets = array("q")
+        self.sizes = array("q")
+        self.ticks = array("q")
+        self.durations = array("q")
+        self.keyframes = array("B")
+        self.segment_starts = array("q")
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def _set_timescale(self, timescale: int):
+        if timescale != self.timescale:
+            assert timescale % self.timescale == 0
+            factor = timescale // self.timescale
+            self.ticks = array("q", (ticks * factor for ticks in self.ticks))
+            self.durations = array("q", (duration * factor for duration in self.durations))
+            self.timescale = timescale
+
+    def start_segment(self):
+        """The samples added from now on belong to a new media segment."""
+        self.segment_starts.append(len(self))
+
+    def extend(self, other: "SampleTable"):
+        """Appends the samples and media segments of another table, e.g. indexed from a later part of the file."""
+        self.segment_starts.extend(start + len(self) for start in other.segment_starts)
+        self.extend_ticks(other.offsets, other.sizes, other.ticks, other.durations, other.keyframes, other.timescale)
+
+    def extend_ticks(self, offsets: Iterable[int], sizes: Iterable[int], ticks: Iterable[int],
+                     durations: Iterable[int], keyframes: Iterable[bool], timescale: int,
+                     time_offset: Fraction = Fraction(0)):
+        self._set_timescale(lcm(self.timescale, timescale, time_offset.denominator))
+        factor = self.timescale // timescale
+        base = int(time_offset * self.timescale)
+        self.offsets.extend(offsets)
+        self.sizes.extend(sizes)
+        if factor == 1 and base == 0:
+            self.ticks.extend(ticks)
+            self.durations.extend(durations)
+        else:
+            self.ticks.extend(value * factor + base for value in ticks)
+            self.durations.extend(duration * factor for duration in durations)
+        self.keyframes.extend(keyframes)
+        assert len(self.offsets) == len(self.sizes) == len(self.ticks) == len(self.durations) == len(self.keyframes)
+
+    def time(self, index: int) -> Fraction:
+        return Fraction(self.ticks[index], self.timescale)
+
+    def segment_samples(self, segment: int) -> range:
+        end = self.segment_starts[segment + 1] if segment + 1 < len(self.segment_starts) else len(self)
+        return range(self.segment_starts[segment], end)
+
+    def segment_keyframes(self, segment: int) -> List[int]:
+        """Indexes of the keyframes of a media segment."""
+        return [index for index in self.segment_samples(segment) if self.keyframes[index]]
+
+    def to_dict(self):
+        return {
+            "timescale": self.timescale,
+            "segments": [{
+                "first_sample": samples.start,
+                "sample_count": len(samples),
+                "keyframes": [{"offset": self.offsets[index], "timestamp": self.ticks[index] / self.timescale}
+                              for index in samples if self.keyframes[index]],
+            } for samples in map(self.segment_samples, range(len(self.segment_starts)))],
+            "samples": {
+                "offsets": self.offsets.tolist(),
+                "sizes": self.sizes.tolist(),
+                "ticks": self.ticks.tolist(),
+                "durations": self.durations.tolist(),
+                "keyframes": self.keyframes.tolist(),
+            },
+        }
+
+
+class Sharding(NamedTuple):
+    """
+    Spreads the parsing of a big file over the workers of executor, e.g. a ProcessPoolExecutor. The parser only walks
+    the top-level headers to find the segments, which are split into shards of contiguous segments parsed by the
+    workers, each opening file_path itself.
+    """
+    file_path: str
+    executor: Executor
+    shards: int
+
+    def map(self, function: Callable, columns: Sequence[Sequence], *args) -> Iterator:
+        """
+        Yields the results of function(file_path, *shard_columns, *args) in order for each shard of the columns,
+        slices with about the same number of segments.
+        """
+        count = len(columns[0])
+        if count == 0:
+            return iter(())
+        shard_size = -(-count // self.shards)
+        shards = [[column[start:start + shard_size] for column in columns] for start in range(0, count, shard_size)]
+        return self.executor.map(function, repeat(self.file_path), *zip(*shards), *map(repeat, args))
+
+
+@contextmanager
+def open_walk_reader(reader: ByteReader, sharding: Optional[Sharding]) -> Iterator[ByteReader]:
+    """
+    Reader for walking the top-level headers of a file, reader itself unless sharding. Then only the headers are read
+    here, which is faster with a direct read of each one than through a cache of blocks that are used once.
+    """
+    if sharding is None:
+        yield reader
+        return
+    walk_reader = FileByteReader(open(sharding.file_path, "rb", buffering=0))
+    try:
+        yield walk_reader
+    finally:
+        walk_reader.close()
 
 
 class MSEParser(metaclass=ABCMeta):
     @abstractmethod
-    def find_media_segments(self, reader: ByteReader) -> List[MediaSegment]:
+    def find_media_segments(self, reader: ByteReader, previous: Optional[Sequence[MediaSegment]] = None,
+                            growing: bool = False, sharding: Optional[Sharding] = None) -> SegmentTable:
+        """
+        previous can be the result of parsing an earlier version of the same file that has been appended to since.
+        When its last segment is still in place, the file is only parsed from there on.
+
+        growing must be set when the file may still be being written. Segments that are not complete yet are left
+        out, instead of running to the end of the file.
+
+        sharding, for a reader of its file, spreads the parsing of the segments found by scanning over its workers.
+        """
+        pass
+
+    def find_media_segments_sharded(self, file_path: str, executor: Executor, shards: int,
+                                    previous: Optional[Sequence[MediaSegment]] = None) -> SegmentTable:
+        """find_media_segments() for a big file, parsing shards of it in the workers of executor."""
+        return self.find_media_segments(open_file_reader(file_path), previous,
+                                        sharding=Sharding(file_path, executor, shards))
+
+    @abstractmethod
+    def iter_media_segments(self, reader: ByteReader, keep_data: bool = False) -> Iterator[MediaSegment]:
+        """
+        Yields the media segments as they are found, reading only forward so that it works on streams like pipes.
+        With keep_data, the data of a segment and everything before the first one can still be read when it is
+        yielded, the reader is allowed to release it once the iteration goes on. Otherwise everything is released as
+        soon as it has been parsed, so that a stream doesn't keep whole segments in memory.
+        """
+        pass
+
+    async def find_media_segments_async(self, reader: AsyncByteReader,
+                                        previous: Optional[Sequence[MediaSegment]] = None,
+                                        growing: bool = False) -> SegmentTable:
+        """
+        find_media_segments() for asyncio code, parsing in the executor of the reader. The whole parse is a single
+        executor call, which holds the lock of the reader until it's done: other calls on the same reader wait for it,
+        and no segment is available before all of them are. iter_media_segments_async() yields them as they are found.
+        """
+        return await reader.run(self.find_media_segments, reader.reader, previous, growing)
+
+    async def iter_media_segments_async(self, reader: AsyncByteReader,
+                                        keep_data: bool = False) -> AsyncIterator[MediaSegment]:
+        """
+        iter_media_segments() for asyncio code. Each segment is found in the executor of the reader, and the event
+        loop runs other tasks between segments, like reading the data of the last one with reader.read_at().
+        """
+        iterator = self.iter_media_segments(reader.reader, keep_data)
+        try:
+            while True:
+                segment = await reader.run(next, iterator, None)
+                if segment is None:
+                    return
+                yield segment
+        finally:
+            await reader.run(iterator.close)
+
+    @abstractmethod
+    def find_samples(self, reader: ByteReader, sharding: Optional[Sharding] = None) -> SampleTable:
+        """
+        Deep index of the samples of the file, finding the same media segments as find_media_segments() when it
+        scans the whole file.
+        """
         pass
 
+    def find_samples_sharded(self, file_path: str, executor: Executor, shards: int) -> SampleTable:
+        """find_samples() for a big file, indexing shards of it in the workers of executor."""
+        return self.find_samples(open_file_reader(file_path), Sharding(file_path, executor, shards))
+
 
 class CustomizableJsonEncoder(json.JSONEncoder):
     def default(self, obj):
         if hasattr(obj, "to_dict"):
             return obj.to_dict()
+        if hasattr(obj, "to_list"):
+            return obj.to_list()
         return super().default(obj)
 
 
-def jsonify(thing):
+def jsonify(thing, compact: bool = False):
+    if compact:
+        return json.dumps(thing, cls=CustomizableJsonEncoder, separators=(",", ":"))
     return json.dumps(thing, cls=CustomizableJsonEncoder, indent=4)
+
+
+class TestSegmentTable(TestCase):
+    def test_segment_table(self):
+        media_segments = SegmentTable()
+        media_segments.append(100, 50, Fraction(0))
+        media_segments.extend_ticks([150, 230], [80, 70], [90, 180], 90, time_offset=Fraction(1, 3))
+        self.assertEqual(90, media_segments.timescale)
+        self.assertEqual([Fraction(0), Fraction(4, 3), Fraction(7, 3)], [segment.time for segment in media_segments])
+        media_segments.append(300, 10, Fraction(1001, 300))
+        self.assertEqual(Fraction(1001, 300), media_segments[-1].time)
+        self.assertEqual(Fraction(4, 3), media_segments.time(1))
+
+        self.assertIsNone(media_segments.find_time(Fraction(-1)))
+        self.assertEqual(0, media_segments.find_time(1.3))
+        self.assertEqual(1, media_segments.find_time(Fraction(4, 3)))
+        self.assertEqual(3, media_segments.find_time(100))
+        self.assertIsNone(media_segments.find_offset(99))
+        self.assertEqual(1, media_segments.find_offset(229))
+        self.assertIsNone(media_segments.find_offset(310))
+
+        combined = media_segments[:2] + [MediaSegment(230, 70, Fraction(7, 3))]
+        self.assertEqual([(150, 80), (230, 70)], [(segment.offset, segment.size) for segment in combined[1:]])
+        self.assertEqual(jsonify([segment for segment in media_segments]), jsonify(media_segments))
+
+    def test_track_times(self):
+        media_segments = SegmentTable()
+        media_segments.extend_ticks([100, 200], [100, 100], [0, 1000], 1000, tracks={
+            1: TrackTicks([0, 90_000], 90_000),
+            2: TrackTicks([-1024, NO_TIME], 48_000, time_offset=Fraction(1, 1000)),
+        })
+        self.assertEqual(720_000, media_segments.timescale)
+        self.assertEqual({1: Fraction(0), 2: Fraction(-1024, 48_000) + Fraction(1, 1000)},
+                         media_segments[0].track_times)
+        self.assertEqual({1: Fraction(1), 2: None}, media_segments[1].track_times)
+        media_segments.append(300, 50, Fraction(2), {1: Fraction(2), 2: None})
+        media_segments.append(350, 50, Fraction(3), {1: Fraction(3), 2: Fraction(1001, 500)})
+        self.assertEqual({1: Fraction(3), 2: Fraction(1001, 500)}, media_segments[-1].track_times)
+        self.assertEqual(jsonify([segment for segment in media_segments]), jsonify(media_segments))
+        self.assertEqual(media_segments.track_ticks, (SegmentTable() + media_segments[:2] + media_segments[2:])
+                         .track_ticks)
+        with self.assertRaises(ValueError):
+            media_segments.append(400, 50, Fraction(4))
+
+
+class TestSampleTable(TestCase):
+    def test_sample_table(self):
+        samples = SampleTable()
+        samples.start_segment()
+        samples.extend_ticks([100, 110, 130], [10, 20, 5], [0, 2, 1], [1, 1, 1], [True, False, False], 2)
+        samples.start_segment()
+        samples.extend_ticks([135], [15], [9], [3], [True], 6, time_offset=Fraction(1, 3))
+        self.assertEqual(6, samples.timescale)
+        self.assertEqual([0, 6, 3, 11], samples.ticks.tolist())
+        self.assertEqual([3, 3, 3, 3], samples.durations.tolist())
+        self.assertEqual(Fraction(11, 6), samples.time(3))
+        self.assertEqual(range(0, 3), samples.segment_samples(0))
+        self.assertEqual([0], samples.segment_keyframes(0))
+        self.assertEqual([3], samples.segment_keyframes(1))
+        self.assertEqual({"first_sample": 3, "sample_count": 1, "keyframes": [{"offset": 135, "timestamp": 11 / 6}]},
+                         samples.to_dict()["segments"][1])
+
+        first, second = SampleTable(), SampleTable()
+        first.start_segment()
+        first.extend_ticks([100, 110, 130], [10, 20, 5], [0, 2, 1], [1, 1, 1], [True, False, False], 2)
+        second.start_segment()
+        second.extend_ticks([135], [15], [9], [3], [True], 6, time_offset=Fraction(1, 3))
+        first.extend(second)
+        self.assertEqual(samples.to_dict(), first.to_dict())
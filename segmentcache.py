@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+from fractions import Fraction
+from tempfile import TemporaryDirectory
+from typing import Optional, Sequence
+from unittest import TestCase
+from unittest.mock import patch
+
+from mseparser import MediaSegment, SegmentTable, TrackTicks
+
+
+class SegmentCache:
+    """
+    On-disk cache of the media segments found in files, so that unchanged files don't have to be parsed again.
+
+    There is one entry per file path, which is only used while the file keeps the same size, mtime and fingerprint
+    (a hash of its first and last bytes). When there are more than max_entries entries, evict() removes the least
+    recently used ones.
+    """
+
+    FINGERPRINT_SIZE = 64 * 1024
+
+    def __init__(self, directory: str, max_entries: int = 100_000):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry_path(self, file_path: str) -> str:
+        key = hashlib.sha1(os.path.abspath(file_path).encode("utf-8", "surrogateescape")).hexdigest()
+        return os.path.join(self.directory, key + ".json")
+
+    def identity(self, file_path: str) -> dict:
+        """
+        What a cache entry is only used with. It should be taken before parsing the file and given to put(), so that
+        a file that changes during the parse isn't cached as the version parsed.
+        """
+        with open(file_path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            head = f.read(self.FINGERPRINT_SIZE)
+            f.seek(max(0, stat.st_size - self.FINGERPRINT_SIZE))
+            tail = f.read(self.FINGERPRINT_SIZE)
+        return {
+            "path": os.path.abspath(file_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "head": hashlib.sha1(head).hexdigest(),
+            "tail": hashlib.sha1(tail).hexdigest(),
+        }
+
+    def _load_entry(self, file_path: str) -> Optional[dict]:
+        try:
+            with open(self._entry_path(file_path)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Entries written in older formats, with a list per segment or without the times of each track, are ignored
+        return entry if isinstance(entry.get("segments"), dict) and "tracks" in entry["segments"] else None
+
+    def get(self, file_path: str, identity: Optional[dict] = None) -> Optional[SegmentTable]:
+        entry = self._load_entry(file_path)
+        if entry is None or entry["identity"] != (identity or self.identity(file_path)):
+            return None
+        os.utime(self._entry_path(file_path))  # mark as recently used
+        return self._segments(entry)
+
+    @staticmethod
+    def _segments(entry: dict) -> SegmentTable:
+        segments = entry["segments"]
+        media_segments = SegmentTable()
+        media_segments.extend_ticks(segments["offsets"], segments["sizes"], segments["ticks"], segments["timescale"],
+                                    tracks={int(track): TrackTicks(ticks, segments["timescale"])
+                                            for track, ticks in segments["tracks"].items()})
+        return media_segments
+
+    def get_appended(self, file_path: str) -> Optional[SegmentTable]:
+        """
+        Returns the segments cached for an earlier version of the file when it may have only been appended to since,
+        for MSEParser.find_media_segments(previous=...) to check and resume from.
+        """
+        entry = self._load_entry(file_path)
+        if entry is None:
+            return None
+        previous_size = entry["identity"]["size"]
+        with open(file_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < previous_size:
+                return None
+            # The head fingerprint covers the whole file when it is small, so only hash what was there before
+            head = f.read(min(self.FINGERPRINT_SIZE, previous_size))
+        if hashlib.sha1(head).hexdigest() != entry["identity"]["head"]:
+            return None
+        return self._segments(entry)
+
+    def put(self, file_path: str, media_segments: Sequence[MediaSegment], identity: Optional[dict] = None):
+        if not isinstance(media_segments, SegmentTable):
+            media_segments = SegmentTable.from_segments(media_segments)
+        entry = {
+            "identity": identity or self.identity(file_path),
+            "segments": {
+                "timescale": media_segments.timescale,
+                "offsets": media_segments.offsets.tolist(),
+                "sizes": media_segments.sizes.tolist(),
+                "ticks": media_segments.ticks.tolist(),
+                "tracks": {track: ticks.tolist() for track, ticks in media_segments.track_ticks.items()},
+            },
+        }
+        # Written to a temporary file first, so that concurrent readers never see a partial entry
+        entry_path = self._entry_path(file_path)
+        temporary_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(entry, f, separators=(",", ":"))
+        os.replace(temporary_path, entry_path)
+
+    def evict(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for dir_entry in it:
+                if dir_entry.name.endswith(".json"):
+                    entries.append((dir_entry.stat().st_mtime_ns, dir_entry.path))
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class TestSegmentCache(TestCase):
+    def test_cache(self):
+        with TemporaryDirectory() as directory:
+            cache = SegmentCache(os.path.join(directory, "cache"), max_entries=1)
+            media_path = os.path.join(directory, "media.mp4")
+            with open(media_path, "wb") as f:
+                f.write(bytes(100))
+
+            self.assertIsNone(cache.get(media_path))
+            segments = [MediaSegment(10, 50, Fraction(0), {1: Fraction(0), 2: None}),
+                        MediaSegment(60, 40, Fraction(1001, 30000), {1: Fraction(1001, 30000), 2: Fraction(1, 30)})]
+            cache.put(media_path, segments)
+            self.assertEqual([(s.offset, s.size, s.time, s.track_times) for s in segments],
+                             [(s.offset, s.size, s.time, s.track_times) for s in cache.get(media_path)])
+
+            with open(media_path, "ab") as f:
+                f.write(b"more")
+            self.assertIsNone(cache.get(media_path))
+            self.assertEqual(2, len(cache.get_appended(media_path)))
+
+            other_path = os.path.join(directory, "other.mp4")
+            with open(other_path, "wb") as f:
+                f.write(bytes(10))
+            cache.put(media_path, segments)
+            os.utime(cache._entry_path(media_path), ns=(0, 0))
+            cache.put(other_path, segments)
+            cache.evict()
+            self.assertIsNone(cache.get(media_path))
+            self.assertIsNotNone(cache.get(other_path))
+
+    def test_changed_during_parse(self):
+        from manifestgen import find_segments
+        from mp4 import MP4Parser
+        from synthetic import write_file
+
+        with TemporaryDirectory() as directory:
+            cache = SegmentCache(os.path.join(directory, "cache"))
+            media_path = os.path.join(directory, "media.mp4")
+            write_file(media_path, 3)
+            find_media_segments = MP4Parser.find_media_segments
+
+            def rewrite_and_parse(parser, *args, **kwargs):
+                # The file is parsed as it was, then replaced before the segments are cached
+                media_segments = find_media_segments(parser, *args, **kwargs)
+                write_file(media_path, 4)
+                return media_segments
+
+            with patch.object(MP4Parser, "find_media_segments", rewrite_and_parse):
+                self.assertEqual(3, len(find_segments(media_path, cache)[0]))
+            self.assertIsNone(cache.get(media_path))
+            media_segments, cached = find_segments(media_path, cache)
+            self.assertEqual((4, False), (len(media_segments), cached))
+            media_segments, cached = find_segments(media_path, cache)
+            self.assertEqual((4, True), (len(media_segments), cached))
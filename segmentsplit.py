@@ -1,14 +1,190 @@
 #!/usr/bin/python3
+import errno
+import fcntl
+import hashlib
+import json
 import os
+import re
+import struct
 import sys
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from tempfile import TemporaryDirectory
+from typing import Dict, List, NamedTuple, Optional
+from unittest import TestCase
 
-from bytereader import FileByteReader
+import instrumentation
+from bytereader import StreamByteReader, open_file_reader
+from manifestgen import parser_for_stream
 from matroska import MatroskaParser
 from mp4 import MP4Parser
 
 
-def split_segments(file_path, base_dir):
+COPY_CHUNK_SIZE = 1024 * 1024
+DIGEST_ALGORITHM = "sha256"
+# Sidecar file with the size and digest of each segment file
+CHECKSUMS_NAME = "checksums.json"
+SEGMENT_NAME = re.compile(r"(init|media[0-9]+)\.(mp4|webm)")
+# ioctl cloning a range of a file into another one, sharing their extents, from linux/fs.h
+FICLONERANGE = 0x4020940D
+# Errors meaning that a way of copying is not available for these files, rather than that the copy failed
+UNSUPPORTED_COPY_ERRORS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF}
+
+
+def clone_range(src_fd: int, dst_fd: int, offset: int, size: int) -> bool:
+    """
+    Makes [offset, offset + size) of src the content of dst by sharing its extents, without copying any data. Only
+    possible on filesystems supporting it (like Btrfs or XFS) and when the range is aligned to their blocks, returns
+    whether it could be done.
+    """
+    try:
+        fcntl.ioctl(dst_fd, FICLONERANGE, struct.pack("=qQQQ", src_fd, offset, size, 0))
+    except OSError as e:
+        if e.errno in UNSUPPORTED_COPY_ERRORS:
+            return False
+        raise
+    os.lseek(dst_fd, size, os.SEEK_SET)
+    return True
+
+
+def copy_range(src_fd: int, dst_fd: int, offset: int, size: int):
+    """
+    Appends [offset, offset + size) of src to dst. The copy is done by the kernel when possible, so the data never
+    goes through Python memory, and otherwise in chunks of COPY_CHUNK_SIZE.
+    """
+    copied = 0
+    for copy in (os.copy_file_range, lambda src, dst, count, position: os.sendfile(dst, src, position, count)):
+        try:
+            while copied < size:
+                count = copy(src_fd, dst_fd, size - copied, offset + copied)
+                if count == 0:
+                    break
+                copied += count
+            break
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_COPY_ERRORS:
+                raise
+    while copied < size:
+        chunk = os.pread(src_fd, min(size - copied, COPY_CHUNK_SIZE), offset + copied)
+        if not chunk:
+            break
+        copied += os.write(dst_fd, chunk)
+    if copied < size:
+        raise RuntimeError(f"Unexpected end of file copying [{offset}, {offset + size})")
+
+
+def hash_range(src_fd: int, offset: int, size: int, dst_fd: Optional[int] = None) -> str:
+    """Returns the digest of [offset, offset + size) of src, also appending that range to dst if given."""
+    digest = hashlib.new(DIGEST_ALGORITHM)
+    buffer = memoryview(bytearray(min(size, COPY_CHUNK_SIZE)))
+    done = 0
+    while done < size:
+        count = os.preadv(src_fd, [buffer[:size - done]], offset + done)
+        if count == 0:
+            raise RuntimeError(f"Unexpected end of file copying [{offset}, {offset + size})")
+        chunk = buffer[:count]
+        digest.update(chunk)
+        while dst_fd is not None and chunk:
+            chunk = chunk[os.write(dst_fd, chunk):]
+        done += count
+    return digest.hexdigest()
+
+
+def extract_range(src_fd: int, dst_path: str, offset: int, size: int, reflink: bool):
+    with open(dst_path, "wb") as dst_file:
+        if not (reflink and clone_range(src_fd, dst_file.fileno(), offset, size)):
+            copy_range(src_fd, dst_file.fileno(), offset, size)
+
+
+class SegmentFile(NamedTuple):
+    name: str
+    size: int
+    digest: Optional[str]
+
+
+def load_checksums(directory: str) -> Dict[str, SegmentFile]:
+    """
+    Returns the segment files listed in the sidecar file of directory, leaving out those that were modified after it
+    was written or have another size, as their digest doesn't tell their content anymore.
+    """
+    checksums_path = os.path.join(directory, CHECKSUMS_NAME)
+    try:
+        with open(checksums_path) as f:
+            checksums_mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            checksums = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if checksums.get("algorithm") != DIGEST_ALGORITHM:
+        return {}
+    segment_files = {}
+    for entry in checksums["files"]:
+        try:
+            stat = os.stat(os.path.join(directory, entry["name"]))
+        except OSError:
+            continue
+        if stat.st_size == entry["size"] and stat.st_mtime_ns <= checksums_mtime_ns:
+            segment_files[entry["name"]] = SegmentFile(entry["name"], entry["size"], entry["digest"])
+    return segment_files
+
+
+def write_checksums(directory: str, segment_files: List[SegmentFile]):
+    checksums = {
+        "algorithm": DIGEST_ALGORITHM,
+        "files": [segment_file._asdict() for segment_file in segment_files],
+    }
+    checksums_path = os.path.join(directory, CHECKSUMS_NAME)
+    temporary_path = f"{checksums_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(checksums, f, indent=4)
+    os.replace(temporary_path, checksums_path)
+
+
+def is_unchanged(segment_file: SegmentFile, previous: Optional[SegmentFile]) -> bool:
+    """Whether a segment file written before, as load_checksums() found it, already has the right content."""
+    return segment_file == previous
+
+
+def remove_stale_segments(directory: str, segment_files: List[SegmentFile]):
+    """Removes the segment files left by an earlier split of a file that had more segments."""
+    names = {segment_file.name for segment_file in segment_files}
+    for name in os.listdir(directory):
+        if SEGMENT_NAME.fullmatch(name) and name not in names:
+            os.remove(os.path.join(directory, name))
+
+
+def write_segment(src_fd: int, directory: str, name: str, offset: int, size: int, reflink: bool, checksums: bool,
+                  previous: Optional[SegmentFile]) -> SegmentFile:
+    dst_path = os.path.join(directory, name)
+    with instrumentation.phase("segment write"):
+        if not checksums:
+            extract_range(src_fd, dst_path, offset, size, reflink)
+            instrumentation.count("segments", "written")
+            return SegmentFile(name, size, None)
+        if reflink or previous is not None:
+            # Hashed first, as the data may not need to be written, or can be written without reading it here
+            segment_file = SegmentFile(name, size, hash_range(src_fd, offset, size))
+            if is_unchanged(segment_file, previous):
+                instrumentation.count("segments", "unchanged")
+            else:
+                extract_range(src_fd, dst_path, offset, size, reflink)
+                instrumentation.count("segments", "written")
+            return segment_file
+        # Hashed while it's copied, so the data is only read once
+        with open(dst_path, "wb") as dst_file:
+            segment_file = SegmentFile(name, size, hash_range(src_fd, offset, size, dst_file.fileno()))
+        instrumentation.count("segments", "written")
+        return segment_file
+
+
+def split_segments(file_path, base_dir, reflink: bool = False, checksums: bool = True, skip_unchanged: bool = False,
+                   jobs: int = 4):
+    """
+    The segments are written by a pool of jobs threads while the file is still being parsed. With checksums, their
+    digests are written to a sidecar file, which skip_unchanged uses to leave alone the segment files that already
+    have the right content.
+    """
     if file_path.endswith(".mp4"):
         parser = MP4Parser()
     elif file_path.endswith(".webm"):
@@ -23,27 +199,161 @@ def split_segments(file_path, base_dir):
     except FileExistsError:
         pass
 
-    media_segments = parser.find_media_segments(FileByteReader(open(file_path, "rb")))
-
+    previous = load_checksums(directory) if skip_unchanged else {}
     extension = os.path.splitext(file_path)[1]
-    with open(file_path, "rb") as srcfile:
-        with open(os.path.join(directory, f"init{extension}"), "wb") as dst_file:
-            dst_file.write(srcfile.read(media_segments[0].offset))
-        for i, segment in enumerate(media_segments, 1):
-            if i > 1:
-                assert segment.offset == media_segments[i - 2].offset + media_segments[i - 2].size
-            with open(os.path.join(directory, f"media{i}{extension}"), "wb") as dst_file:
-                dst_file.write(srcfile.read(segment.size))
+    segment_files = []
+    with open(file_path, "rb") as src_file, ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+
+        def submit(name: str, offset: int, size: int):
+            # Bounds how far parsing can get ahead of writing
+            if len(pending) >= 2 * jobs:
+                segment_files.append(pending.popleft().result())
+            pending.append(executor.submit(write_segment, src_file.fileno(), directory, name, offset, size, reflink,
+                                           checksums, previous.get(name)))
+
+        last_end = None
+        for i, segment in enumerate(parser.iter_media_segments(open_file_reader(file_path), keep_data=True), 1):
+            if i == 1:
+                submit(f"init{extension}", 0, segment.offset)
+            else:
+                assert segment.offset == last_end
+            submit(f"media{i}{extension}", segment.offset, segment.size)
+            last_end = segment.offset + segment.size
+        segment_files.extend(future.result() for future in pending)
+    remove_stale_segments(directory, segment_files)
+    if checksums:
+        write_checksums(directory, segment_files)
+
+
+def split_stream(file, base_dir, checksums: bool = True, skip_unchanged: bool = False):
+    """Splits a stream like stdin as it is read, into a directory named stdin."""
+    reader = StreamByteReader(file)
+    parser = parser_for_stream(reader)
+    extension = ".webm" if isinstance(parser, MatroskaParser) else ".mp4"
+
+    directory = os.path.join(base_dir, "stdin")
+    try:
+        os.mkdir(directory)
+    except FileExistsError:
+        pass
+
+    previous = load_checksums(directory) if skip_unchanged else {}
+    segment_files = []
+
+    def write(name: str, data: bytes):
+        with instrumentation.phase("segment write"):
+            segment_file = SegmentFile(name, len(data), hashlib.new(DIGEST_ALGORITHM, data).hexdigest() if checksums
+                                       else None)
+            if skip_unchanged and is_unchanged(segment_file, previous.get(name)):
+                instrumentation.count("segments", "unchanged")
+            else:
+                with open(os.path.join(directory, name), "wb") as dst_file:
+                    dst_file.write(data)
+                instrumentation.count("segments", "written")
+        segment_files.append(segment_file)
+
+    # Each segment can still be read when it's yielded, as well as the init segment with the first one
+    for i, segment in enumerate(parser.iter_media_segments(reader, keep_data=True), 1):
+        if i == 1:
+            write(f"init{extension}", reader.read_at(reader.start, segment.offset - reader.start))
+        write(f"media{i}{extension}", reader.read_at(segment.offset, segment.size))
+    remove_stale_segments(directory, segment_files)
+    if checksums:
+        write_checksums(directory, segment_files)
+
+
+class TestSegmentSplit(TestCase):
+    def test_copy_range(self):
+        data = os.urandom(3 * COPY_CHUNK_SIZE)
+        with TemporaryDirectory() as directory:
+            src_path = os.path.join(directory, "src")
+            with open(src_path, "wb") as f:
+                f.write(data)
+            with open(src_path, "rb") as src_file, open(os.path.join(directory, "dst"), "wb+") as dst_file:
+                src_fd, dst_fd = src_file.fileno(), dst_file.fileno()
+                copy_range(src_fd, dst_fd, 10, 2 * COPY_CHUNK_SIZE)
+                self.assertEqual(hashlib.new(DIGEST_ALGORITHM, data[20:30]).hexdigest(), hash_range(src_fd, 20, 10))
+                self.assertEqual(hashlib.new(DIGEST_ALGORITHM, data[5:]).hexdigest(),
+                                 hash_range(src_fd, 5, len(data) - 5, dst_fd))
+                self.assertEqual(data[10:10 + 2 * COPY_CHUNK_SIZE] + data[5:], os.pread(dst_fd, 2 * len(data), 0))
+                with self.assertRaises(RuntimeError):
+                    copy_range(src_fd, dst_fd, len(data) - 10, 20)
+                with self.assertRaises(RuntimeError):
+                    hash_range(src_fd, len(data) - 10, 20)
+
+    def test_skip_unchanged(self):
+        from synthetic import write_file
+
+        with TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, "file.mp4")
+            write_file(file_path, 5)
+            segments_dir = os.path.join(directory, "segments")
+            os.mkdir(segments_dir)
+            directory_path = os.path.join(segments_dir, "file.mp4")
+            names = ["init.mp4"] + [f"media{i}.mp4" for i in range(1, 6)]
+
+            def split() -> dict:
+                with instrumentation.collect() as stats:
+                    split_segments(file_path, segments_dir, skip_unchanged=True, jobs=2)
+                self.assertEqual(sorted(names + [CHECKSUMS_NAME]), sorted(os.listdir(directory_path)))
+                with open(file_path, "rb") as f:
+                    data = f.read()
+                for name in names:
+                    with open(os.path.join(directory_path, name), "rb") as f:
+                        segment = f.read()
+                    self.assertEqual(data[:len(segment)], segment, name)
+                    data = data[len(segment):]
+                self.assertEqual(b"", data)
+                return stats.counters["segments"]
+
+            self.assertEqual({"written": 6}, split())
+            self.assertEqual({"unchanged": 6}, split())
+            # Same size as in the sidecar, but modified after it was written
+            media2_path = os.path.join(directory_path, "media2.mp4")
+            with open(media2_path, "r+b") as f:
+                f.write(b"changed")
+            checksums_mtime_ns = os.stat(os.path.join(directory_path, CHECKSUMS_NAME)).st_mtime_ns
+            os.utime(media2_path, ns=(checksums_mtime_ns, checksums_mtime_ns + 1))
+            self.assertEqual({"unchanged": 5, "written": 1}, split())
+
+            # Fewer segments than before, the last ones are removed
+            write_file(file_path, 3)
+            names = names[:4]
+            self.assertEqual({"unchanged": 4}, split())
 
 
 if __name__ == '__main__':
     parser = ArgumentParser(description="Splits MP4 and WebM MSE Bytestream files into one file per segment.")
     parser.add_argument("--basedir", "-b", help="Base directory where the segments will be extracted to.")
-    parser.add_argument("FILES", nargs="+")
+    parser.add_argument("--reflink", action="store_true",
+                        help="Share the data of the segments with the original file instead of copying it, where the "
+                             "filesystem supports it and the segments are aligned to its blocks.")
+    parser.add_argument("--jobs", "-j", type=int, default=4,
+                        help="Number of segments written in parallel, 0 to use one thread per CPU.")
+    parser.add_argument("--no-checksums", dest="checksums", action="store_false",
+                        help=f"Don't write {CHECKSUMS_NAME} with the digest of each segment file, which allows "
+                             f"copying them in the kernel without reading them.")
+    parser.add_argument("--skip-unchanged", action="store_true",
+                        help=f"Don't rewrite the segment files that already have the right content according to "
+                             f"the {CHECKSUMS_NAME} of a previous split.")
+    parser.add_argument("--stats", action="store_true",
+                        help="Print the reads, boxes and elements visited, segments written and time spent in each "
+                             "phase. Segment writes run in parallel, so their times add up across threads.")
+    parser.add_argument("FILES", nargs="+", help="Files to split, - reads a stream from stdin.")
     args = parser.parse_args()
+    if args.skip_unchanged and not args.checksums:
+        parser.error("--skip-unchanged needs checksums")
 
     if not os.path.exists(args.basedir):
         os.mkdir(args.basedir)
 
-    for file_path in args.FILES:
-        split_segments(file_path, args.basedir)
+    with instrumentation.collect() if args.stats else nullcontext() as stats:
+        for file_path in args.FILES:
+            if file_path == "-":
+                split_stream(sys.stdin.buffer, args.basedir, args.checksums, args.skip_unchanged)
+            else:
+                split_segments(file_path, args.basedir, args.reflink, args.checksums, args.skip_unchanged,
+                               args.jobs or os.cpu_count())
+    if stats is not None:
+        stats.report()
@@ -0,0 +1,523 @@
+#!/usr/bin/python3
+import os
+import struct
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from typing import BinaryIO, Collection, Optional, Sequence
+from unittest import TestCase
+
+import instrumentation
+from bytereader import StreamByteReader, open_file_reader
+from matroska import MatroskaParser
+from manifestclient import manifest_path
+from manifestformat import load_manifest
+from mp4 import MP4Parser
+from mseparser import jsonify
+
+# Generates structurally valid fragmented MP4 and WebM files with zero-filled payloads. Payload bytes are never
+# written, just seeked over, so on filesystems supporting sparse files even multi-GB outputs are cheap to produce.
+
+KEYFRAME_SAMPLE_FLAGS = 0x02000000  # sample_depends_on = 2
+NON_KEYFRAME_SAMPLE_FLAGS = 0x01010000  # sample_depends_on = 1, sample_is_non_sync_sample
+
+
+def mp4_box(kind: bytes, payload: bytes = b"") -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def mp4_full_box(kind: bytes, version: int, flags: int, payload: bytes) -> bytes:
+    return mp4_box(kind, struct.pack(">I", (version << 24) | flags) + payload)
+
+
+class SyntheticTrack:
+    def __init__(self, track_id: int = 1, timescale: int = 90000, sample_duration: int = 3000,
+                 samples_per_fragment: int = 60, sample_size: int = 1000, composition_offset: int = 0,
+                 media_time: Optional[int] = None, empty_edit_duration: int = 0, keyframe_interval: int = 0,
+                 handler: bytes = b"vide"):
+        self.track_id = track_id
+        self.timescale = timescale
+        self.sample_duration = sample_duration
+        self.samples_per_fragment = samples_per_fragment
+        self.sample_size = sample_size
+        self.composition_offset = composition_offset
+        self.media_time = media_time
+        self.empty_edit_duration = empty_edit_duration
+        # 0 means only the first sample of each fragment is a keyframe
+        self.keyframe_interval = keyframe_interval
+        self.handler = handler
+
+    def sample_flags(self, index: int) -> int:
+        if index == 0 or (self.keyframe_interval and index % self.keyframe_interval == 0):
+            return KEYFRAME_SAMPLE_FLAGS
+        return NON_KEYFRAME_SAMPLE_FLAGS
+
+    @property
+    def fragment_duration(self) -> int:
+        return self.sample_duration * self.samples_per_fragment
+
+    @property
+    def fragment_payload_size(self) -> int:
+        return self.sample_size * self.samples_per_fragment
+
+
+def _mp4_track_box(track: SyntheticTrack) -> bytes:
+    tkhd = mp4_full_box(b"tkhd", 0, 3, struct.pack(">IIIIIQhhhH36sII", 0, 0, track.track_id, 0, 0, 0, 0, 0,
+                                                     0x0100 if track.handler == b"soun" else 0, 0, bytes(36), 0, 0))
+    edts = b""
+    if track.media_time is not None or track.empty_edit_duration:
+        edits = b""
+        count = 0
+        if track.empty_edit_duration:
+            edits += struct.pack(">IiI", track.empty_edit_duration, -1, 0x00010000)
+            count += 1
+        if track.media_time is not None:
+            edits += struct.pack(">IiI", 0, track.media_time, 0x00010000)
+            count += 1
+        edts = mp4_box(b"edts", mp4_full_box(b"elst", 0, 0, struct.pack(">I", count) + edits))
+    mdhd = mp4_full_box(b"mdhd", 0, 0, struct.pack(">IIIIHH", 0, 0, track.timescale, 0, 0x55C4, 0))
+    hdlr = mp4_full_box(b"hdlr", 0, 0, struct.pack(">I4s12s", 0, track.handler, bytes(12)) + b"\0")
+    dinf = mp4_box(b"dinf", mp4_full_box(b"dref", 0, 0, struct.pack(">I", 1) + mp4_full_box(b"url ", 0, 1, b"")))
+    stbl = mp4_box(b"stbl", b"".join([
+        mp4_full_box(b"stsd", 0, 0, struct.pack(">I", 0)),
+        mp4_full_box(b"stts", 0, 0, struct.pack(">I", 0)),
+        mp4_full_box(b"stsc", 0, 0, struct.pack(">I", 0)),
+        mp4_full_box(b"stsz", 0, 0, struct.pack(">II", 0, 0)),
+        mp4_full_box(b"stco", 0, 0, struct.pack(">I", 0)),
+    ]))
+    minf = mp4_box(b"minf", dinf + stbl)
+    mdia = mp4_box(b"mdia", mdhd + hdlr + minf)
+    return mp4_box(b"trak", tkhd + edts + mdia)
+
+
+def _mp4_moov(tracks: Sequence[SyntheticTrack], movie_timescale: int) -> bytes:
+    mvhd = mp4_full_box(b"mvhd", 0, 0, struct.pack(">IIIIIH10s36s24sI", 0, 0, movie_timescale, 0, 0x00010000,
+                                                     0x0100, bytes(10), bytes(36), bytes(24), len(tracks) + 1))
+    mvex = mp4_box(b"mvex", b"".join(
+        mp4_full_box(b"trex", 0, 0, struct.pack(">IIIII", track.track_id, 1, track.sample_duration,
+                                                track.sample_size, NON_KEYFRAME_SAMPLE_FLAGS))
+        for track in tracks))
+    return mp4_box(b"moov", mvhd + b"".join(_mp4_track_box(track) for track in tracks) + mvex)
+
+
+def _mp4_moof(sequence_number: int, tracks: Sequence[SyntheticTrack], fragment_index: int,
+              first_sample_flags: bool) -> bytes:
+    def traf(track: SyntheticTrack, data_offset: int) -> bytes:
+        tfhd = mp4_full_box(b"tfhd", 0, 0x20000, struct.pack(">I", track.track_id))
+        tfdt = mp4_full_box(b"tfdt", 1, 0, struct.pack(">Q", fragment_index * track.fragment_duration))
+        tr_flags = 0x1 | 0x100 | 0x200 | (0x800 if track.composition_offset else 0)
+        tr_flags |= 0x4 if first_sample_flags else 0x400
+        header = struct.pack(">Ii", track.samples_per_fragment, data_offset)
+        if first_sample_flags:
+            header += struct.pack(">I", KEYFRAME_SAMPLE_FLAGS)
+        samples = []
+        for i in range(track.samples_per_fragment):
+            fields = [track.sample_duration, track.sample_size]
+            if not first_sample_flags:
+                fields.append(track.sample_flags(i))
+            if track.composition_offset:
+                fields.append(track.composition_offset)
+            samples.append(struct.pack(f">{len(fields)}I", *fields))
+        trun = mp4_full_box(b"trun", 0, tr_flags, header + b"".join(samples))
+        return mp4_box(b"traf", tfhd + tfdt + trun)
+
+    def build(data_offsets):
+        mfhd = mp4_full_box(b"mfhd", 0, 0, struct.pack(">I", sequence_number))
+        return mp4_box(b"moof", mfhd + b"".join(traf(track, offset) for track, offset in zip(tracks, data_offsets)))
+
+    # Data offsets are relative to the moof start, so they depend on the moof size itself.
+    moof_size = len(build([0] * len(tracks)))
+    data_offsets = []
+    offset = moof_size + 8
+    for track in tracks:
+        data_offsets.append(offset)
+        offset += track.fragment_payload_size
+    return build(data_offsets)
+
+
+def write_fragmented_mp4(file: BinaryIO, num_fragments: int, tracks: Optional[Sequence[SyntheticTrack]] = None,
+                         movie_timescale: int = 1000, with_sidx: bool = False, with_mfra: bool = False,
+                         first_sample_flags: bool = False, unindexed: Collection[int] = ()):
+    """unindexed fragments are left out of the mfra, like the ones without sync samples."""
+    if tracks is None:
+        tracks = [SyntheticTrack()]
+    ftyp = mp4_box(b"ftyp", b"iso6\0\0\0\0iso6mp41")
+    moov = _mp4_moov(tracks, movie_timescale)
+    moofs = [_mp4_moof(i + 1, tracks, i, first_sample_flags) for i in range(num_fragments)]
+    mdat_size = 8 + sum(track.fragment_payload_size for track in tracks)
+    fragment_sizes = [len(moof) + mdat_size for moof in moofs]
+
+    file.write(ftyp)
+    file.write(moov)
+    if with_sidx:
+        track = tracks[0]
+        references = b"".join(struct.pack(">III", size, track.fragment_duration, 0x90000000)
+                              for size in fragment_sizes)
+        file.write(mp4_full_box(b"sidx", 1, 0, struct.pack(">IIQQHH", track.track_id, track.timescale,
+                                                           track.composition_offset, 0, 0, num_fragments)
+                                + references))
+
+    moof_offsets = []
+    for moof in moofs:
+        moof_offsets.append(file.tell())
+        file.write(moof)
+        file.write(struct.pack(">I4s", mdat_size, b"mdat"))
+        file.seek(mdat_size - 8, os.SEEK_CUR)
+    file.truncate()
+
+    if with_mfra:
+        tfras = b""
+        for track in tracks:
+            indexed = [i for i in range(num_fragments) if i not in unindexed]
+            entries = b"".join(struct.pack(">QQBBB", i * track.fragment_duration + track.composition_offset,
+                                           moof_offsets[i], 1, 1, 1)
+                               for i in indexed)
+            tfras += mp4_full_box(b"tfra", 1, 0, struct.pack(">III", track.track_id, 0, len(indexed)) + entries)
+        mfra_size = 8 + len(tfras) + 16
+        file.write(mp4_box(b"mfra", tfras + mp4_full_box(b"mfro", 0, 0, struct.pack(">I", mfra_size))))
+
+
+EBML_UNKNOWN_SIZE = b"\x01\xff\xff\xff\xff\xff\xff\xff"
+
+
+def ebml_size(size: int, length: int = 0) -> bytes:
+    if length == 0:
+        length = 1
+        while size >= (1 << (7 * length)) - 1:
+            length += 1
+    return ((1 << (7 * length)) | size).to_bytes(length, "big")
+
+
+def ebml_element(element_id: int, payload: bytes, size_length: int = 0, unknown_size: bool = False) -> bytes:
+    size = EBML_UNKNOWN_SIZE if unknown_size else ebml_size(len(payload), size_length)
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") + size + payload
+
+
+def ebml_uint(element_id: int, value: int) -> bytes:
+    return ebml_element(element_id, value.to_bytes(max(1, (value.bit_length() + 7) // 8), "big"))
+
+
+def write_webm(file: BinaryIO, num_clusters: int, blocks_per_cluster: int = 60, block_size: int = 1000,
+               block_duration: int = 33, timestamp_scale: int = 1_000_000, with_cues: bool = False,
+               unknown_size_segment: bool = False, unknown_size_clusters: bool = False,
+               keyframe_interval: int = 0, tracks: int = 1, unindexed: Collection[int] = ()):
+    """unindexed clusters are left out of the Cues, like the ones without keyframes."""
+    file.write(ebml_element(0x1A45DFA3, b"".join([
+        ebml_uint(0x4286, 1), ebml_uint(0x42F7, 1), ebml_uint(0x42F2, 4), ebml_uint(0x42F3, 8),
+        ebml_element(0x4282, b"webm"), ebml_uint(0x4287, 4), ebml_uint(0x4285, 2),
+    ])))
+
+    info = ebml_element(0x1549A966, ebml_uint(0x2AD7B1, timestamp_scale) +
+                        ebml_element(0x4D80, b"synthetic") + ebml_element(0x5741, b"synthetic"))
+    track_entries = b""
+    for track_number in range(1, tracks + 1):
+        is_video = track_number == 1
+        track_entries += ebml_element(0xAE, b"".join([
+            ebml_uint(0xD7, track_number), ebml_uint(0x73C5, track_number), ebml_uint(0x83, 1 if is_video else 2),
+            ebml_element(0x86, b"V_VP9" if is_video else b"A_OPUS"),
+        ]))
+    track_info = ebml_element(0x1654AE6B, track_entries)
+
+    cluster_duration = blocks_per_cluster * block_duration
+    block_header_size = 4  # track number, timestamp, flags
+    block_element_size = 1 + len(ebml_size(block_header_size + block_size)) + block_header_size + block_size
+
+    def cluster_header(index: int) -> bytes:
+        # Fixed width, so that all cluster headers have the same size
+        timestamp = ebml_element(0xE7, (index * cluster_duration).to_bytes(8, "big"))
+        content_size = len(timestamp) + block_element_size * blocks_per_cluster * tracks
+        size = EBML_UNKNOWN_SIZE if unknown_size_clusters else ebml_size(content_size, 8)
+        return b"\x1f\x43\xb6\x75" + size + timestamp
+
+    cluster_size = len(cluster_header(0)) + block_element_size * blocks_per_cluster * tracks
+
+    # SeekHead positions are written with a fixed width, so its size does not depend on them.
+    def seek_head(info_position: int, tracks_position: int, cues_position: int) -> bytes:
+        seeks = [(0x1549A966, info_position), (0x1654AE6B, tracks_position)]
+        if with_cues:
+            seeks.append((0x1C53BB6B, cues_position))
+        return ebml_element(0x114D9B74, b"".join(
+            ebml_element(0x4DBB, ebml_element(0x53AB, element_id.to_bytes(4, "big")) +
+                         ebml_element(0x53AC, position.to_bytes(8, "big")))
+            for element_id, position in seeks))
+
+    info_position = len(seek_head(0, 0, 0))
+    tracks_position = info_position + len(info)
+    first_cluster_position = tracks_position + len(track_info)
+    cues_position = first_cluster_position + cluster_size * num_clusters
+
+    cues = b""
+    if with_cues:
+        cues = ebml_element(0x1C53BB6B, b"".join(
+            ebml_element(0xBB, ebml_uint(0xB3, i * cluster_duration) + ebml_element(
+                0xB7, ebml_uint(0xF7, 1) + ebml_uint(0xF1, first_cluster_position + i * cluster_size)))
+            for i in range(num_clusters) if i not in unindexed))
+
+    segment_size = cues_position + len(cues)
+    file.write(b"\x18\x53\x80\x67" + (EBML_UNKNOWN_SIZE if unknown_size_segment else ebml_size(segment_size, 8)))
+    file.write(seek_head(info_position, tracks_position, cues_position))
+    file.write(info)
+    file.write(track_info)
+    for i in range(num_clusters):
+        file.write(cluster_header(i))
+        for j in range(blocks_per_cluster):
+            keyframe = j == 0 or (keyframe_interval and j % keyframe_interval == 0)
+            for track_number in range(1, tracks + 1):
+                file.write(b"\xa3" + ebml_size(block_header_size + block_size) +
+                           struct.pack(">BhB", 0x80 | track_number, j * block_duration, 0x80 if keyframe else 0))
+                file.seek(block_size, os.SEEK_CUR)
+    file.truncate()
+    file.write(cues)
+
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(size: str) -> int:
+    """Parses sizes like 500K, 10M or 20G, in powers of 1024."""
+    unit = size[-1:].upper() if size[-1:].isalpha() else ""
+    if unit not in SIZE_UNITS:
+        raise ValueError(f"Invalid size: {size}")
+    return int(float(size[:len(size) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def fragments_for_size(size: int, samples_per_fragment: int = 60, sample_size: int = 1000) -> int:
+    return max(1, size // (samples_per_fragment * sample_size))
+
+
+def write_file(path: str, num_fragments: int, samples_per_fragment: int = 60, sample_size: int = 1000,
+               sidx: bool = False, mfra: bool = False, cues: bool = False, unknown_sizes: bool = False):
+    """Writes a fragmented MP4 or a WebM file depending on the extension of path, with a single video track."""
+    with open(path, "wb") as f:
+        if path.endswith(".webm"):
+            write_webm(f, num_fragments, blocks_per_cluster=samples_per_fragment, block_size=sample_size,
+                       with_cues=cues, unknown_size_segment=unknown_sizes, unknown_size_clusters=unknown_sizes)
+        else:
+            write_fragmented_mp4(f, num_fragments, [SyntheticTrack(samples_per_fragment=samples_per_fragment,
+                                                                   sample_size=sample_size)],
+                                 with_sidx=sidx, with_mfra=mfra)
+
+
+class TestSynthetic(TestCase):
+    def test_parsers(self):
+        variants = {
+            "plain.mp4": {},
+            "indexed.mp4": {"sidx": True, "mfra": True},
+            "plain.webm": {},
+            "indexed.webm": {"cues": True},
+            "unknown-sizes.webm": {"unknown_sizes": True},
+        }
+        with TemporaryDirectory() as directory:
+            for name, options in variants.items():
+                path = os.path.join(directory, name)
+                write_file(path, 5, sample_size=100_000, **options)
+                parser = MatroskaParser() if name.endswith(".webm") else MP4Parser()
+                media_segments = parser.find_media_segments(open_file_reader(path))
+                # 60 frames of 3000 ticks at 90 kHz in MP4, 60 blocks of 33 ms in WebM
+                duration = Fraction(2) if name.endswith(".mp4") else Fraction(1980, 1000)
+                self.assertEqual([i * duration for i in range(5)], [segment.time for segment in media_segments],
+                                 name)
+                self.assertGreater(media_segments[-1].offset + media_segments[-1].size, 5 * 60 * 100_000)
+                self.assertEqual(jsonify(media_segments),
+                                 jsonify(parser.find_media_segments(open_file_reader(path), media_segments[:3])), name)
+                samples = parser.find_samples(open_file_reader(path))
+                self.assertEqual(300, len(samples.offsets), name)
+                self.assertEqual(5, sum(samples.keyframes), name)
+
+    def test_multi_track(self):
+        video = SyntheticTrack(1, samples_per_fragment=60, sample_size=1000)
+        # 94 frames of 1024 samples at 48 kHz, starting 2048 samples in according to the edit list
+        audio = SyntheticTrack(2, timescale=48000, sample_duration=1024, samples_per_fragment=94, sample_size=100,
+                               media_time=2048, handler=b"soun")
+        with TemporaryDirectory() as directory:
+            for name in ("muxed.mp4", "muxed.webm"):
+                path = os.path.join(directory, name)
+                with open(path, "wb") as f:
+                    if name.endswith(".mp4"):
+                        write_fragmented_mp4(f, 5, [video, audio])
+                        expected = [{1: i * Fraction(2), 2: i * Fraction(96256, 48000) - Fraction(2048, 48000)}
+                                    for i in range(5)]
+                    else:
+                        write_webm(f, 5, tracks=2)
+                        expected = [{1: i * Fraction(1980, 1000), 2: i * Fraction(1980, 1000)} for i in range(5)]
+                parser = MatroskaParser() if name.endswith(".webm") else MP4Parser()
+                media_segments = parser.find_media_segments(open_file_reader(path))
+                self.assertEqual(expected, [segment.track_times for segment in media_segments], name)
+                if name.endswith(".mp4"):
+                    self.assertEqual([min(times.values()) for times in expected],
+                                     [segment.time for segment in media_segments])
+                self.assertEqual(jsonify(media_segments),
+                                 jsonify(list(parser.iter_media_segments(open_file_reader(path)))), name)
+                self.assertEqual(jsonify(media_segments),
+                                 jsonify(parser.find_media_segments(open_file_reader(path), media_segments[:3])), name)
+
+    def test_sharded(self):
+        video = SyntheticTrack(1)
+        audio = SyntheticTrack(2, timescale=48000, sample_duration=1024, samples_per_fragment=94, sample_size=100,
+                               media_time=2048, handler=b"soun")
+        with TemporaryDirectory() as directory, ProcessPoolExecutor(2) as executor:
+            for name in ("plain.mp4", "muxed.mp4", "plain.webm", "muxed.webm", "unknown-sizes.webm"):
+                path = os.path.join(directory, name)
+                with open(path, "wb") as f:
+                    if name == "muxed.mp4":
+                        write_fragmented_mp4(f, 7, [video, audio])
+                    elif name == "muxed.webm":
+                        write_webm(f, 7, tracks=2)
+                if not name.startswith("muxed"):
+                    write_file(path, 7, unknown_sizes=name.startswith("unknown"))
+                parser = MatroskaParser() if name.endswith(".webm") else MP4Parser()
+                media_segments = parser.find_media_segments(open_file_reader(path))
+                self.assertEqual(jsonify(media_segments),
+                                 jsonify(parser.find_media_segments_sharded(path, executor, 3)), name)
+                self.assertEqual(jsonify(media_segments),
+                                 jsonify(parser.find_media_segments_sharded(path, executor, 3, media_segments[:4])),
+                                 name)
+                self.assertEqual(parser.find_samples(open_file_reader(path)).to_dict(),
+                                 parser.find_samples_sharded(path, executor, 3).to_dict(), name)
+
+    def test_growing(self):
+        variants = {
+            "growing.mp4": {},
+            "growing.webm": {},
+            # The last unknown-size Cluster is only known to be complete when another one follows it
+            "unknown-sizes.webm": {"unknown_sizes": True},
+        }
+        with TemporaryDirectory() as directory:
+            for name, options in variants.items():
+                path = os.path.join(directory, name)
+                write_file(path, 5, **options)
+                parser = MatroskaParser() if name.endswith(".webm") else MP4Parser()
+                media_segments = parser.find_media_segments(open_file_reader(path))
+                with open(path, "rb") as f:
+                    data = f.read()
+                # Cut in the middle of the mdat or the blocks of the fourth segment
+                with open(path, "wb") as f:
+                    f.write(data[:media_segments[3].offset + media_segments[3].size // 2])
+                previous = parser.find_media_segments(open_file_reader(path), growing=True)
+                self.assertEqual(jsonify(media_segments[:3]), jsonify(previous), name)
+                with open(path, "wb") as f:
+                    f.write(data)
+                complete = 4 if options else 5
+                self.assertEqual(jsonify(media_segments[:complete]),
+                                 jsonify(parser.find_media_segments(open_file_reader(path), previous, growing=True)),
+                                 name)
+
+            path = os.path.join(directory, "growing.mp4")
+            with open(path, "rb") as f:
+                data = f.read()
+            with open(path, "wb") as f:
+                f.write(data[:len(data) * 2 // 3])
+            follow = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                    "manifestgen.py"),
+                                       "--follow", "--interval", "0.05", path], stderr=subprocess.DEVNULL)
+            try:
+                for num_segments in (3, 5):
+                    if num_segments == 5:
+                        with open(path, "ab") as f:
+                            f.write(data[len(data) * 2 // 3:])
+                    for _ in range(200):
+                        time.sleep(0.05)
+                        try:
+                            if len(load_manifest(manifest_path(path)).media_segments) == num_segments:
+                                break
+                        except (OSError, ValueError):
+                            pass  # not written yet, or being written
+                    else:
+                        self.fail(f"--follow didn't list {num_segments} segments")
+            finally:
+                follow.terminate()
+                follow.wait()
+
+    def test_streams(self):
+        with TemporaryDirectory() as directory:
+            for name in ("stream.mp4", "stream.webm"):
+                path = os.path.join(directory, name)
+                write_file(path, 5, sample_size=10_000)
+                parser = MatroskaParser() if name.endswith(".webm") else MP4Parser()
+                expected = jsonify(parser.find_media_segments(open_file_reader(path)))
+                with open(path, "rb") as f:
+                    data = f.read()
+                if name.endswith(".mp4"):
+                    # The last mdat extends to the end of the stream
+                    mdat = data.rindex(b"mdat") - 4
+                    data = data[:mdat] + bytes(4) + data[mdat + 4:]
+                for keep_data in (False, True):
+                    reader = StreamByteReader(BytesIO(data))
+                    media_segments = []
+                    for segment in parser.iter_media_segments(reader, keep_data):
+                        media_segments.append(segment)
+                        if keep_data:
+                            self.assertEqual(data[segment.offset:segment.offset + segment.size],
+                                             reader.read_at(segment.offset, segment.size), name)
+                        else:
+                            # Not even the mdat of the last fragment stays buffered
+                            self.assertLess(len(reader._buffer), 1000, name)
+                    self.assertEqual(expected, jsonify(media_segments), name)
+
+    def test_partial_indexes(self):
+        with TemporaryDirectory() as directory:
+            path = os.path.join(directory, "partial.mp4")
+            with open(path, "wb") as f:
+                write_fragmented_mp4(f, 40, with_mfra=True, unindexed=[3])
+            media_segments = MP4Parser().find_media_segments(open_file_reader(path))
+            self.assertEqual(40, len(media_segments))
+            self.assertEqual(media_segments[2].size, media_segments[3].size)
+
+            path = os.path.join(directory, "partial.webm")
+            with open(path, "wb") as f:
+                write_webm(f, 40, with_cues=True, unindexed=[3])
+            media_segments = MatroskaParser().find_media_segments(open_file_reader(path))
+            self.assertEqual([i * Fraction(1980, 1000) for i in range(40)],
+                             [segment.time for segment in media_segments])
+            self.assertEqual({media_segments[0].size}, {segment.size for segment in media_segments})
+
+    def test_cues_reads(self):
+        # Trusting the Cues takes a read per cluster instead of walking each of them
+        with TemporaryDirectory() as directory:
+            reads = {}
+            media_segments = {}
+            for name, options in {"plain.webm": {}, "cues.webm": {"cues": True}}.items():
+                path = os.path.join(directory, name)
+                write_file(path, 200, **options)
+                with instrumentation.collect() as stats:
+                    media_segments[name] = MatroskaParser().find_media_segments(open_file_reader(path))
+                reads[name] = stats.counters["io"]["reads"]
+            # The Cues move the clusters but not their sizes and times
+            self.assertEqual([(segment.size, segment.time) for segment in media_segments["plain.webm"]],
+                             [(segment.size, segment.time) for segment in media_segments["cues.webm"]])
+            self.assertLess(reads["cues.webm"], reads["plain.webm"] / 4)
+
+    def test_parse_size(self):
+        self.assertEqual(20 * 1024 ** 3, parse_size("20G"))
+        self.assertEqual(1536, parse_size("1.5k"))
+        self.assertEqual(100, parse_size("100"))
+        with self.assertRaises(ValueError):
+            parse_size("10X")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Generates synthetic fragmented MP4 and WebM files for testing and "
+                                        "benchmarking.")
+    parser.add_argument("--fragments", "-n", type=int, default=100, help="Number of fragments or clusters.")
+    parser.add_argument("--size", type=parse_size,
+                        help="Approximate file size, like 500M or 20G, instead of a number of fragments.")
+    parser.add_argument("--samples", type=int, default=60, help="Samples or blocks per fragment.")
+    parser.add_argument("--sample-size", type=int, default=1000, help="Payload bytes per sample or block.")
+    parser.add_argument("--sidx", action="store_true", help="Add a sidx box (MP4 only).")
+    parser.add_argument("--mfra", action="store_true", help="Add a mfra box (MP4 only).")
+    parser.add_argument("--cues", action="store_true", help="Add a Cues element (WebM only).")
+    parser.add_argument("--unknown-sizes", action="store_true",
+                        help="Use unknown sizes for the Segment and Clusters (WebM only).")
+    parser.add_argument("OUTPUT", help="Output path, the format is chosen by the extension (.mp4 or .webm).")
+    args = parser.parse_args()
+
+    num_fragments = args.fragments
+    if args.size is not None:
+        num_fragments = fragments_for_size(args.size, args.samples, args.sample_size)
+    write_file(args.OUTPUT, num_fragments, args.samples, args.sample_size, args.sidx, args.mfra, args.cues,
+               args.unknown_sizes)